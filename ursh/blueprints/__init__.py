@@ -1,5 +0,0 @@
-from ursh.blueprints.api.blueprint import bp as api
-from ursh.blueprints.misc import bp as misc
-from ursh.blueprints.redirection import bp as redirection
-
-__all__ = ['redirection', 'api', 'misc']
@@ -1,10 +1,9 @@
 from datetime import UTC, datetime
 
-from flask import Blueprint, g, request
-from sqlalchemy.exc import DataError, SQLAlchemyError
+from flask import Blueprint, current_app, g, request
+from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.exceptions import BadRequest, Conflict, MethodNotAllowed, NotFound
 
-from ursh import db
 from ursh.blueprints.api.handlers import (
     create_error_json,
     handle_bad_requests,
@@ -14,10 +13,21 @@ from ursh.blueprints.api.handlers import (
     handle_method_not_allowed,
     handle_not_found,
 )
-from ursh.blueprints.api.resources import TokenResource, URLResource
-from ursh.models import Token
+from ursh.blueprints.api.internal import (
+    pool_stats,
+    profiling_settings,
+    request_profile,
+    request_profile_results,
+)
+from ursh.blueprints.api.resources import TokenResource, URLResource, URLRewriteResource
+from ursh.core.db import use_replica
+from ursh.storage import get_storage
+from ursh.util.compression import compress_response
+from ursh.util.nested_query_parser import NestedQueryParser
 
 bp = Blueprint('urls', __name__, url_prefix='/api')
+# flask-apispec parses the query string of the resources using this parser
+bp.record_once(lambda state: state.app.config.setdefault('APISPEC_WEBARGS_PARSER', NestedQueryParser()))
 
 tokens_view = TokenResource.as_view('tokens')
 bp.add_url_rule('/tokens/', view_func=tokens_view)
@@ -26,25 +36,38 @@ bp.add_url_rule('/tokens/<api_key>', view_func=tokens_view)
 urls_view = URLResource.as_view('urls')
 bp.add_url_rule('/urls/', view_func=urls_view)
 bp.add_url_rule('/urls/<shortcut>', view_func=urls_view)
+bp.add_url_rule('/url-rewrites/', view_func=URLRewriteResource.as_view('url_rewrites'))
+
+bp.add_url_rule('/internal/pool', view_func=pool_stats)
+bp.add_url_rule('/internal/profiling', view_func=profiling_settings, methods=('GET', 'PATCH'))
+bp.add_url_rule('/internal/profile', view_func=request_profile, methods=('GET', 'POST', 'DELETE'))
+bp.add_url_rule('/internal/profile/<any(pstats,collapsed,memory):result>', view_func=request_profile_results)
 
 
 @bp.before_request
 def authorize_request():
     auth_token = get_token()
-    error_json = create_error_json(401, 'invalid-token', 'The token you have entered is invalid')
     if not auth_token:
-        return error_json
-    try:
-        token = Token.query.filter_by(api_key=auth_token).one_or_none()
-    except DataError:
-        return error_json
+        return _invalid_token()
+    storage = get_storage()
+    token = storage.get_token(auth_token)
     if token is None or token.is_blocked:
-        return error_json
-    token.token_uses = Token.token_uses + 1
-    token.last_access = datetime.now(UTC)
-    db.session.commit()
+        return _invalid_token()
+    now = datetime.now(UTC)
+    read_only = request.method in ('GET', 'HEAD')
+    storage.record_token_access(token, now, write=not read_only)
+    storage.commit()
 
     g.token = token
+    # clients expect to see their own changes, so we only use replicas if there
+    # were no recent writes which may not have been replicated yet
+    if read_only and (not token.last_write or
+                      (now - token.last_write).total_seconds() > current_app.config['REPLICA_STICKY_TIME']):
+        use_replica()
+
+
+def _invalid_token():
+    return create_error_json(401, 'invalid-token', 'The token you have entered is invalid')
 
 
 def get_token():
@@ -56,6 +79,7 @@ def get_token():
     return auth_info if auth_type == 'bearer' else None
 
 
+bp.after_request(compress_response)
 bp.register_error_handler(BadRequest, handle_bad_requests)
 bp.register_error_handler(SQLAlchemyError, handle_db_errors)
 bp.register_error_handler(Conflict, handle_conflict)
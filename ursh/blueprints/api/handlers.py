@@ -1,7 +1,11 @@
 from flask import current_app, jsonify
 
+from ursh.core.metrics import API_ERRORS
+
 
 def handle_bad_requests(error):
+    code = error.description.get('code') if isinstance(error.description, dict) else None
+    API_ERRORS.labels(code or 'bad-request').inc()
     return jsonify({'status': error.code, 'error': error.description}), error.code
 
 
@@ -27,6 +31,7 @@ def handle_internal_exceptions(error):
 
 
 def create_error_json(status_code, error_code, message, **kwargs):
+    API_ERRORS.labels(error_code).inc()
     message_dict = {
         'status': status_code,
         'error': {
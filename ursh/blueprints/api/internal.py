@@ -0,0 +1,252 @@
+import os
+
+from flask import jsonify, request
+from werkzeug.exceptions import NotFound
+
+from ursh import db
+from ursh.core.db import get_lane_engines
+from ursh.core.profiling import (
+    RequestProfile,
+    get_profile_response,
+    get_profiling_settings,
+    get_request_profile,
+    start_request_profile,
+)
+from ursh.schemas import ProfilingSettingsSchema, RequestProfileSchema
+from ursh.util.decorators import admin_only
+
+
+@admin_only
+def pool_stats():
+    """Get statistics about the database connection pools of this process.
+    ---
+    get:
+      tags:
+      - admins
+      summary: returns database connection pool statistics
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      responses:
+        200:
+          description: the pool statistics for each database engine
+        403:
+          description: not an admin token
+    """
+    names = {engine: bind_key or 'default' for bind_key, engine in db.engines.items()}
+    stats = {name: _get_pool_stats(engine.pool) for engine, name in names.items()}
+    stats.update((f'{names[base_engine]}/{lane}', _get_pool_stats(engine.pool))
+                 for base_engine, lane, engine in get_lane_engines()
+                 if base_engine in names)
+    return jsonify(stats)
+
+
+def _get_pool_stats(pool):
+    try:
+        return pool.get_stats()
+    except AttributeError:
+        return {'status': pool.status()}
+
+
+@admin_only
+def profiling_settings():
+    """Get or change the SQL profiling settings of this process.
+    ---
+    get:
+      tags:
+      - admins
+      summary: returns the SQL profiling settings
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      responses:
+        200:
+          description: the SQL profiling settings and the id of the process using them
+        403:
+          description: not an admin token
+    patch:
+      tags:
+      - admins
+      summary: changes the SQL profiling settings
+      description: >
+        Only the worker process handling the request is affected, and its process id is
+        included in the response.  To change the settings of all workers, set
+        `SQL_PROFILING`, `SLOW_QUERY_THRESHOLD` and `SLOW_QUERY_EXPLAIN_RATE` in the config
+        file (or the environment) instead and reload the workers, e.g. by sending SIGHUP to
+        the gunicorn master process.  Changes made using this endpoint are lost when the
+        worker is restarted.
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      - in: body
+        name: settings
+        description: the settings to change; one or more can be specified
+        schema:
+          type: object
+          properties:
+            enabled:
+              type: boolean
+              description: 'log the number of queries and the database time of each request'
+            slow_query_threshold:
+              type: integer
+              description: 'log queries taking longer than this many milliseconds (null to disable)'
+            explain_rate:
+              type: number
+              description: 'the fraction of slow queries logged with their query plan'
+      responses:
+        200:
+          description: the new SQL profiling settings and the id of the process using them
+        400:
+          description: invalid settings
+        403:
+          description: not an admin token
+    """
+    settings = get_profiling_settings()
+    if request.method == 'PATCH':
+        for key, value in ProfilingSettingsSchema().load(request.get_json(silent=True) or {}).items():
+            setattr(settings, key, value)
+    return jsonify(settings.to_dict() | {'pid': os.getpid()})
+
+
+@admin_only
+def request_profile():
+    """Get, start or stop profiling the next requests handled by this process.
+    ---
+    get:
+      tags:
+      - admins
+      summary: returns the status of the current request profile
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      responses:
+        200:
+          description: the current request profile, or null if none was started
+        403:
+          description: not an admin token
+    post:
+      tags:
+      - admins
+      summary: starts profiling the next requests
+      description: >
+        Only the process handling the request is affected, and the results of a previous
+        profile are discarded.  The profiled requests are handled one at a time and the
+        results can be downloaded once some of them have been profiled.
+        This only works reliably when running a single worker process, since otherwise the
+        requests to profile and the requests getting the results may be handled by any of
+        them.  To profile a single request in any deployment, send it with an admin token
+        and an `X-Ursh-Profile` header containing the format of the results (pstats,
+        collapsed or memory), which are then sent instead of the response, with the status
+        code of the actual response in the `X-Ursh-Profile-Status` header.
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      - in: body
+        name: profile
+        description: the requests to profile
+        schema:
+          type: object
+          properties:
+            endpoint:
+              type: string
+              description: 'the endpoint whose requests are profiled (all of them if omitted)'
+            requests:
+              type: integer
+              description: 'the number of requests to profile (defaults to 10)'
+            cpu:
+              type: boolean
+              description: 'profile the CPU usage of the requests (defaults to true)'
+            memory:
+              type: boolean
+              description: 'trace the memory allocated by the requests (defaults to false)'
+      responses:
+        201:
+          description: the new request profile
+        400:
+          description: invalid parameters
+        403:
+          description: not an admin token
+    delete:
+      tags:
+      - admins
+      summary: stops profiling requests
+      description: The results profiled so far can still be downloaded.
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      responses:
+        200:
+          description: the stopped request profile
+        403:
+          description: not an admin token
+    """
+    if request.method == 'POST':
+        profile = RequestProfile(**RequestProfileSchema().load(request.get_json(silent=True) or {}))
+        start_request_profile(profile)
+        return jsonify(profile.to_dict()), 201
+    profile = get_request_profile()
+    if profile is not None and request.method == 'DELETE':
+        profile.stop()
+    return jsonify(profile.to_dict() if profile is not None else None)
+
+
+@admin_only
+def request_profile_results(result):
+    """Download the results of the current request profile.
+    ---
+    get:
+      tags:
+      - admins
+      summary: returns the aggregated results of the profiled requests
+      description: >
+        `pstats` returns the cProfile statistics, which can be loaded using the
+        `pstats` module or tools like snakeviz.  `collapsed` returns the sampled
+        stacks and `memory` the allocating stacks weighted by the allocated bytes,
+        both in the collapsed format used by flame graph tools.
+      parameters:
+      - in: header
+        name: Authorization
+        description: the API key bearer
+        type: string
+        format: uuid
+        required: true
+      - in: path
+        name: result
+        description: the format of the results (pstats, collapsed or memory)
+        type: string
+        required: true
+      responses:
+        200:
+          description: the results
+        403:
+          description: not an admin token
+        404:
+          description: no requests were profiled
+    """
+    if (profile := get_request_profile()) is None or not profile.profiled:
+        raise NotFound({'message': 'No requests were profiled', 'args': ['result']})
+    return get_profile_response(profile, result)
@@ -1,15 +1,26 @@
+from itertools import islice
 from uuid import UUID
 
-from flask import Response, current_app, g
+from flask import Response, current_app, g, request, stream_with_context
 from flask_apispec import MethodResource, marshal_with, use_kwargs
 from marshmallow import fields
-from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, Conflict, MethodNotAllowed, NotFound
 
-from ursh import db
-from ursh.models import URL, Token
-from ursh.schemas import ShortcutSchemaManual, ShortcutSchemaRestricted, TokenSchema, URLSchema
-from ursh.util.decorators import admin_only, authorize_request_for_url, marshal_many_or_one
+from ursh.core.cache import get_redirect_cache
+from ursh.core.jobs import enqueue_job
+from ursh.models import generate_shortcut_candidate
+from ursh.schemas import ShortcutSchemaManual, ShortcutSchemaRestricted, TokenSchema, URLRewriteSchema, URLSchema
+from ursh.storage import TokenInUseError, get_storage
+from ursh.util.conditional import (
+    get_conditional_headers,
+    is_conditional_request,
+    make_etag,
+    make_not_modified_response,
+)
+from ursh.util.decorators import admin_only, authorize_request_for_url, idempotent, marshal_many_or_one
+
+# number of objects serialized at once when streaming a collection
+STREAM_CHUNK_SIZE = 1000
 
 
 class TokenResource(MethodResource):
@@ -34,6 +45,7 @@ class TokenResource(MethodResource):
     """
 
     @admin_only
+    @idempotent
     @marshal_with(TokenSchema, code=201)
     @use_kwargs(TokenSchema)
     def post(self, **kwargs):
@@ -53,6 +65,12 @@ class TokenResource(MethodResource):
           type: string
           format: uuid
           required: true
+        - in: header
+          name: Idempotency-Key
+          description: >
+            a unique value identifying the request; retrying a request with the same key
+            returns the original response instead of processing the request again
+          type: string
         - in: body
           name: token
           description: the token to create
@@ -87,12 +105,13 @@ class TokenResource(MethodResource):
         """
         if not kwargs.get('name'):
             raise generate_bad_request('missing-args', 'New tokens need to mention the "name" attribute', args=['name'])
-        if Token.query.filter_by(name=kwargs['name']).count() != 0:
+        create_params = ['name', 'is_admin', 'is_blocked', 'callback_url']
+        values = {key: value for key, value in kwargs.items() if key in create_params}
+        storage = get_storage()
+        new_token = storage.create_token(values)
+        if new_token is None:
             raise Conflict({'message': 'Token with name exists', 'args': ['name']})
-        new_token = Token()
-        populate_from_dict(new_token, kwargs, ('name', 'is_admin', 'is_blocked', 'callback_url'))
-        db.session.add(new_token)
-        db.session.commit()
+        storage.commit()
         current_app.logger.info('Token created by %s: %s (admin: %s)', g.token.name, new_token.name, new_token.is_admin)
         return new_token, 201
 
@@ -158,17 +177,22 @@ class TokenResource(MethodResource):
             UUID(api_key)
         except ValueError:
             raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
-        token = Token.query.filter_by(api_key=api_key).one_or_none()
+        storage = get_storage()
+        values = {key: value for key, value in kwargs.items() if key in ('is_admin', 'is_blocked', 'callback_url')}
+        token = storage.update_token(api_key, values)
         if not token:
             raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
-        populate_from_dict(token, kwargs, ('is_admin', 'is_blocked', 'callback_url'))
-        db.session.commit()
+        storage.commit()
         current_app.logger.info('Token updated by %s: %s (%r)', g.token.name, token.name, kwargs)
         return token
 
     @admin_only
     @use_kwargs(TokenSchema)
-    def delete(self, api_key=None, **kwargs):
+    @use_kwargs({
+        'delete_urls': fields.Boolean(load_default=False),
+        'transfer_urls_to': fields.Str(load_default=None),
+    }, location='query')
+    def delete(self, api_key=None, delete_urls=False, transfer_urls_to=None, **kwargs):
         """Delete an existing token.
         ---
         tags:
@@ -176,7 +200,10 @@ class TokenResource(MethodResource):
         summary: deletes an existing token
         operationId: deleteToken
         description: >
-          Delete an existing API token.
+          Delete an existing API token. A token owning URLs can only be deleted
+          when specifying what should happen to them, in which case the token is
+          blocked and a job deleting it once all its URLs have been deleted or
+          transferred is queued for `ursh worker`.
         produces:
         - application/json
         parameters:
@@ -192,28 +219,63 @@ class TokenResource(MethodResource):
           required: true
           type: string
           format: uuid
+        - in: query
+          name: delete_urls
+          description: delete the URLs owned by the token
+          type: boolean
+        - in: query
+          name: transfer_urls_to
+          description: the API key of the token receiving the URLs owned by the token
+          type: string
+          format: uuid
         responses:
+          202:
+            description: token blocked and scheduled for deletion
           204:
             description: token deleted successfully
+          400:
+            description: invalid token specified in `transfer_urls_to`
           404:
             description: token to delete not found
           405:
             description: 'method not allowed: `api_key` not specified'
+          409:
+            description: the token owns URLs and neither `delete_urls` nor `transfer_urls_to` was specified
         """
         if not api_key:
             raise MethodNotAllowed
-        token = Token.query.filter_by(api_key=api_key).one_or_none()
-        if not token:
-            raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
+        storage = get_storage()
+        if delete_urls or transfer_urls_to:
+            return self._delete_with_urls(api_key, transfer_urls_to)
         try:
-            db.session.delete(token)
-            db.session.commit()
-        except IntegrityError:
+            token = storage.delete_token(api_key)
+        except TokenInUseError:
             raise Conflict({'message': 'There are URLs associated with the token specified for deletion',
                             'args': ['api_key']})
+        if not token:
+            raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
+        storage.commit()
         current_app.logger.info('Token deleted by %s: %s', g.token.name, token.name)
         return Response(status=204)
 
+    def _delete_with_urls(self, api_key, transfer_urls_to=None):
+        storage = get_storage()
+        token = storage.get_token(api_key)
+        if not token:
+            raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
+        if transfer_urls_to is not None:
+            new_token = storage.get_token(transfer_urls_to)
+            if new_token is None or new_token.id == token.id:
+                raise generate_bad_request('invalid-token', 'Invalid token to transfer the URLs to',
+                                           args=['transfer_urls_to'])
+        # the token must not create new urls while its urls are being deleted
+        storage.update_token(api_key, {'is_blocked': True})
+        enqueue_job('delete-token', {'api_key': api_key, 'transfer_to': transfer_urls_to})
+        storage.commit()
+        action = 'transferred' if transfer_urls_to else 'deleted'
+        current_app.logger.info('Token deletion queued by %s: %s (URLs %s)', g.token.name, token.name, action)
+        return Response(status=202)
+
     @admin_only
     @marshal_many_or_one(TokenSchema, 'api_key', code=200)
     @use_kwargs(TokenSchema, location='query')
@@ -227,7 +289,9 @@ class TokenResource(MethodResource):
         description: >
           Obtain the API tokens that match the given parameters. If `api_key` is provided,
           then exactly one token will be returned. Otherwise, a collection of tokens that
-          match the provided parameters will be returned (maybe empty).
+          match the provided parameters will be returned (maybe empty). The `ETag` of a
+          collection is only sent for conditional and `HEAD` requests, so use a `HEAD`
+          request to get it without loading the collection.
         produces:
         - application/json
         parameters:
@@ -266,21 +330,30 @@ class TokenResource(MethodResource):
               format: array
               items:
                 $ref: '#/components/schemas/Token'
+          304:
+            description: >
+              the token(s) did not change since the version identified by the `If-None-Match`
+              or `If-Modified-Since` header
           404:
             description: 'no token found for the specified `api_key`'
         """
         if not api_key:
             filter_params = ['name', 'is_admin', 'is_blocked', 'callback_url']
             filter_dict = {key: value for key, value in kwargs.items() if key in filter_params}
-            return Token.query.filter_by(**filter_dict).all()
+            return get_collection(get_storage().filter_tokens(with_version=needs_collection_version(),
+                                                              **filter_dict), TokenSchema)
         try:
             UUID(api_key)
         except ValueError:
             raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
-        token = Token.query.filter_by(api_key=api_key).one_or_none()
+        if is_conditional_request():
+            updated_at = get_storage().get_token_version(api_key)
+            if updated_at and (response := make_not_modified_response(make_etag(api_key, updated_at), updated_at)):
+                return response
+        token = get_storage().get_token(api_key)
         if not token:
             raise NotFound({'message': 'API key does not exist', 'args': ['api_key']})
-        return token
+        return token, 200, get_conditional_headers(make_etag(api_key, token.updated_at), token.updated_at)
 
 
 class URLResource(MethodResource):
@@ -304,6 +377,7 @@ class URLResource(MethodResource):
           description: not authorized
     """
 
+    @idempotent
     @marshal_with(URLSchema, code=201)
     @use_kwargs(URLSchema)
     @use_kwargs(ShortcutSchemaRestricted, location='view_args')
@@ -326,6 +400,12 @@ class URLResource(MethodResource):
           type: string
           format: uuid
           required: true
+        - in: header
+          name: Idempotency-Key
+          description: >
+            a unique value identifying the request; retrying a request with the same key
+            returns the original response instead of processing the request again
+          type: string
         - in: body
           name: URL properties
           description: the properties of the URL to create
@@ -346,6 +426,13 @@ class URLResource(MethodResource):
                   'a': 'foo',
                   'b': 'bar'
                 }
+              expires_at:
+                type: string
+                format: date-time
+                example: '2030-01-01T00:00:00+00:00'
+                description: >
+                  when the short URL expires; afterwards it responds with `410 Gone` and it is
+                  eventually deleted. URLs are only reused if they have the same expiry.
               allow_reuse:
                 type: boolean
                 description: >
@@ -362,16 +449,15 @@ class URLResource(MethodResource):
         if not kwargs.get('url'):
             raise generate_bad_request('missing-args', 'URL missing', args=['url'])
         if kwargs.get('allow_reuse'):
-            existing_url = URL.query.filter_by(url=kwargs.get('url'), is_custom=False).order_by(URL.shortcut).first()
-            if existing_url:
-                return existing_url, 201
-        new_url = create_new_url(data=kwargs)
-        db.session.add(new_url)
-        db.session.commit()
+            new_url = create_or_reuse_url(data=kwargs)
+        else:
+            new_url = create_new_url(data=kwargs)
+        get_storage().commit()
         current_app.logger.info('URL created by %s: %s -> <%s> (%r)', g.token.name, new_url.shortcut, new_url.url,
                                 kwargs.get('meta', {}))
         return new_url, 201
 
+    @idempotent
     @use_kwargs(URLSchema)
     @use_kwargs(ShortcutSchemaManual, location='view_args')
     @authorize_request_for_url
@@ -395,6 +481,12 @@ class URLResource(MethodResource):
           type: string
           format: uuid
           required: true
+        - in: header
+          name: Idempotency-Key
+          description: >
+            a unique value identifying the request; retrying a request with the same key
+            returns the original response instead of processing the request again
+          type: string
         - in: path
           name: shortcut
           description: the shortcut of the URL to put
@@ -420,6 +512,13 @@ class URLResource(MethodResource):
                   'a': 'foo',
                   'b': 'bar'
                 }
+              expires_at:
+                type: string
+                format: date-time
+                example: '2030-01-01T00:00:00+00:00'
+                description: >
+                  when the short URL expires; afterwards it responds with `410 Gone` and it is
+                  eventually deleted. URLs are only reused if they have the same expiry.
               allow_reuse:
                 type: boolean
                 description: >
@@ -435,16 +534,18 @@ class URLResource(MethodResource):
           409:
             description: 'shortcut already exists and `allow_reuse=true` was not specified'
         """
-        existing_url = URL.query.filter_by(shortcut=shortcut).one_or_none()
-        if existing_url:
-            if kwargs.get('allow_reuse') and existing_url.url == kwargs['url']:
+        new_url = create_new_url(data=kwargs, shortcut=shortcut)
+        if new_url is None:
+            existing_url = get_storage().get_url(shortcut)
+            if existing_url is None:
+                # the existing url has been deleted (or purged after expiring) in the meantime
+                new_url = create_new_url(data=kwargs, shortcut=shortcut)
+            elif kwargs.get('allow_reuse') and existing_url.url == kwargs['url']:
                 return existing_url, 201
-            else:
+            if new_url is None:
                 raise Conflict({'message': 'This shortcut already exists',
                                 'args': ['shortcut']})
-        new_url = create_new_url(data=kwargs, shortcut=shortcut)
-        db.session.add(new_url)
-        db.session.commit()
+        get_storage().commit()
         current_app.logger.info('URL created by %s: %s -> <%s> (%r)', g.token.name, new_url.shortcut, new_url.url,
                                 kwargs.get('meta', {}))
         return new_url, 201
@@ -464,6 +565,13 @@ class URLResource(MethodResource):
         description: >
           Modify the properties of an existing URL object.
           Non-admin users may only patch their own URLs (created with their API key).
+          When sent with the `application/merge-patch+json` content type, `meta` is
+          merged into the existing metadata according to RFC 7396 (keys set to `null`
+          are removed) instead of being replaced, and only `url`, `meta` and `expires_at`
+          may be specified.
+        consumes:
+        - application/json
+        - application/merge-patch+json
         produces:
         - application/json
         parameters:
@@ -497,6 +605,13 @@ class URLResource(MethodResource):
                   'a': 'foo',
                   'b': 'bar'
                 }
+              expires_at:
+                type: string
+                format: date-time
+                example: '2030-01-01T00:00:00+00:00'
+                description: >
+                  when the short URL expires; afterwards it responds with `410 Gone` and it is
+                  eventually deleted; `null` removes the expiry
               allow_reuse:
                 type: boolean
                 description: >
@@ -507,6 +622,8 @@ class URLResource(MethodResource):
             description: URL object patched successfully
             schema:
               $ref: '#/components/schemas/URL'
+          400:
+            description: 'a merge patch contains other fields than `url`, `meta` and `expires_at`'
           404:
             description: 'shortcut to modify not found'
           405:
@@ -514,11 +631,17 @@ class URLResource(MethodResource):
         """
         if not shortcut:
             raise MethodNotAllowed
-        url = URL.query.filter_by(shortcut=shortcut).one_or_none()
+        storage = get_storage()
+        values = {key: value for key, value in kwargs.items() if key in ('url', 'meta', 'expires_at')}
+        merge_meta = request.mimetype == 'application/merge-patch+json'
+        if merge_meta and (unsupported := sorted(kwargs.keys() - values.keys())):
+            raise generate_bad_request('invalid-args', 'Merge patches can only change url, meta and expires_at',
+                                       args=unsupported)
+        url = storage.update_url(shortcut, values, merge_meta=merge_meta)
         if not url:
             raise NotFound({'message': 'Shortcut does not exist', 'args': ['shortcut']})
-        populate_from_dict(url, kwargs, ('url', 'allow_reuse', 'meta'))
-        db.session.commit()
+        storage.commit()
+        get_redirect_cache().delete(url.shortcut)
         current_app.logger.info('URL updated by %s: %s (%r)', g.token.name, url.shortcut, kwargs)
         return url
 
@@ -558,11 +681,12 @@ class URLResource(MethodResource):
         """
         if not shortcut:
             raise MethodNotAllowed
-        url = URL.query.filter_by(shortcut=shortcut).one_or_none()
+        storage = get_storage()
+        url = storage.delete_url(shortcut)
         if not url:
             raise NotFound({'message': 'Shortcut does not exist', 'args': ['shortcut']})
-        db.session.delete(url)
-        db.session.commit()
+        storage.commit()
+        get_redirect_cache().delete(url.shortcut)
         current_app.logger.info('URL deleted by %s: %s -> <%s>', g.token.name, url.shortcut, url.url)
         return Response(status=204)
 
@@ -583,7 +707,9 @@ class URLResource(MethodResource):
         description: >
           Obtain the URLs that match the given parameters. If `shortcut` is provided,
           then exactly one URL will be returned. Otherwise, a collection of tokens that
-          match the provided parameters will be returned (maybe empty).
+          match the provided parameters will be returned (maybe empty). The `ETag` of a
+          collection is only sent for conditional and `HEAD` requests, so use a `HEAD`
+          request to get it without loading the collection.
           Non-admin users may only obtain their own URLs (created with their API key).
         produces:
         - application/json
@@ -627,40 +753,185 @@ class URLResource(MethodResource):
               format: array
               items:
                 $ref: '#/components/schemas/URL'
+          304:
+            description: >
+              the URL(s) did not change since the version identified by the `If-None-Match`
+              or `If-Modified-Since` header
           404:
             description: 'no URL found for the specified `shortcut`'
         """
         if not shortcut:
-            meta = kwargs.get('meta')
-            filters = []
-            if kwargs.get('url'):
-                filters.append(URL.url == kwargs.get('url'))
-            if not g.token.is_admin or not kwargs.get('all'):
-                filters.append(URL.token == g.token)
-            if meta:
-                filters.append(URL.meta.contains(meta))
-            return URL.query.filter(*filters).all()
-        url = URL.query.filter_by(shortcut=shortcut).one_or_none()
+            token_id = g.token.id if not g.token.is_admin or not kwargs.get('all') else None
+            urls = get_storage().filter_urls(url=kwargs.get('url') or None, token_id=token_id, meta=kwargs.get('meta'),
+                                             with_version=needs_collection_version())
+            return get_collection(urls, URLSchema)
+        if is_conditional_request():
+            updated_at = get_storage().get_url_version(shortcut)
+            if updated_at and (response := make_not_modified_response(make_etag(shortcut, updated_at), updated_at)):
+                return response
+        url = get_storage().get_url(shortcut)
         if not url:
             raise NotFound({'message': 'Shortcut does not exist', 'args': ['shortcut']})
-        return url
+        return url, 200, get_conditional_headers(make_etag(shortcut, url.updated_at), url.updated_at)
 
 
-def populate_from_dict(obj, values, fields):
-    for field in fields:
-        if field in values:
-            setattr(obj, field, values[field])
+class URLRewriteResource(MethodResource):
+    @admin_only
+    @use_kwargs(URLRewriteSchema)
+    def post(self, from_prefix, to_prefix, dry_run=False, batch_size=1000, delay=0):
+        """Rewrite the targets of all URLs starting with a prefix.
+        ---
+        tags:
+        - admins
+        summary: rewrites the targets of many URLs
+        operationId: rewriteURLs
+        description: >
+          Replace the beginning of the target of every URL starting with `from_prefix`,
+          e.g. when a site moved to another domain. This is done by a job queued for
+          `ursh worker`, which rewrites the URLs in batches. Include the trailing slash
+          of the old location in the prefix to avoid rewriting URLs of other sites
+          which happen to start with the same name.
+        produces:
+        - application/json
+        parameters:
+        - in: header
+          name: Authorization
+          description: the API key bearer
+          type: string
+          format: uuid
+          required: true
+        - in: body
+          name: rewrite
+          description: the prefixes and how to rewrite the URLs
+          schema:
+            type: object
+            required:
+              - from_prefix
+              - to_prefix
+            properties:
+              from_prefix:
+                type: string
+                example: 'https://old.example.org/'
+                description: the beginning of the URLs to rewrite
+              to_prefix:
+                type: string
+                example: 'https://new.example.org/'
+                description: the new beginning of the URLs
+              dry_run:
+                type: boolean
+                description: only count the URLs which would be rewritten
+              batch_size:
+                type: integer
+                description: the number of URLs rewritten per transaction
+              delay:
+                type: number
+                description: the number of seconds to wait between two batches
+        responses:
+          200:
+            description: the number of URLs which would be rewritten (dry run)
+          202:
+            description: rewrite of the URLs scheduled; includes the number of matching URLs
+          400:
+            description: invalid prefixes specified
+          403:
+            description: not an admin token
+        """
+        count = get_storage().filter_urls(url_prefix=from_prefix)[0]
+        if dry_run:
+            return {'count': count}
+        enqueue_job('rewrite-urls', {'old_prefix': from_prefix, 'new_prefix': to_prefix, 'batch_size': batch_size,
+                                     'delay': delay})
+        get_storage().commit()
+        current_app.logger.info('URL rewrite queued by %s: %s -> %s (%d URLs)', g.token.name, from_prefix, to_prefix,
+                                count)
+        return {'count': count}, 202
+
+
+def needs_collection_version():
+    """Check whether the version of a collection is needed for the current request.
+
+    Getting it needs an additional query over the whole collection, which
+    is only worth it if the client is validating its cached copy, or only
+    wants the headers anyway.
+    """
+    return is_conditional_request() or request.method == 'HEAD'
+
+
+def get_collection(collection, schema):
+    """Get a streamed response containing the objects of a collection.
+
+    The ETag of a collection depends on the number of objects and the
+    most recent modification of any of them, so a client's cached copy
+    can be validated using a cheap aggregate query instead of loading
+    and serializing all the objects.  It is only sent if the collection
+    was loaded with its version (see `needs_collection_version`).
+
+    There is no ``Last-Modified`` header, since deleting an object does
+    not make the most recent modification any newer.
+
+    :param collection: A tuple as returned by the `filter_*` methods of
+                       the storage backend.
+    """
+    count, last_modified, objs = collection
+    if count is None:
+        return Response(stream_with_context(_stream_json_list(objs, schema(many=True))), mimetype='application/json')
+    etag = make_etag(g.token.id, count, last_modified)
+    if response := make_not_modified_response(etag):
+        return response
+    return Response(stream_with_context(_stream_json_list(objs, schema(many=True))), mimetype='application/json',
+                    headers=get_conditional_headers(etag))
+
+
+def _stream_json_list(objs, schema):
+    # serialize the collection in chunks to avoid having everything in memory at once
+    yield '['
+    rows = iter(objs)
+    separator = ''
+    while chunk := list(islice(rows, STREAM_CHUNK_SIZE)):
+        yield separator + current_app.json.dumps(schema.dump(chunk), separators=(',', ':'))[1:-1]
+        separator = ','
+    yield ']'
 
 
 def create_new_url(data, shortcut=None):
-    meta = data.get('meta') or {}
+    """Create a new URL with the given or a random shortcut.
+
+    :return: The new `URL` or ``None`` if the specified shortcut
+             already exists
+    """
     if shortcut in current_app.config['BLACKLISTED_URLS']:
         raise generate_bad_request('invalid-shortcut', 'Invalid shortcut', args=['shortcut'])
-    new_url = URL(token=g.token, meta=meta, shortcut=shortcut, is_custom=shortcut is not None)
-    populate_from_dict(new_url, data, ('url', 'allow_reuse'))
+    storage = get_storage()
+    values = _get_new_url_values(data, shortcut)
+    if shortcut is not None:
+        return storage.create_url(values)
+    # random shortcuts rarely collide, so we just retry with a new one in that case
+    # instead of checking whether it is available before inserting
+    while (new_url := storage.create_url(values)) is None:
+        values['shortcut'] = generate_shortcut_candidate()
     return new_url
 
 
+def create_or_reuse_url(data):
+    """Get an existing (non-custom) URL with the same target or create a new one."""
+    storage = get_storage()
+    # the random shortcut of the new url may already exist, in which case we try again
+    while (url := storage.get_or_create_url(_get_new_url_values(data))) is None:
+        pass
+    return url
+
+
+def _get_new_url_values(data, shortcut=None):
+    return {
+        'shortcut': shortcut if shortcut is not None else generate_shortcut_candidate(),
+        'url': data['url'],
+        'meta': data.get('meta') or {},
+        'expires_at': data.get('expires_at'),
+        'token_id': g.token.id,
+        'is_custom': shortcut is not None,
+    }
+
+
 def generate_bad_request(error_code, message, **kwargs):
     message_dict = {'code': error_code,
                     'description': message}
@@ -1,4 +1,6 @@
-from flask import Blueprint, Response, current_app, redirect
+from flask import Blueprint, Response, current_app, jsonify, redirect
+
+from ursh.core.health import check_readiness
 
 bp = Blueprint('misc', __name__)
 
@@ -27,3 +29,43 @@ def index():
     if current_app.config['INDEX_REDIRECT']:
         return redirect(current_app.config['INDEX_REDIRECT'])
     return Response('Nothing to see here', content_type='text/plain')
+
+
+@bp.route('/healthz')
+def health():
+    """Liveness probe, which does not check any dependencies.
+    ---
+    get:
+      tags:
+      - public
+      summary: responds as long as the process can handle requests
+      responses:
+        200:
+          description: OK
+    """
+    return Response('OK', content_type='text/plain')
+
+
+@bp.route('/readyz')
+def readiness():
+    """Readiness probe checking the database and other dependencies.
+    ---
+    get:
+      tags:
+      - public
+      summary: returns whether the application is ready to handle requests
+      description: >
+        The results of the checks are reused for a short time, so the endpoint
+        is cheap enough to be polled frequently by load balancers.  A saturated
+        connection pool is only reported as a warning, unless `READINESS_MAX_POOL_USAGE`
+        is set, in which case reaching that usage makes the instance unavailable.
+      responses:
+        200:
+          description: ready (possibly with warnings); the diagnostics of each check are included
+        503:
+          description: >
+            not ready, e.g. the database cannot be reached (or its connection pool usage
+            reached `READINESS_MAX_POOL_USAGE`, if set)
+    """
+    ready, checks = check_readiness()
+    return jsonify(status='ready' if ready else 'unavailable', checks=checks), 200 if ready else 503
@@ -1,6 +1,13 @@
-from flask import Blueprint, Response, redirect
+from datetime import UTC, datetime
 
-from ursh.models import URL
+from flask import Blueprint, Response, current_app, redirect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from ursh.core.cache import get_redirect_cache
+from ursh.core.db import use_lane, use_replica
+from ursh.core.metrics import REDIRECT_CACHE_FALLBACKS
+from ursh.storage import get_storage
 
 bp = Blueprint('redirection', __name__)
 
@@ -23,6 +30,10 @@ def redirect_to_url(shortcut):
           description: redirect to the registered URL
         404:
           description: specified shortcut not found
+        410:
+          description: the URL registered for the shortcut has expired
+        503:
+          description: the database is unavailable and the shortcut is not cached
     options:
       tags:
       - public
@@ -36,7 +47,34 @@ def redirect_to_url(shortcut):
         200:
           description: OK
     """
-    url = URL.query.filter_by(shortcut=shortcut).one_or_none()
-    if not url:
-        return Response('No URL found for this shortcut', status=404, content_type='text/plain')
-    return redirect(url.url)
+    cache = get_redirect_cache()
+    try:
+        target = _get_target_url(shortcut)
+    except (OperationalError, PoolTimeoutError):
+        # the database is slow or unavailable; serving a possibly outdated
+        # target is better than failing
+        get_storage().rollback()
+        target = cache.get(shortcut)
+        REDIRECT_CACHE_FALLBACKS.labels('miss' if target is None else 'hit').inc()
+        if target is None:
+            current_app.logger.exception('Could not look up shortcut %s', shortcut,
+                                         extra={'event': 'redirect-cache-fallback', 'shortcut': shortcut})
+            return Response('Service temporarily unavailable', status=503, content_type='text/plain')
+        current_app.logger.warning('Could not look up shortcut %s, using cached URL', shortcut, exc_info=True,
+                                   extra={'event': 'redirect-cache-fallback', 'shortcut': shortcut})
+    else:
+        if target is None:
+            cache.delete(shortcut)
+            return Response('No URL found for this shortcut', status=404, content_type='text/plain')
+        cache.set(shortcut, target)
+    url, expires_at = target
+    # expired urls are only deleted periodically, and the cache may also still contain them
+    if expires_at is not None and expires_at <= datetime.now(UTC):
+        return Response('This short URL has expired', status=410, content_type='text/plain')
+    return redirect(url)
+
+
+def _get_target_url(shortcut):
+    use_lane('redirection')
+    use_replica()
+    return get_storage().get_url_target(shortcut)
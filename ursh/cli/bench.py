@@ -0,0 +1,65 @@
+import json
+import sys
+
+import click
+from flask import current_app
+
+from ursh.cli.core import cli_group
+from ursh.core.bench import WORKLOADS, compare_results, run_benchmark
+
+
+@cli_group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--urls', type=click.IntRange(min=1), default=10000, show_default=True,
+              help='The number of URLs to create before running the workloads')
+@click.option('--requests', type=click.IntRange(min=2), default=1000, show_default=True,
+              help='The number of requests of each workload')
+@click.option('--concurrency', type=click.IntRange(min=1), default=8, show_default=True,
+              help='The number of requests sent at the same time')
+@click.option('--warmup', type=click.IntRange(min=0), default=50, show_default=True,
+              help='The number of requests sent before each workload which are not measured')
+@click.option('--workload', 'workloads', type=click.Choice(list(WORKLOADS)), multiple=True,
+              help='Only run this workload')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Write the JSON results to this file')
+def run(urls, requests, concurrency, warmup, workloads, output):
+    """Measure the throughput and latency of redirects and API requests
+
+    A temporary token and its URLs are created in the configured database
+    and deleted afterwards.
+    """
+    def _print_result(name, result):
+        latency = result['latency']
+        click.echo(f'{name:10} {result["throughput"]:8.1f} req/s   p50 {latency["p50"]:7.2f}ms   '
+                   f'p95 {latency["p95"]:7.2f}ms   p99 {latency["p99"]:7.2f}ms   {result["errors"]} errors',
+                   err=True)
+
+    results = run_benchmark(current_app._get_current_object(), urls, requests, concurrency, warmup, workloads,
+                            callback=_print_result)
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+@cli.command()
+@click.argument('old', type=click.File())
+@click.argument('new', type=click.File())
+@click.option('--threshold', type=click.FloatRange(min=0), default=10, show_default=True,
+              help='The change in percent above which a metric counts as a regression')
+def compare(old, new, threshold):
+    """Compare the results of two benchmark runs
+
+    The exit code is 1 if any metric of NEW is worse than in OLD by more
+    than the threshold.
+    """
+    regressions = 0
+    for name, metric, old_value, new_value, change in compare_results(json.load(old), json.load(new)):
+        regression = change * 100 > threshold
+        regressions += regression
+        marker = click.style('  regression', fg='red') if regression else ''
+        click.echo(f'{name:10} {metric:10} {old_value:10.2f} {new_value:10.2f} {change:+8.1%}{marker}')
+    if regressions:
+        click.echo(f'{regressions} metrics regressed by more than {threshold}%', err=True)
+        sys.exit(1)
@@ -1,4 +1,8 @@
+import json
+import signal
+
 import click
+from flask import current_app
 from flask.cli import AppGroup, FlaskGroup
 
 from ursh.cli.util import LazyGroup
@@ -38,6 +42,98 @@ def apikey():
     """Perform API key related operations."""
 
 
+@cli.group(cls=LazyGroup, import_name='ursh.cli.urls:cli')
+def urls():
+    """Perform URL related operations."""
+
+
 @cli.group(cls=LazyGroup, import_name='ursh.cli.openapi:cli')
 def openapi():
     """Perform OpenAPI related operations."""
+
+
+@cli.group(cls=LazyGroup, import_name='ursh.cli.dev:cli')
+def dev():
+    """Perform development and testing related operations."""
+
+
+@cli.group(cls=LazyGroup, import_name='ursh.cli.bench:cli')
+def bench():
+    """Run performance benchmarks."""
+
+
+@cli.command()
+@click.option('--threads', type=int, help='The number of jobs to run at the same time [default: WORKER_THREADS]')
+@click.option('--type', 'types', multiple=True, metavar='TYPE', help='Only run jobs of this type')
+@click.option('--burst', is_flag=True, help='Exit once there are no more jobs which are due')
+def worker(threads, types, burst):
+    """Run queued jobs."""
+    from ursh.core.jobs import JOB_TYPES, Worker
+    if invalid := set(types) - set(JOB_TYPES):
+        raise click.BadParameter(f'Unknown job types: {", ".join(sorted(invalid))}', param_hint='--type')
+    worker = Worker(current_app._get_current_object(), threads, types)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    worker.run(burst=burst)
+
+
+@cli.command(with_appcontext=False)
+@click.argument('captures', nargs=-1, required=True, type=click.File())
+@click.option('--target', default='http://127.0.0.1:5000', show_default=True,
+              help='The base URL of the instance receiving the requests')
+@click.option('--speed', type=click.FloatRange(min=0), default=1, show_default=True,
+              help='How many times faster than recorded to send the requests (0 sends them as fast as possible)')
+@click.option('--concurrency', type=click.IntRange(min=1), default=8, show_default=True,
+              help='The number of requests sent at the same time')
+@click.option('--api-key', help='The API key to use for requests which had one (they are skipped otherwise)')
+@click.option('--output', '-o', type=click.File('w'), help='Write the JSON results to this file')
+def replay(captures, target, speed, concurrency, api_key, output):
+    """Replay captured requests against a running instance
+
+    Captures of several processes and rotated captures can be passed at
+    the same time; their requests are replayed in chronological order.
+    """
+    from ursh.core.bench import COMPARED_LATENCIES
+    from ursh.core.replay import read_captures, replay_requests
+    results = replay_requests(read_captures(captures), target, concurrency, speed, api_key)
+    if results['skipped']:
+        click.echo(f'Skipped {results["skipped"]} requests which need an API key')
+    for kind, result in results['workloads'].items():
+        click.echo(f'{kind}: {result["requests"]} requests, {result["errors"]} errors, '
+                   f'{result["status_changes"]} with a different status')
+        if not result['latency'] or not result['recorded_latency']:
+            continue
+        for metric in COMPARED_LATENCIES:
+            recorded = result['recorded_latency'][metric]
+            replayed = result['latency'][metric]
+            change = (replayed - recorded) / recorded if recorded else 0
+            click.echo(f'  {metric}  {recorded:8.2f}ms -> {replayed:8.2f}ms  {change:+8.1%}')
+    if output:
+        json.dump(results, output, indent=2)
+        output.write('\n')
+
+
+@cli.command('startup-profile', with_appcontext=False)
+@click.option('--runs', type=click.IntRange(min=1), default=3, show_default=True,
+              help='The number of processes to start (the median durations are shown)')
+@click.option('--top', type=click.IntRange(min=0), default=10, show_default=True,
+              help='The number of imported packages to show')
+@click.option('--output', '-o', type=click.File('w'), help='Write the JSON results to this file')
+def startup_profile(runs, top, output):
+    """Measure how long starting the application takes
+
+    New processes import and create the application using the current
+    config, measuring the time spent importing each package and in each
+    phase of creating the application.
+    """
+    from ursh.core.startup import run_startup_profile
+    results = run_startup_profile(runs)
+    click.echo(f'{"import":20} {results["import"] * 1000:8.1f}ms')
+    for package, duration in sorted(results['packages'].items(), key=lambda item: -item[1])[:top]:
+        click.echo(f'  {package:18} {duration * 1000:8.1f}ms')
+    click.echo(f'{"create_app":20} {results["create_app"] * 1000:8.1f}ms')
+    for phase, duration in results['phases'].items():
+        click.echo(f'  {phase:18} {duration * 1000:8.1f}ms')
+    click.echo(f'{"total":20} {(results["import"] + results["create_app"]) * 1000:8.1f}ms')
+    if output:
+        json.dump(results, output, indent=2)
+        output.write('\n')
@@ -1,5 +1,14 @@
+import sys
+
+import click
+from alembic import command
+from alembic.config import Config
+
 from ursh import db
 from ursh.cli.core import cli_group
+from ursh.core import purge
+from ursh.core.jobs import enqueue_job
+from ursh.storage import ShardedSQLStorage, SQLStorage, get_storage
 
 
 @cli_group()
@@ -7,7 +16,110 @@ def cli():
     pass
 
 
+def _get_alembic_config(**attributes):
+    if not isinstance(get_storage(), SQLStorage):
+        raise click.UsageError('The storage backend does not use a database')
+    config = Config(stdout=sys.stdout)
+    config.set_main_option('script_location', 'ursh:migrations')
+    config.set_main_option('file_template',
+                           '%%(year)d%%(month).2d%%(day).2d_%%(hour).2d%%(minute).2d_%%(rev)s_%%(slug)s')
+    config.attributes.update(attributes)
+    return config
+
+
 @cli.command()
 def create():
     """Creates the initial database structure"""
-    db.create_all()
+    storage = get_storage()
+    storage.create_all()
+    if isinstance(storage, SQLStorage):
+        # the new database is already up to date, there is nothing to migrate
+        command.stamp(_get_alembic_config(), 'head')
+
+
+@cli.command()
+@click.argument('revision', default='head')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='The number of rows to update per transaction when backfilling columns')
+@click.option('--batch-delay', type=float, default=0, show_default=True,
+              help='The number of seconds to wait between batches to reduce the load on the database')
+@click.option('--lock-timeout', default='5s', show_default=True,
+              help='How long to wait for a lock before failing instead of blocking other queries on the table')
+def upgrade(revision, batch_size, batch_delay, lock_timeout):
+    """Updates the database structure to the latest version
+
+    Indexes are built concurrently and new columns are filled in small
+    batches, so this can be done while ursh is running.  If it fails
+    because a table could not be locked in time, simply run it again.
+    """
+    config = _get_alembic_config(batch_size=batch_size, batch_delay=batch_delay, lock_timeout=lock_timeout)
+    command.upgrade(config, revision)
+
+
+@cli.command()
+@click.argument('revision')
+def downgrade(revision):
+    """Reverts the database structure to an older version"""
+    command.downgrade(_get_alembic_config(), revision)
+
+
+@cli.command()
+def current():
+    """Shows the current version of the database structure"""
+    command.current(_get_alembic_config())
+
+
+@cli.command()
+@click.argument('message')
+@click.option('--autogenerate', is_flag=True, help='Detect changes made to the models')
+def revision(message, autogenerate):
+    """Creates a new migration"""
+    # comparing the models with a shard would find that most tables are missing
+    command.revision(_get_alembic_config(shards=False), message, autogenerate=autogenerate)
+
+
+@cli.command()
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='The number of keys to delete per transaction')
+@click.option('--queue', is_flag=True, help='Queue a job deleting the keys instead of deleting them right away')
+def purge_idempotency_keys(batch_size, queue):
+    """Deletes expired idempotency keys"""
+    if queue:
+        enqueue_job('purge-idempotency-keys', {'batch_size': batch_size})
+        db.session.commit()
+        click.echo('Queued a job deleting expired idempotency keys')
+        return
+    total = purge.purge_idempotency_keys(batch_size)
+    click.echo(f'Deleted {total} expired idempotency keys')
+
+
+@cli.command()
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='The number of URLs to check per transaction')
+@click.option('--dry-run', is_flag=True, help='Only show how many URLs would be moved')
+def rebalance_shards(batch_size, dry_run):
+    """Moves URLs to the shard they belong to after adding shards"""
+    storage = get_storage()
+    if not isinstance(storage, ShardedSQLStorage):
+        raise click.UsageError('This command requires the sharded storage backend')
+
+    sources = set()
+
+    conflicts = {}
+
+    def _progress(shard, checked, moved, conflicting):
+        if sources and shard not in sources:
+            click.echo()
+        sources.add(shard)
+        conflicts[shard] = conflicting
+        source = 'main database' if shard is None else f'shard {shard}'
+        conflicting = f', {conflicting} already on their shard' if conflicting else ''
+        click.echo(f'\r{source}: {checked} checked, {moved} {"to move" if dry_run else "moved"}{conflicting}',
+                   nl=False)
+
+    total = storage.rebalance(batch_size, dry_run=dry_run, callback=_progress)
+    click.echo()
+    click.echo(f'{total} URLs {"would be" if dry_run else "were"} moved')
+    if total_conflicts := sum(conflicts.values()):
+        click.echo(f'{total_conflicts} URLs were not moved since their shortcuts already exist on the shard they '
+                   'belong to; their shortcuts are listed in the log', err=True)
@@ -0,0 +1,43 @@
+import click
+
+from ursh import db
+from ursh.cli.core import cli_group
+from ursh.core.seed import SyntheticDataset, seed_database, write_trace
+from ursh.storage import SQLStorage, get_storage
+
+
+@cli_group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--urls', type=click.IntRange(min=1), required=True, help='The number of URLs to create')
+@click.option('--tokens', type=click.IntRange(min=1), default=100, show_default=True,
+              help='The number of tokens owning the URLs')
+@click.option('--seed', type=int, help='Create the same dataset as a previous run with this seed')
+@click.option('--batch-size', type=click.IntRange(min=1), default=100000, show_default=True,
+              help='The number of URLs to create per transaction')
+@click.option('--trace', type=click.File('w'), help='Write an access trace for `ursh replay` to this file')
+@click.option('--trace-requests', type=click.IntRange(min=1), default=100000, show_default=True,
+              help='The number of requests in the access trace')
+@click.option('--zipf-exponent', type=click.FloatRange(min=0, min_open=True), default=1.1, show_default=True,
+              help='How much the accesses in the trace are concentrated on the most popular URLs')
+def seed(urls, tokens, seed, batch_size, trace, trace_requests, zipf_exponent):
+    """Fill the database with synthetic tokens and URLs
+
+    Use this to test the performance with a production-sized dataset.  The
+    seeded tokens are named `seed-<SEED>-<N>`.
+    """
+    if type(get_storage()) is not SQLStorage or db.engine.dialect.name != 'postgresql':
+        raise click.UsageError('Seeding is only supported with a single PostgreSQL database')
+    try:
+        dataset = SyntheticDataset(urls, tokens, seed)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--urls')
+    click.echo(f'Seeding {urls} URLs owned by {tokens} tokens (seed {dataset.seed})')
+    count = seed_database(dataset, batch_size, callback=lambda count: click.echo(f'\r{count}/{urls} URLs', nl=False))
+    click.echo(f'\nCreated {count} URLs')
+    if trace:
+        write_trace(dataset, trace, trace_requests, zipf_exponent)
+        click.echo(f'Wrote {trace_requests} requests to {trace.name}')
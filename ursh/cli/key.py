@@ -1,11 +1,11 @@
 import sys
+from operator import attrgetter
 
 import click
-from sqlalchemy.exc import IntegrityError
 
-from ursh import db
 from ursh.cli.core import cli_group
-from ursh.models import Token
+from ursh.core.tokens import delete_token_with_urls
+from ursh.storage import TokenInUseError, get_storage
 
 
 def _print_usage(command):
@@ -32,13 +32,18 @@ def _print_api_key(token):
     click.echo(f'Blocked: {token.is_blocked}')
 
 
+def _get_token(**kwargs):
+    filters = {k: v for k, v in kwargs.items() if v}
+    count, _, tokens = get_storage().filter_tokens(**filters)
+    return next(iter(tokens)) if count == 1 else None
+
+
 def _create_api_key(role, name, blocked):
-    token = Token(name=name, is_admin=(role == 'admin'), is_blocked=blocked)
-    try:
-        db.session.add(token)
-        db.session.commit()
-    except IntegrityError:
+    storage = get_storage()
+    token = storage.create_token({'name': name, 'is_admin': (role == 'admin'), 'is_blocked': blocked})
+    if token is None:
         _failure(f'An API key with the same name ("{name}") already exists.')
+    storage.commit()
     _print_api_key(token)
     if blocked:
         _success('The above listed API key is blocked - you will not be able to use it until it is unblocked.')
@@ -47,14 +52,14 @@ def _create_api_key(role, name, blocked):
 
 
 def _toggle_api_key_block(blocked, **kwargs):
-    filters = {k: v for k, v in kwargs.items() if v}
-    token = Token.query.filter_by(**filters).one_or_none()
+    token = _get_token(**kwargs)
     if not token:
         _failure('No API key was found for the specified filters.')
         return
     if token.is_blocked != blocked:
-        token.is_blocked = blocked
-        db.session.commit()
+        storage = get_storage()
+        storage.update_token(token.api_key, {'is_blocked': blocked})
+        storage.commit()
     _success('API key {} successfully.'.format('unblocked' if not blocked else 'blocked'))
 
 
@@ -81,19 +86,39 @@ def create(role, token_name, blocked):
 @cli.command()
 @click.option('--name', '-n', metavar='NAME')
 @click.option('--api-key', '-k', metavar='API_KEY')
-def delete(**kwargs):
+@click.option('--delete-urls', is_flag=True, help='Delete the URLs associated with the API key')
+@click.option('--transfer-urls-to', metavar='NAME', help='Transfer the URLs associated with the API key to another one')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='The number of URLs to delete or transfer per transaction')
+def delete(delete_urls, transfer_urls_to, batch_size, **kwargs):
     """Delete an API key."""
     _validate_filters_or_die(kwargs, delete)
-    filters = {k: v for k, v in kwargs.items() if v}
-    token = Token.query.filter_by(**filters).one_or_none()
-    if token:
+    token = _get_token(**kwargs)
+    if not token:
+        _failure('No API key was found for the specified filters.')
+    storage = get_storage()
+    if not delete_urls and not transfer_urls_to:
         try:
-            db.session.delete(token)
-            db.session.commit()
-        except IntegrityError:
+            storage.delete_token(token.api_key)
+        except TokenInUseError:
             _failure('Could not delete the specified API key as there are URLs associated with it.')
-    else:
-        _failure('No API key was found for the specified filters.')
+        storage.commit()
+        return
+    new_token = None
+    if transfer_urls_to:
+        new_token = storage.get_token_by_name(transfer_urls_to)
+        if not new_token or new_token.id == token.id:
+            _failure('No other API key was found to transfer the URLs to.')
+    # the token must not create new urls while its urls are being deleted
+    storage.update_token(token.api_key, {'is_blocked': True})
+    storage.commit()
+    total = storage.filter_urls(token_id=token.id)[0]
+    action = 'transferred' if new_token else 'deleted'
+    delete_token_with_urls(token.api_key, new_token.api_key if new_token else None, batch_size=batch_size,
+                           callback=lambda count: click.echo(f'\r{count}/{total} URLs {action}', nl=False))
+    if total:
+        click.echo()
+    _success(f'API key deleted after {"transferring" if new_token else "deleting"} its URLs.')
 
 
 @cli.command()
@@ -102,8 +127,7 @@ def delete(**kwargs):
 def get(**kwargs):
     """Display information about an API key."""
     _validate_filters_or_die(kwargs, get)
-    filters = {k: v for k, v in kwargs.items() if v}
-    token = Token.query.filter_by(**filters).one_or_none()
+    token = _get_token(**kwargs)
     if token:
         _print_api_key(token)
     else:
@@ -113,8 +137,8 @@ def get(**kwargs):
 @cli.command('list')
 def list_():
     """List all API keys."""
-    tokens = Token.query.order_by(Token.name).all()
-    for token in tokens:
+    _, _, tokens = get_storage().filter_tokens()
+    for token in sorted(tokens, key=attrgetter('name')):
         admin = ' (admin)' if token.is_admin else ''
         blocked = ' (blocked)' if token.is_blocked else ''
         print(f'{token.name}: {token.api_key}{admin}{blocked}')
@@ -1,8 +1,14 @@
+import os
+import sys
+from pathlib import Path
+
+import click
 from flask import current_app
 from flask import json as _json
 
 from ursh.cli.core import cli_group
-from ursh.core.app import _register_openapi
+from ursh.core.openapi import get_openapi_spec
+from ursh.core.openapi_artifact import is_spec_artifact_stale, write_spec_artifact
 
 
 @cli_group()
@@ -13,7 +19,42 @@ def cli():
 @cli.command()
 def export_json():
     """Export API spec to JSON"""
-    if not current_app.config['ENABLE_SWAGGER']:
-        _register_openapi(current_app)
-    spec = current_app.config['APISPEC_SPEC']
+    path = current_app.config['OPENAPI_SPEC_FILE']
+    if path and not is_spec_artifact_stale(path):
+        print(Path(path).read_text())
+        return
+    spec = get_openapi_spec(current_app)
     print(_json.dumps(spec.to_dict()))
+
+
+@cli.command()
+@click.argument('path', type=click.Path(dir_okay=False, writable=True), required=False)
+def build(path):
+    """Build the API spec served when OPENAPI_SPEC_FILE is set
+
+    PATH defaults to OPENAPI_SPEC_FILE.  A gzip-compressed copy is saved
+    next to it as well.
+    """
+    if not (path := path or current_app.config['OPENAPI_SPEC_FILE']):
+        raise click.UsageError('Specify a path or set OPENAPI_SPEC_FILE')
+    write_spec_artifact(get_openapi_spec(current_app).to_dict(), path)
+    click.echo(f'Saved API spec to {path}')
+
+
+@cli.command()
+@click.argument('path', type=click.Path(dir_okay=False), required=False)
+def check(path):
+    """Check whether the prebuilt API spec is up to date
+
+    PATH defaults to OPENAPI_SPEC_FILE.  The exit code is 1 if the spec
+    was built from different code and needs to be rebuilt.
+    """
+    if not (path := path or current_app.config['OPENAPI_SPEC_FILE']):
+        raise click.UsageError('Specify a path or set OPENAPI_SPEC_FILE')
+    if not os.path.exists(path):
+        click.echo(f'{path} does not exist; build it using `ursh openapi build`', err=True)
+        sys.exit(1)
+    if is_spec_artifact_stale(path):
+        click.echo(f'{path} is out of date; rebuild it using `ursh openapi build`', err=True)
+        sys.exit(1)
+    click.echo(f'{path} is up to date')
@@ -0,0 +1,57 @@
+import time
+
+import click
+
+from ursh.cli.core import cli_group
+from ursh.core.jobs import enqueue_job
+from ursh.core.purge import purge_expired_urls
+from ursh.core.urls import rewrite_url_prefix
+from ursh.storage import get_storage
+
+
+@cli_group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='The number of URLs to delete per transaction')
+@click.option('--every', type=int, metavar='SECONDS',
+              help='Keep running and delete expired URLs periodically')
+@click.option('--queue', is_flag=True, help='Queue a job deleting the URLs instead of deleting them right away')
+def purge_expired(batch_size, every, queue):
+    """Deletes expired URLs"""
+    if queue:
+        enqueue_job('purge-expired-urls', {'batch_size': batch_size})
+        get_storage().commit()
+        click.echo('Queued a job deleting expired URLs')
+        return
+    while True:
+        total = purge_expired_urls(batch_size)
+        click.echo(f'Deleted {total} expired URLs')
+        if not every:
+            break
+        time.sleep(every)
+
+
+@cli.command()
+@click.option('--from-prefix', required=True, help='The beginning of the URLs to rewrite, e.g. https://old.example.org/')
+@click.option('--to-prefix', required=True, help='The new beginning of the URLs, e.g. https://new.example.org/')
+@click.option('--batch-size', type=int, default=1000, show_default=True,
+              help='The number of URLs to rewrite per transaction')
+@click.option('--delay', type=float, default=0, metavar='SECONDS', help='Wait between two batches')
+@click.option('--dry-run', is_flag=True, help='Only show how many URLs would be rewritten')
+def rewrite(from_prefix, to_prefix, batch_size, delay, dry_run):
+    """Rewrites the target of all URLs starting with a prefix"""
+    if from_prefix == to_prefix:
+        raise click.BadParameter('The prefixes must be different', param_hint='--to-prefix')
+    total = get_storage().filter_urls(url_prefix=from_prefix)[0]
+    if dry_run:
+        click.echo(f'{total} URLs would be rewritten')
+        return
+    count = rewrite_url_prefix(from_prefix, to_prefix, batch_size, delay,
+                               callback=lambda count: click.echo(f'\r{count}/{total} URLs rewritten', nl=False))
+    if count:
+        click.echo()
+    click.echo(f'Rewrote {count} URLs')
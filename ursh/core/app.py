@@ -1,22 +1,33 @@
 import datetime
+import functools
 import logging
 import logging.config
+import math
 import os
+import time
 
 import yaml
-from apispec import APISpec
-from apispec.ext.marshmallow import MarshmallowPlugin
-from apispec_webframeworks.flask import FlaskPlugin
 from flask import Flask
-from flask_apispec import FlaskApiSpec
+from sqlalchemy.engine import make_url
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import import_string
 
 from ursh import db
+from ursh.core import health
+from ursh.core.cache import RedirectCache
+from ursh.core.db import InstrumentedQueuePool, get_statement_timeout, reset_db_routing
+from ursh.storage import BACKENDS as STORAGE_BACKENDS
 from ursh.util.db import import_all_models
-from ursh.util.nested_query_parser import NestedQueryParser
+
+try:
+    # the C implementation is much faster
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
 
 CONFIG_OPTIONS = {
     'SQLALCHEMY_DATABASE_URI': 'str',
+    'STORAGE_BACKEND': 'str',
     'USE_PROXY': 'bool',
     'SECRET_KEY': 'str',
     'URL_LENGTH': 'int',
@@ -25,9 +36,79 @@ CONFIG_OPTIONS = {
     'BLACKLISTED_URLS': 'set',
     'INDEX_REDIRECT': 'str',
     'ENABLE_SWAGGER': 'bool',
+    'OPENAPI_SPEC_FILE': 'str',
+    'IDEMPOTENCY_KEY_TTL': 'int',
+    'COMPRESSION_MIN_SIZE': 'int',
+    'COMPRESSION_LEVEL': 'int',
+    'DB_POOL_SIZE': 'int',
+    'DB_MAX_OVERFLOW': 'int',
+    'DB_POOL_TIMEOUT': 'int',
+    'DB_POOL_RECYCLE': 'int',
+    'DB_POOL_PRE_PING': 'bool',
+    'DB_STATEMENT_TIMEOUT': 'int',
+    'STATEMENT_TIMEOUTS': 'dict',
+    'DB_PGBOUNCER_MODE': 'bool',
+    'SQLALCHEMY_REPLICA_URIS': 'list',
+    'REPLICA_MAX_LAG': 'int',
+    'REPLICA_LAG_CHECK_INTERVAL': 'int',
+    'REPLICA_STICKY_TIME': 'int',
+    'SQLALCHEMY_SHARD_URIS': 'list',
+    'SHARD_REBALANCING': 'bool',
+    'REDIRECT_POOL_SIZE': 'int',
+    'REDIRECT_MAX_OVERFLOW': 'int',
+    'REDIRECT_POOL_TIMEOUT': 'int',
+    'REDIRECT_CACHE_SIZE': 'int',
+    'WORKER_THREADS': 'int',
+    'JOB_POLL_INTERVAL': 'int',
+    'JOB_CONCURRENCY': 'dict',
+    'JOB_RETRY_DELAY': 'int',
+    'JOB_MAX_RETRY_DELAY': 'int',
+    'METRICS_URL': 'str',
+    'SQL_PROFILING': 'bool',
+    'SLOW_QUERY_THRESHOLD': 'int',
+    'SLOW_QUERY_EXPLAIN_RATE': 'float',
+    'CAPTURE_FILE': 'str',
+    'CAPTURE_SAMPLE_RATE': 'float',
+    'CAPTURE_MAX_BYTES': 'int',
+    'CAPTURE_BACKUP_COUNT': 'int',
+    'CAPTURE_BODIES': 'bool',
+    'LOG_FORMAT': 'str',
+    'LOG_QUEUE_SIZE': 'int',
+    'LOG_SAMPLE_RATES': 'dict',
+    'READINESS_DB_TIMEOUT': 'int',
+    'READINESS_CHECK_INTERVAL': 'float',
+    'READINESS_MAX_POOL_USAGE': 'float',
+    'READINESS_MAX_JOB_LAG': 'int',
+    'READINESS_WARM_CACHE_RATIO': 'float',
+}
+
+# the blueprints which can be enabled using ``ENABLED_BLUEPRINTS``; they are only imported when enabled
+BLUEPRINTS = {
+    'api': 'ursh.blueprints.api.blueprint:bp',
+    'misc': 'ursh.blueprints.misc:bp',
+    'redirection': 'ursh.blueprints.redirection:bp',
 }
 
-INTERNAL_URLS = frozenset({'api', 'static', 'swagger', 'swagger-ui', 'flask-apispec'})
+INTERNAL_URLS = frozenset({'api', 'static', 'swagger', 'swagger-ui', 'flask-apispec', 'metrics', 'healthz', 'readyz'})
+
+
+def _startup_phase(name):
+    """Record how long a step of creating the application takes.
+
+    The durations (in seconds) are stored in the ``startup_timings``
+    extension of the application, see ``ursh startup-profile``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(app, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(app, *args, **kwargs)
+            finally:
+                timings = app.extensions.setdefault('startup_timings', {})
+                timings[name] = timings.get(name, 0) + time.perf_counter() - start
+        return wrapper
+    return decorator
 
 
 def create_app(config_file=None, testing=False):
@@ -43,14 +124,24 @@ def create_app(config_file=None, testing=False):
     app.testing = testing
     _setup_logger(app)
     _load_config(app, config_file)
+    _setup_log_handlers(app)
     _setup_db(app)
+    _setup_cache(app)
+    _setup_storage(app)
+    _setup_health(app)
+    _setup_profiling(app)
     _register_handlers(app)
     _register_blueprints(app)
+    if app.config['METRICS_URL']:
+        _setup_metrics(app)
     if app.config['ENABLE_SWAGGER']:
         _register_openapi(app)
+    if app.config['CAPTURE_FILE']:
+        _setup_capture(app)
     return app
 
 
+@_startup_phase('logging')
 def _setup_logger(app):
     # Create our own logger since Flask's DebugLogger is a pain
     app._logger = logging.getLogger(app.logger.name)
@@ -59,9 +150,20 @@ def _setup_logger(app):
     except KeyError:
         path = os.path.join(app.root_path, 'logging.yml')
     with open(path) as f:
-        logging.config.dictConfig(yaml.safe_load(f))
+        logging.config.dictConfig(yaml.load(f, Loader=YAMLLoader))
 
 
+@_startup_phase('logging')
+def _setup_log_handlers(app):
+    from ursh.core.logging import set_log_format, setup_log_queue, setup_log_sampling
+    set_log_format(app.config['LOG_FORMAT'])
+    if app.config['LOG_QUEUE_SIZE']:
+        setup_log_queue(app.config['LOG_QUEUE_SIZE'])
+    if app.config['LOG_SAMPLE_RATES']:
+        setup_log_sampling({event: float(rate) for event, rate in app.config['LOG_SAMPLE_RATES'].items()})
+
+
+@_startup_phase('config')
 def _load_config(app, config_file):
     app.config.from_pyfile('defaults.cfg')
     if config_file:
@@ -75,28 +177,120 @@ def _load_config(app, config_file):
                 value = os.environ.get(prefixed_key)
                 if type_ == 'int':
                     value = int(value)
+                elif type_ == 'float':
+                    value = float(value)
                 elif type_ == 'list':
                     value = [x.strip() for x in value.split(',') if x.strip()]
                 elif type_ == 'bool':
                     value = value.lower() in ('1', 'true')
+                elif type_ == 'dict':
+                    value = dict(x.strip().split('=', 1) for x in value.split(',') if x.strip())
                 app.config[key] = value
     if app.config['USE_PROXY']:
         app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
-    app.config['APISPEC_WEBARGS_PARSER'] = NestedQueryParser()
     app.config['BLACKLISTED_URLS'] = set(app.config['BLACKLISTED_URLS']) | INTERNAL_URLS
+    if app.config['METRICS_URL']:
+        app.config['BLACKLISTED_URLS'].add(app.config['METRICS_URL'].strip('/').split('/')[0])
 
 
+@_startup_phase('database')
 def _setup_db(app):
     # these settings should not be configurable in the config file so we
     # set them after loading the config file
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = False
+    config = app.config
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = _get_engine_options(config, config['DB_POOL_SIZE'],
+                                                              config['DB_MAX_OVERFLOW'], config['DB_POOL_TIMEOUT'],
+                                                              config['DB_STATEMENT_TIMEOUT'])
+    # redirects get their own connection pools so slow API requests cannot starve them
+    config['DB_LANE_ENGINE_OPTIONS'] = {}
+    if config['REDIRECT_POOL_SIZE']:
+        config['DB_LANE_ENGINE_OPTIONS']['redirection'] = _get_engine_options(
+            config, config['REDIRECT_POOL_SIZE'], config['REDIRECT_MAX_OVERFLOW'], config['REDIRECT_POOL_TIMEOUT'],
+            get_statement_timeout(config, 'redirection')
+        )
+    # readiness checks get a tiny pool of their own so they neither wait for nor take connections needed elsewhere
+    readiness_timeout = config['READINESS_DB_TIMEOUT']
+    config['DB_LANE_ENGINE_OPTIONS'][health.HEALTH_LANE] = health_options = _get_engine_options(
+        config, 1, 0, readiness_timeout / 1000, readiness_timeout
+    )
+    if make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'postgresql':
+        health_options['connect_args']['connect_timeout'] = max(1, math.ceil(readiness_timeout / 1000))
+    replica_binds = {f'replica-{i}': uri for i, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS'])}
+    shard_binds = {f'shard-{i}': uri for i, uri in enumerate(app.config['SQLALCHEMY_SHARD_URIS'])}
+    app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), **replica_binds, **shard_binds}
+    app.config['REPLICA_BIND_KEYS'] = list(replica_binds)
+    app.config['SHARD_BIND_KEYS'] = list(shard_binds)
     # ensure all models are imported even if not referenced from already-imported modules
-    import_all_models(app.import_name)
+    import_all_models()
     db.init_app(app)
 
 
+def _get_engine_options(config, pool_size, max_overflow, pool_timeout, statement_timeout):
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'connect_args': {},
+    }
+    # in pgbouncer mode the timeout is set for each transaction instead (see `_configure_transaction`)
+    backend = make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    if statement_timeout and backend == 'postgresql' and not config['DB_PGBOUNCER_MODE']:
+        options['connect_args']['options'] = f'-c statement_timeout={statement_timeout}'
+    elif backend == 'sqlite':
+        # pooled connections are used by different threads (e.g. of `ursh worker`), but never at the same time
+        options['connect_args']['check_same_thread'] = False
+    return options
+
+
+@_startup_phase('cache')
+def _setup_cache(app):
+    app.extensions['redirect_cache'] = RedirectCache(app.config['REDIRECT_CACHE_SIZE'])
+
+
+@_startup_phase('storage')
+def _setup_storage(app):
+    storage = app.extensions['storage'] = STORAGE_BACKENDS[app.config['STORAGE_BACKEND']]()
+    storage.init_app(app)
+
+
+@_startup_phase('health')
+def _setup_health(app):
+    health.init_app(app)
+
+
+@_startup_phase('profiling')
+def _setup_profiling(app):
+    from ursh.core import profiling
+    profiling.init_app(app)
+
+
+@_startup_phase('metrics')
+def _setup_metrics(app):
+    from ursh.core import metrics
+    metrics.init_app(app)
+
+
+@_startup_phase('capture')
+def _setup_capture(app):
+    from ursh.core.capture import CaptureMiddleware
+    config = app.config
+    app.wsgi_app = CaptureMiddleware(app.wsgi_app, config['CAPTURE_FILE'], config['CAPTURE_SAMPLE_RATE'],
+                                     config['CAPTURE_MAX_BYTES'], config['CAPTURE_BACKUP_COUNT'],
+                                     config['CAPTURE_BODIES'])
+
+
+@_startup_phase('handlers')
 def _register_handlers(app):
+    @app.before_request
+    def _reset_db_routing():
+        # read-only views opt in to using replicas or other connection pools explicitly
+        reset_db_routing()
+
     @app.shell_context_processor
     def _extend_shell_context():
         ctx = {'db': db}
@@ -105,28 +299,22 @@ def _register_handlers(app):
         return ctx
 
 
+@_startup_phase('blueprints')
 def _register_blueprints(app):
-    import ursh.blueprints
-    blueprint_names = app.config['ENABLED_BLUEPRINTS']
-    for name in blueprint_names:
-        blueprint = getattr(ursh.blueprints, name)
-        app.register_blueprint(blueprint)
+    # only import the enabled blueprints, so e.g. redirect-only deployments do not need to load the API
+    for name in app.config['ENABLED_BLUEPRINTS']:
+        app.register_blueprint(import_string(BLUEPRINTS[name]))
 
 
+@_startup_phase('openapi')
 def _register_openapi(app):
-    from ursh.schemas import TokenSchema, URLSchema
-    with app.app_context():
-        spec = APISpec(
-            openapi_version='3.0.2',
-            title='ursh - URL Shortener',
-            version='2.0',
-            plugins=(
-                FlaskPlugin(),
-                MarshmallowPlugin(),
-            ),
-        )
-        spec.components.schema('Token', schema=TokenSchema)
-        spec.components.schema('URL', schema=URLSchema)
-        app.config['APISPEC_SPEC'] = spec
-        apispec = FlaskApiSpec(app)
-        apispec.register_existing_resources()
+    path = app.config['OPENAPI_SPEC_FILE']
+    if path and os.path.exists(path):
+        from ursh.core import openapi_artifact
+        openapi_artifact.init_app(app, path)
+        return
+    if path:
+        # e.g. when running `ursh openapi build` for the first time
+        app.logger.warning('The OpenAPI spec %s does not exist, so it will be generated from the code', path)
+    from ursh.core import openapi
+    openapi.init_app(app)
@@ -0,0 +1,174 @@
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+from uuid import uuid4
+
+import ursh
+from ursh.core.tokens import delete_token_with_urls
+from ursh.storage import get_storage
+
+# the number of URLs in each group of the `list` workload
+LIST_GROUP_SIZE = 100
+# the latency figures compared between two runs (throughput is compared as well)
+COMPARED_LATENCIES = ('p50', 'p95', 'p99')
+
+
+def _redirect(client, auth, shortcuts, i):
+    return client.get(f'/{random.choice(shortcuts)}'), 302
+
+
+def _create(client, auth, shortcuts, i):
+    return client.post('/api/urls/', json={'url': f'https://bench.example.com/new/{uuid4().hex}'}, headers=auth), 201
+
+
+def _list(client, auth, shortcuts, i):
+    group = random.randrange(max(1, len(shortcuts) // LIST_GROUP_SIZE))
+    return client.get('/api/urls/', query_string={'meta.group': str(group)}, headers=auth), 200
+
+
+def _patch(client, auth, shortcuts, i):
+    return client.patch(f'/api/urls/{random.choice(shortcuts)}', json={'meta': {'bench': str(i)}}, headers=auth), 200
+
+
+WORKLOADS = {
+    'redirect': _redirect,
+    'create': _create,
+    'list': _list,
+    'patch': _patch,
+}
+
+
+def run_benchmark(app, urls=10000, requests=1000, concurrency=8, warmup=50, workloads=None, callback=None):
+    """Measure the throughput and latency of the application.
+
+    A temporary token owning ``urls`` URLs is created in the configured
+    database and deleted afterwards, including the URLs created by the
+    benchmark.  Each workload then sends ``requests`` requests from
+    ``concurrency`` threads, going through the whole application (but
+    without an HTTP server in front of it).
+
+    :param app: The `Flask` application to benchmark.
+    :param urls: The number of URLs to create before running the workloads.
+    :param requests: The number of requests of each workload.
+    :param concurrency: The number of requests sent at the same time.
+    :param warmup: The number of requests sent before each workload
+                   which are not included in the results.
+    :param workloads: The names of the workloads to run (see `WORKLOADS`),
+                      or ``None`` to run all of them.
+    :param callback: A function called with the name and results of
+                     each workload once it finished.
+    :return: A dict containing the results of each workload and the
+             parameters of the benchmark, which can be saved as JSON.
+    """
+    storage = get_storage()
+    token = storage.create_token({'name': f'bench-{uuid4().hex[:8]}'})
+    storage.commit()
+    api_key = token.api_key
+    try:
+        shortcuts = _seed_urls(token, urls)
+        auth = {'Authorization': f'Bearer {api_key}'}
+        results = {}
+        for name in (workloads or WORKLOADS):
+            if warmup:
+                _run_workload(app, WORKLOADS[name], auth, shortcuts, warmup, concurrency)
+            results[name] = _run_workload(app, WORKLOADS[name], auth, shortcuts, requests, concurrency)
+            if callback:
+                callback(name, results[name])
+    finally:
+        delete_token_with_urls(api_key)
+    return {
+        'version': ursh.__version__,
+        'date': datetime.now(UTC).isoformat(),
+        'urls': urls,
+        'requests': requests,
+        'concurrency': concurrency,
+        'workloads': results,
+    }
+
+
+def compare_results(old, new):
+    """Compare the results of two benchmark runs.
+
+    :param old: The results of the baseline run, as returned by `run_benchmark`.
+    :param new: The results of the run to compare with the baseline.
+    :return: A list of ``(workload, metric, old, new, change)`` tuples
+             for the workloads present in both runs, where ``change``
+             is the relative change of the metric and positive values
+             mean the new run performed worse.
+    """
+    rows = []
+    for name, new_result in new['workloads'].items():
+        if (old_result := old['workloads'].get(name)) is None:
+            continue
+        rows.append((name, 'throughput', old_result['throughput'], new_result['throughput'],
+                     -_get_change(old_result['throughput'], new_result['throughput'])))
+        rows.extend((name, metric, old_result['latency'][metric], new_result['latency'][metric],
+                     _get_change(old_result['latency'][metric], new_result['latency'][metric]))
+                    for metric in COMPARED_LATENCIES)
+    return rows
+
+
+def get_latency_stats(latencies):
+    """Summarize a list of latencies.
+
+    :param latencies: The latencies of at least one request.
+    :return: A dict containing the mean, the 50th, 95th and 99th
+             percentiles and the maximum of the latencies.
+    """
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    else:
+        percentiles = latencies * 99
+    return {
+        'mean': statistics.fmean(latencies),
+        'p50': percentiles[49],
+        'p95': percentiles[94],
+        'p99': percentiles[98],
+        'max': latencies[-1],
+    }
+
+
+def _get_change(old, new):
+    return (new - old) / old if old else 0
+
+
+def _seed_urls(token, count, batch_size=1000):
+    storage = get_storage()
+    prefix = uuid4().hex[:8]
+    shortcuts = [f'bench{prefix}{i}' for i in range(count)]
+    for start in range(0, count, batch_size):
+        storage.create_urls([{'shortcut': shortcut, 'url': f'https://bench.example.com/{shortcut}',
+                              'token_id': token.id, 'meta': {'group': str(i // LIST_GROUP_SIZE)}}
+                             for i, shortcut in enumerate(shortcuts[start:start + batch_size], start)])
+        storage.commit()
+    return shortcuts
+
+
+def _run_workload(app, workload, auth, shortcuts, requests, concurrency):
+    local = threading.local()
+
+    def _send(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        start = time.perf_counter()
+        response, expected_status = workload(local.client, auth, shortcuts, i)
+        # streamed responses are only generated while reading them
+        response.get_data()
+        response.close()
+        return time.perf_counter() - start, response.status_code == expected_status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(_send, range(requests)))
+    duration = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'errors': sum(1 for __, success in results if not success),
+        'duration': duration,
+        'throughput': requests / duration,
+        'latency': get_latency_stats([latency * 1000 for latency, __ in results]),
+    }
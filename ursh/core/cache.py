@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+
+
+class RedirectCache:
+    """A small in-process LRU cache of the URLs redirects point to.
+
+    It is only used as a fallback when the database cannot be queried,
+    so entries invalidated by another process may be served in that case.
+    The entries contain the expiry of each URL as well, so expired URLs
+    are never served from the cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, shortcut):
+        with self._lock:
+            try:
+                self._data.move_to_end(shortcut)
+            except KeyError:
+                return None
+            return self._data[shortcut]
+
+    def set(self, shortcut, target):
+        """Cache the target of a shortcut.
+
+        :param shortcut: The shortcut of the URL.
+        :param target: A ``(url, expires_at)`` tuple.
+        """
+        if not self.size:
+            return
+        with self._lock:
+            self._data[shortcut] = target
+            self._data.move_to_end(shortcut)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, shortcut):
+        with self._lock:
+            self._data.pop(shortcut, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_redirect_cache():
+    """Get the redirect cache of the current application."""
+    return current_app.extensions['redirect_cache']
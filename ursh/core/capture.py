@@ -0,0 +1,93 @@
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from werkzeug.wsgi import ClosingIterator
+
+# larger bodies are not captured, so requests uploading them cannot be replayed
+MAX_CAPTURED_BODY_SIZE = 65536
+
+
+class CaptureMiddleware:
+    """WSGI middleware recording the requests handled by an application.
+
+    Each request is written as one line of JSON containing its time,
+    method, path, query string, the kind of authorization it used (but
+    not the credentials), its status code and how long it took.  Such
+    captures can be replayed using ``ursh replay``.
+
+    :param app: The WSGI application to wrap.
+    :param path: The file to write to.  It may contain ``{pid}``, which
+                 is needed when several processes handle requests.
+    :param sample_rate: The fraction of requests to record.
+    :param max_bytes: The size after which the file is rotated.
+    :param backup_count: The number of rotated files to keep.
+    :param capture_bodies: Whether to record the body of requests
+                           modifying data, which is needed to replay
+                           them but may contain private data.
+    """
+
+    def __init__(self, app, path, sample_rate=1, max_bytes=0, backup_count=0, capture_bodies=False):
+        self.app = app
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.capture_bodies = capture_bodies
+        self._handler = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.sample_rate:
+            return self.app(environ, start_response)
+        record = {'t': time.time(), 'method': environ['REQUEST_METHOD'], 'path': environ.get('PATH_INFO') or '/'}
+        if query := environ.get('QUERY_STRING'):
+            record['query'] = query
+        record['auth'] = _get_auth_type(environ.get('HTTP_AUTHORIZATION'))
+        if self.capture_bodies and record['method'] in ('POST', 'PUT', 'PATCH'):
+            self._capture_body(environ, record)
+        start = time.perf_counter()
+
+        def _start_response(status, headers, exc_info=None):
+            record['status'] = int(status.split(None, 1)[0])
+            return start_response(status, headers, exc_info)
+
+        def _finish():
+            record['duration'] = round((time.perf_counter() - start) * 1000, 3)
+            self._write(record)
+
+        return ClosingIterator(self.app(environ, _start_response), _finish)
+
+    def _capture_body(self, environ, record):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return
+        if not length or length > MAX_CAPTURED_BODY_SIZE:
+            return
+        body = environ['wsgi.input'].read(length)
+        environ['wsgi.input'] = io.BytesIO(body)
+        record['content_type'] = environ.get('CONTENT_TYPE')
+        record['body'] = body.decode('utf-8', 'replace')
+
+    def _write(self, record):
+        if self._handler is None:
+            with self._lock:
+                # the file is only opened when the first request is recorded, which happens after
+                # e.g. gunicorn forked its workers, so each of them uses its own file
+                if self._handler is None:
+                    self._handler = RotatingFileHandler(self.path.format(pid=os.getpid()), maxBytes=self.max_bytes,
+                                                        backupCount=self.backup_count)
+        self._handler.handle(logging.makeLogRecord({'msg': json.dumps(record, separators=(',', ':'))}))
+
+
+def _get_auth_type(header):
+    if not header:
+        return 'none'
+    auth_type = header.split(None, 1)[0].lower()
+    return 'bearer' if auth_type == 'bearer' else 'other'
@@ -1,4 +1,16 @@
+import random
+import time
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+from flask import current_app, has_app_context, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 
 _naming_convention = {
     'fk': 'fk_%(table_name)s_%(column_names)s_%(referred_table_name)s',
@@ -11,5 +23,247 @@ _naming_convention = {
 }
 
 
-db = SQLAlchemy(session_options={'autoflush': False})
+class InstrumentedQueuePool(QueuePool):
+    """A `QueuePool` which keeps track of how long checkouts take."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self.checkouts += 1
+            self.total_wait_time += duration
+            self.max_wait_time = max(self.max_wait_time, duration)
+
+    def get_stats(self):
+        return {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': max(0, self.overflow()),
+            'max_overflow': self._max_overflow,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+
+def get_statement_timeout(config, blueprint, endpoint=None):
+    """Get the statement timeout for queries made while handling a route.
+
+    :param config: The application config
+    :param blueprint: The name of the blueprint handling the request
+    :param endpoint: The endpoint handling the request
+    :return: The timeout in milliseconds (or as a string with a unit)
+             as it is used in ``STATEMENT_TIMEOUTS``; 0 disables it.
+    """
+    timeouts = config['STATEMENT_TIMEOUTS']
+    for key in (endpoint, blueprint):
+        if key is not None and key in timeouts:
+            return timeouts[key]
+    return config['DB_STATEMENT_TIMEOUT']
+
+
+# the statement timeout set when connecting, for engines where it differs from `DB_STATEMENT_TIMEOUT`
+_engine_statement_timeouts = WeakKeyDictionary()
+
+
+@event.listens_for(Engine, 'begin')
+def _configure_transaction(conn):
+    if not has_app_context() or conn.dialect.name != 'postgresql':
+        return
+    config = current_app.config
+    if has_request_context():
+        timeout = get_statement_timeout(config, request.blueprint, request.endpoint)
+    else:
+        timeout = config['DB_STATEMENT_TIMEOUT']
+    # engines used for maintenance tasks such as migrations may need a different one
+    timeout = conn.get_execution_options().get('statement_timeout', timeout)
+    # pgbouncer in transaction pooling mode may give us a different server connection for
+    # every transaction, so we cannot use any session-level settings and need to set them
+    # for each transaction instead
+    if config['DB_PGBOUNCER_MODE']:
+        connection_timeout = 0
+    else:
+        connection_timeout = _engine_statement_timeouts.get(conn.engine, config['DB_STATEMENT_TIMEOUT'])
+    if str(timeout) != str(connection_timeout):
+        conn.exec_driver_sql("SELECT set_config('statement_timeout', %s, true)", (str(timeout),))
+
+
+class RoutingSession(Session):
+    """A session which can send read-only queries to a replica database.
+
+    Replicas are only used after calling `use_replica`, and even then
+    flushes and DML statements always go to the primary database.
+    After calling `use_lane`, connections come from a separate pool
+    for the given lane instead of the default one.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if self.info.get('use_replica') and not self._flushing and not getattr(clause, 'is_dml', False):
+            if 'replica' not in self.info:
+                self.info['replica'] = _select_replica()
+            if self.info['replica'] is not None:
+                return get_lane_engine(self.info['replica'], self.info.get('lane'))
+        engine = super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        return get_lane_engine(engine, self.info.get('lane'))
+
+
+# the engines of each lane, created on demand for every engine they are based on
+_lane_engines = WeakKeyDictionary()
+_lane_engines_lock = Lock()
+
+
+def get_lane_engine(engine, lane):
+    """Get the engine to use instead of `engine` for a lane.
+
+    :param engine: The engine used by default.
+    :param lane: The name of the lane or ``None``.
+    :return: An engine connecting to the same database as `engine` but
+             with its own connection pool, or `engine` itself if the
+             lane is not configured.
+    """
+    try:
+        options = current_app.config['DB_LANE_ENGINE_OPTIONS'][lane]
+    except KeyError:
+        return engine
+    try:
+        return _lane_engines[engine][lane]
+    except KeyError:
+        pass
+    with _lane_engines_lock:
+        engines = _lane_engines.setdefault(engine, {})
+        if lane not in engines:
+            if (timeout_option := options['connect_args'].get('options')) and 'options' in engine.url.query:
+                # keep any options from the database uri, e.g. a search path
+                connect_args = {**options['connect_args'], 'options': f'{engine.url.query["options"]} {timeout_option}'}
+                options = {**options, 'connect_args': connect_args}
+            engines[lane] = lane_engine = create_engine(engine.url, **options)
+            if timeout_option:
+                _engine_statement_timeouts[lane_engine] = timeout_option.partition('=')[2]
+            else:
+                _engine_statement_timeouts[lane_engine] = 0
+        return engines[lane]
+
+
+def get_lane_engines():
+    """Get the engines of all lanes which have been used so far.
+
+    :return: A list of ``(base_engine, lane, engine)`` tuples.
+    """
+    return [(base_engine, lane, engine)
+            for base_engine, engines in list(_lane_engines.items())
+            for lane, engine in engines.items()]
+
+
+class _ReplicaStatus:
+    _lag_query = text("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """)
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = None
+        self.checked = 0
+        self.lock = Lock()
+
+    def get_lag(self, check_interval):
+        """Get the replication lag in seconds or ``None`` if the replica is unavailable."""
+        # only one thread updates the lag while the others keep using the previous value
+        if time.monotonic() - self.checked > check_interval and self.lock.acquire(blocking=False):
+            try:
+                with self.engine.connect() as conn:
+                    lag = conn.execute(self._lag_query).scalar()
+                # the lag is unknown e.g. on a standby which has not replayed anything yet
+                self.lag = float(lag) if lag is not None else None
+            except SQLAlchemyError:
+                current_app.logger.warning('Could not check replication lag of %s', self.engine.url, exc_info=True)
+                self.lag = None
+            finally:
+                self.checked = time.monotonic()
+                self.lock.release()
+        return self.lag
+
+    def mark_failed(self):
+        self.lag = None
+        self.checked = time.monotonic()
+
+
+_replica_status = {}
+
+
+def _get_replica_status(engine):
+    try:
+        return _replica_status[engine]
+    except KeyError:
+        return _replica_status.setdefault(engine, _ReplicaStatus(engine))
+
+
+def _select_replica():
+    config = current_app.config
+    engines = [db.engines[key] for key in config['REPLICA_BIND_KEYS']]
+    candidates = [engine for engine in engines
+                  if (lag := _get_replica_status(engine).get_lag(config['REPLICA_LAG_CHECK_INTERVAL'])) is not None
+                  and lag <= config['REPLICA_MAX_LAG']]
+    return random.choice(candidates) if candidates else None
+
+
+def use_replica():
+    """Send subsequent read-only queries in this session to a replica.
+
+    If there are no replicas, or none of them is available and up to date,
+    queries keep going to the primary database.
+    """
+    db.session.info['use_replica'] = True
+
+
+def use_primary(replica_failed=False):
+    """Send subsequent queries in this session to the primary database.
+
+    :param replica_failed: Whether the replica used so far failed, in
+                           which case it is not used again until its
+                           status has been checked again.
+    """
+    replica = db.session.info.pop('replica', None)
+    if replica_failed and replica is not None:
+        _get_replica_status(replica).mark_failed()
+    db.session.info.pop('use_replica', None)
+
+
+def use_lane(lane):
+    """Take the connections for this session from the pools of a lane.
+
+    Each lane has its own connection pools, so e.g. redirects cannot be
+    starved of connections by slow API requests.  If the lane is not
+    configured, the default pools are used.
+
+    :param lane: The name of the lane, e.g. ``'redirection'``
+    """
+    db.session.info['lane'] = lane
+
+
+def reset_db_routing():
+    """Send subsequent queries to the primary database using the default pool."""
+    use_primary()
+    db.session.info.pop('lane', None)
+
+
+db = SQLAlchemy(session_options={'autoflush': False, 'class_': RoutingSession})
 db.Model.metadata.naming_convention = _naming_convention
@@ -0,0 +1,151 @@
+import time
+from datetime import UTC, datetime
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from ursh import db
+from ursh.core.cache import get_redirect_cache
+from ursh.core.db import get_lane_engine, get_lane_engines
+from ursh.core.logging import QueueHandler
+from ursh.models import Job
+from ursh.storage import get_storage
+
+# the lane whose connection pools are used for the readiness checks, so they do not need to wait for a
+# connection when the default pools are saturated (which is reported separately)
+HEALTH_LANE = 'health'
+
+
+class _Readiness:
+    def __init__(self):
+        self.checks = None
+        self.checked = 0
+        self.lock = Lock()
+
+    def get(self, check_interval):
+        # only one thread runs the checks while the others keep using the previous results
+        if time.monotonic() - self.checked >= check_interval and self.lock.acquire(blocking=self.checks is None):
+            try:
+                if self.checks is None or time.monotonic() - self.checked >= check_interval:
+                    self.checks = _run_checks()
+                    self.checked = time.monotonic()
+            finally:
+                self.lock.release()
+        return self.checks
+
+
+def check_readiness():
+    """Check whether the application is ready to handle requests.
+
+    Checks involving the database are limited to ``READINESS_DB_TIMEOUT``
+    and their results are reused for ``READINESS_CHECK_INTERVAL`` seconds,
+    so frequent calls (e.g. from a load balancer) stay cheap.
+
+    :return: A ``(ready, checks)`` tuple, where ``checks`` maps the name
+             of each check to a dict containing its ``status`` (``ok``,
+             ``warning`` or ``error``; only errors make the application
+             unready) and further diagnostics.
+    """
+    readiness = current_app.extensions['readiness']
+    checks = readiness.get(current_app.config['READINESS_CHECK_INTERVAL'])
+    return all(check['status'] != 'error' for check in checks.values()), checks
+
+
+def _run_checks():
+    checks = {}
+    if get_storage().supports_jobs:
+        checks['database'] = _check_databases()
+        checks['pools'] = _check_pools()
+        checks['jobs'] = _check_jobs()
+    checks['cache'] = _check_cache()
+    checks['logging'] = _check_logging()
+    return checks
+
+
+def _get_primary_engines():
+    bind_keys = [None, *current_app.config['SHARD_BIND_KEYS']]
+    return {bind_key or 'default': db.engines[bind_key] for bind_key in bind_keys}
+
+
+def _execute(engine, statement):
+    with get_lane_engine(engine, HEALTH_LANE).connect() as conn:
+        conn = conn.execution_options(statement_timeout=current_app.config['READINESS_DB_TIMEOUT'])
+        return conn.execute(statement).scalar()
+
+
+def _check_databases():
+    latencies = {}
+    errors = {}
+    for name, engine in _get_primary_engines().items():
+        start = time.perf_counter()
+        try:
+            _execute(engine, text('SELECT 1'))
+        except SQLAlchemyError as exc:
+            current_app.logger.warning('Readiness check of the %s database failed: %s', name, exc)
+            errors[name] = type(exc).__name__
+        else:
+            latencies[name] = (time.perf_counter() - start) * 1000
+    return {'status': 'error' if errors else 'ok', 'latency': latencies, 'errors': errors}
+
+
+def _check_pools():
+    primary_engines = {engine: name for name, engine in _get_primary_engines().items()}
+    pools = {name: engine.pool for engine, name in primary_engines.items()}
+    pools.update((f'{primary_engines[base_engine]}/{lane}', engine.pool)
+                 for base_engine, lane, engine in get_lane_engines()
+                 if base_engine in primary_engines and lane != HEALTH_LANE)
+    max_usage = current_app.config['READINESS_MAX_POOL_USAGE']
+    usage = {name: _get_pool_usage(pool.get_stats()) for name, pool in pools.items()}
+    saturated = [name for name, value in usage.items() if value >= 1]
+    # the busiest instances have saturated pools during a traffic peak, and taking them out of the load
+    # balancer would only move their load to the others, so this is only an error if explicitly enabled
+    if max_usage is not None and any(value >= max_usage for value in usage.values()):
+        status = 'error'
+    else:
+        status = 'warning' if saturated else 'ok'
+    return {'status': status, 'usage': usage, 'saturated': saturated}
+
+
+def _get_pool_usage(stats):
+    if stats['max_overflow'] < 0:
+        # the pool can grow without limits
+        return 0
+    return stats['checked_out'] / (stats['size'] + stats['max_overflow'])
+
+
+def _check_jobs():
+    # the oldest job which is due but has not been claimed shows how far behind the workers are
+    now = datetime.now(UTC)
+    query = select(func.min(Job.run_at)).where(Job.failed_at.is_(None), Job.run_at <= now)
+    try:
+        oldest = _execute(db.engines[None], query)
+    except SQLAlchemyError:
+        return {'status': 'warning', 'lag': None}
+    lag = (now - oldest).total_seconds() if oldest is not None else 0
+    max_lag = current_app.config['READINESS_MAX_JOB_LAG']
+    # the workers run separately, so a backlog does not keep this process from handling requests
+    return {'status': 'warning' if max_lag is not None and lag > max_lag else 'ok', 'lag': lag}
+
+
+def _check_cache():
+    cache = get_redirect_cache()
+    entries = len(cache)
+    # the cache is only a fallback, so a cold one is worth knowing about but does not break anything
+    warm = not cache.size or entries >= cache.size * current_app.config['READINESS_WARM_CACHE_RATIO']
+    return {'status': 'ok' if warm else 'warning', 'entries': entries, 'size': cache.size}
+
+
+def _check_logging():
+    queues = [handler for handler in current_app.logger.handlers if isinstance(handler, QueueHandler)]
+    if not queues:
+        return {'status': 'ok'}
+    usage = max(handler.queue.qsize() / handler.queue.maxsize for handler in queues)
+    dropped = sum(handler.dropped for handler in queues)
+    # a full queue drops records but requests are still handled
+    return {'status': 'warning' if usage >= 1 else 'ok', 'usage': usage, 'dropped': dropped}
+
+
+def init_app(app):
+    app.extensions['readiness'] = _Readiness()
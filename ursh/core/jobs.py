@@ -0,0 +1,223 @@
+import random
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import UTC, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select
+from werkzeug.utils import cached_property, import_string
+
+from ursh import db
+from ursh.core.metrics import JOB_DURATION, JOBS
+from ursh.models import Job
+from ursh.storage import get_storage
+
+
+class JobType:
+    """A kind of job which can be queued.
+
+    Jobs may be run more than once, e.g. when a worker dies while running
+    one, so they need to be safe to restart.
+
+    :param import_name: The function running the job as ``module:name``.
+                        It is called with the payload of the job as
+                        keyword arguments.
+    :param concurrency: The number of jobs of this type each worker runs
+                        at the same time, or ``None`` for no limit.
+    :param max_attempts: The number of times a job is run before giving
+                         up on it.
+    :param visibility_timeout: The number of seconds after which a job is
+                               considered lost and may be claimed again.
+    """
+
+    def __init__(self, import_name, concurrency=None, max_attempts=5, visibility_timeout=300):
+        self.import_name = import_name
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+
+    @cached_property
+    def func(self):
+        return import_string(self.import_name)
+
+
+JOB_TYPES = {
+    'delete-token': JobType('ursh.core.tokens:delete_token_with_urls', concurrency=1, visibility_timeout=3600),
+    'purge-expired-urls': JobType('ursh.core.purge:purge_expired_urls', concurrency=1, visibility_timeout=3600),
+    'purge-idempotency-keys': JobType('ursh.core.purge:purge_idempotency_keys', concurrency=1,
+                                      visibility_timeout=3600),
+    'rewrite-urls': JobType('ursh.core.urls:rewrite_url_prefix', concurrency=1, visibility_timeout=3600),
+}
+
+
+def enqueue_job(type_, payload=None, delay=0):
+    """Queue a job to be run by a worker.
+
+    The job is added to the current transaction, so it only becomes
+    visible to workers once that transaction is committed.  Storage
+    backends without a database cannot queue jobs, so the job is run
+    right away instead.
+
+    :param type_: The type of the job (a key of `JOB_TYPES`).
+    :param payload: A dict containing the arguments of the job.
+    :param delay: The number of seconds to wait before running the job.
+    :return: The new `Job` or ``None`` if the job has been run already.
+    """
+    job_type = JOB_TYPES[type_]
+    payload = payload or {}
+    if not get_storage().supports_jobs:
+        job_type.func(**payload)
+        return None
+    job = Job(type=type_, payload=payload, run_at=datetime.now(UTC) + timedelta(seconds=delay))
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+
+def claim_job(types=None):
+    """Claim the next job which is due.
+
+    Rows locked by other workers claiming a job are skipped instead of
+    waiting for them.  The claim is committed right away and only hides
+    the job from other workers until its visibility timeout expires.
+
+    :param types: The job types which may be claimed; all known types
+                  if omitted.
+    :return: The claimed `Job` or ``None`` if no job is due.
+    """
+    now = datetime.now(UTC)
+    query = (select(Job)
+             .where(Job.type.in_(JOB_TYPES if types is None else types), Job.failed_at.is_(None), Job.run_at <= now)
+             .order_by(Job.run_at)
+             .limit(1)
+             .with_for_update(skip_locked=True))
+    job = db.session.execute(query).scalar_one_or_none()
+    if job is not None:
+        job.attempts += 1
+        job.run_at = now + timedelta(seconds=JOB_TYPES[job.type].visibility_timeout)
+    db.session.commit()
+    return job
+
+
+def run_job(job):
+    """Run a claimed job.
+
+    A successful job is deleted.  If it fails, it is retried after a
+    delay growing with each attempt until it has been attempted the
+    maximum number of times of its type, after which it is marked as
+    failed.
+
+    :param job: A `Job` returned by `claim_job`.
+    :return: Whether the job succeeded.
+    """
+    job_id, type_, payload, attempts = job.id, job.type, job.payload, job.attempts
+    job_type = JOB_TYPES[type_]
+    current_app.logger.info('Running job %d (%s, attempt %d)', job_id, type_, attempts)
+    start = time.perf_counter()
+    try:
+        job_type.func(**payload)
+    except Exception:
+        JOBS.labels(type_, 'failure').inc()
+        db.session.rollback()
+        current_app.logger.exception('Job %d (%s) failed', job_id, type_)
+        now = datetime.now(UTC)
+        values = {'last_error': traceback.format_exc()}
+        if attempts >= job_type.max_attempts:
+            values['failed_at'] = now
+        else:
+            values['run_at'] = now + timedelta(seconds=_get_retry_delay(attempts))
+        # if the job took so long that another worker claimed it meanwhile, that claim is kept
+        Job.query.filter_by(id=job_id, attempts=attempts).update(values, synchronize_session=False)
+        db.session.commit()
+        return False
+    finally:
+        JOB_DURATION.labels(type_).observe(time.perf_counter() - start)
+    JOBS.labels(type_, 'success').inc()
+    # likewise, a job claimed by another worker meanwhile is still running there and must not be deleted
+    if not Job.query.filter_by(id=job_id, attempts=attempts).delete(synchronize_session=False):
+        current_app.logger.warning('Job %d (%s) has been claimed by another worker while running', job_id, type_)
+    db.session.commit()
+    return True
+
+
+def _get_retry_delay(attempts):
+    delay = min(current_app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1), current_app.config['JOB_MAX_RETRY_DELAY'])
+    # the jitter avoids retrying many jobs which failed for the same reason at the same time
+    return delay * random.uniform(0.5, 1)
+
+
+class Worker:
+    """Run queued jobs using a pool of threads.
+
+    The concurrency limits of the job types apply to each worker, so
+    running several workers allows more jobs of a type to run at once.
+
+    :param app: The Flask application.
+    :param threads: The number of jobs to run at the same time.
+    :param types: The job types to run; all known types if omitted.
+    """
+
+    def __init__(self, app, threads=None, types=None):
+        self.app = app
+        self.threads = threads or app.config['WORKER_THREADS']
+        self.types = list(types or JOB_TYPES)
+        self.poll_interval = app.config['JOB_POLL_INTERVAL']
+        self.limits = {name: JOB_TYPES[name].concurrency for name in self.types}
+        self.limits.update({name: int(limit) for name, limit in app.config['JOB_CONCURRENCY'].items()
+                            if name in self.limits})
+        self._running = Counter()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def run(self, burst=False):
+        """Run jobs until `stop` is called.
+
+        :param burst: Stop once there are no more jobs which are due.
+        """
+        threads = [threading.Thread(target=self._work, args=(burst,), name=f'ursh-worker-{i}')
+                   for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # joining with a timeout keeps the main thread responsive to signals
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self):
+        """Stop the worker after the jobs which are running have finished."""
+        self._stopping.set()
+
+    def _work(self, burst):
+        while not self._stopping.is_set():
+            try:
+                with self.app.app_context():
+                    found = self._run_next_job()
+            except Exception:
+                self.app.logger.exception('Could not claim a job')
+                found = False
+            if not found:
+                if burst:
+                    break
+                self._stopping.wait(self.poll_interval)
+
+    def _run_next_job(self):
+        with self._lock:
+            types = [name for name, limit in self.limits.items() if limit is None or self._running[name] < limit]
+            job = claim_job(types) if types else None
+            if job is None:
+                return False
+            type_ = job.type
+            self._running[type_] += 1
+        try:
+            run_job(job)
+        finally:
+            with self._lock:
+                self._running[type_] -= 1
+        return True
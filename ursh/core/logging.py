@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from datetime import UTC, datetime
+from logging.handlers import QueueListener
+
+_STANDARD_ATTRIBUTES = {*vars(logging.makeLogRecord({})), 'message', 'asctime', 'taskName'}
+
+
+class JSONFormatter(logging.Formatter):
+    """Format log records as one JSON object per line.
+
+    Attributes passed using ``extra`` (e.g. the query statistics of
+    `ursh.core.profiling`) are included as separate fields.
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, UTC).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in _STANDARD_ATTRIBUTES)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Only keep a fraction of the records of high-volume events.
+
+    Records are identified by their ``event`` attribute (passed using
+    ``extra``).  Kept records get a ``sample_rate`` attribute so their
+    real number can be estimated.
+
+    :param rates: A dict mapping events to the fraction of their records
+                  to keep.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None:
+            return True
+        if random.random() >= rate:
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Handler passing records to other handlers in a background thread.
+
+    The thread logging a record only adds it to a queue, while slow I/O
+    (e.g. a blocked stdout pipe) and formatting the message happen in
+    the background, so the arguments of log calls must not be modified
+    afterwards.  When the queue is full, records are dropped instead of
+    blocking; they are counted in `dropped` and in a prometheus metric.
+
+    :param handlers: The handlers emitting the records.
+    :param maxsize: The number of records the queue can hold.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self.listener = _QueueListener(self.queue, *handlers, respect_handler_level=True)
+        # gunicorn may create the app before forking its workers, which do not inherit the thread
+        os.register_at_fork(after_in_child=self.listener.restart)
+
+    def prepare(self, record):
+        # the records do not need to be pickled, so we can format them in the background
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # this module is imported when configuring logging, which should not need to load the metrics
+            from ursh.core.metrics import LOG_RECORDS_DROPPED
+            with self._lock:
+                self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+    def close(self):
+        self.listener.stop()
+        super().close()
+
+
+class _QueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # unlike records, the sentinel stopping the thread must not be dropped
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+    def restart(self):
+        if self._thread is not None:
+            self._thread = None
+            self.start()
+
+
+def _get_configured_loggers():
+    return [logging.getLogger(), *(logger for logger in logging.root.manager.loggerDict.values()
+                                   if isinstance(logger, logging.Logger))]
+
+
+def set_log_format(name):
+    """Use the same format for all configured log handlers.
+
+    :param name: The name of the format: ``json`` for `JSONFormatter`, or
+                 ``text`` to keep the formatters of the logging config.
+    """
+    if name == 'text':
+        return
+    formatter = FORMATTERS[name]()
+    for logger in _get_configured_loggers():
+        for handler in logger.handlers:
+            # the records in a queue are formatted by the handlers of its listener
+            targets = handler.listener.handlers if isinstance(handler, QueueHandler) else [handler]
+            for target in targets:
+                target.setFormatter(formatter)
+
+
+def setup_log_sampling(rates):
+    """Sample the records of high-volume events in all configured log handlers.
+
+    When using `setup_log_queue`, this needs to be called afterwards, so
+    the records are sampled before being added to a queue.
+
+    :param rates: A dict mapping events to the fraction of their records
+                  to keep, see `SamplingFilter`.
+    """
+    sampling_filter = SamplingFilter(rates)
+    for logger in _get_configured_loggers():
+        for handler in logger.handlers:
+            handler.filters = [f for f in handler.filters if not isinstance(f, SamplingFilter)]
+            handler.addFilter(sampling_filter)
+
+
+def setup_log_queue(maxsize):
+    """Move all configured log handlers behind `QueueHandler` instances.
+
+    :param maxsize: The number of records each queue can hold.
+    """
+    queue_handlers = {}
+    for logger in _get_configured_loggers():
+        if not logger.handlers or any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+            continue
+        key = tuple(logger.handlers)
+        if key not in queue_handlers:
+            queue_handlers[key] = QueueHandler(logger.handlers, maxsize)
+            queue_handlers[key].listener.start()
+        logger.handlers = [queue_handlers[key]]
+
+
+# the formats which can be selected using ``LOG_FORMAT``
+FORMATTERS = {'json': JSONFormatter}
@@ -0,0 +1,72 @@
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.exposition import CONTENT_TYPE_LATEST
+
+from ursh.core.profiling import get_query_stats
+
+# redirects usually take a few milliseconds, which the default buckets do not distinguish well
+_LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+_JOB_DURATION_BUCKETS = (.1, 1, 10, 60, 300, 900, 1800, 3600)
+
+REQUEST_DURATION = Histogram('ursh_request_duration_seconds', 'Time spent handling requests',
+                             ['endpoint', 'method'], buckets=_LATENCY_BUCKETS)
+REQUEST_DB_DURATION = Histogram('ursh_request_db_duration_seconds',
+                                'Time spent waiting for database queries while handling requests',
+                                ['endpoint'], buckets=_LATENCY_BUCKETS)
+REQUESTS = Counter('ursh_requests', 'Handled requests', ['endpoint', 'method', 'status'])
+API_ERRORS = Counter('ursh_api_errors', 'Error responses of the API', ['code'])
+REDIRECT_CACHE_FALLBACKS = Counter('ursh_redirect_cache_fallbacks',
+                                   'Redirects which needed the cache since the database was unavailable', ['result'])
+JOBS = Counter('ursh_jobs', 'Jobs run by workers', ['type', 'result'])
+LOG_RECORDS_DROPPED = Counter('ursh_log_records_dropped', 'Log records dropped since the log queue was full')
+JOB_DURATION = Histogram('ursh_job_duration_seconds', 'Time spent running jobs', ['type'],
+                         buckets=_JOB_DURATION_BUCKETS)
+
+
+def init_app(app):
+    """Record metrics of the requests handled by an application.
+
+    The metrics are served at ``METRICS_URL``.  When running several
+    processes (e.g. gunicorn workers), ``PROMETHEUS_MULTIPROC_DIR`` must
+    point to an empty directory shared by all of them, so each of them
+    serves the metrics of all processes.
+    """
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    app.add_url_rule(app.config['METRICS_URL'], 'metrics', _serve_metrics)
+
+
+def child_exit(server, worker):
+    """Discard the metrics of a gunicorn worker which exited.
+
+    Use this as the ``child_exit`` hook in the gunicorn config when
+    ``PROMETHEUS_MULTIPROC_DIR`` is set.
+    """
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+
+
+def _record_request(response):
+    if 'metrics_start' not in g:
+        return response
+    endpoint = request.endpoint or 'none'
+    REQUEST_DURATION.labels(endpoint, request.method).observe(time.perf_counter() - g.metrics_start)
+    if (stats := get_query_stats()) is not None:
+        REQUEST_DB_DURATION.labels(endpoint).observe(stats.duration)
+    REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    return response
+
+
+def _serve_metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,79 @@
+from threading import Lock
+
+from apispec import APISpec
+from apispec.ext.marshmallow import MarshmallowPlugin
+from apispec_webframeworks.flask import FlaskPlugin
+from flask import jsonify
+from flask_apispec import FlaskApiSpec
+from flask_apispec.apidoc import ResourceConverter, ViewConverter
+
+
+class _LazyApiSpec(FlaskApiSpec):
+    """A `FlaskApiSpec` which only builds the spec once it is needed.
+
+    Converting all views and schemas is one of the slowest parts of
+    creating the application, while the spec is rarely requested.
+    """
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        self._built = False
+        super().__init__(app)
+
+    def init_app(self, app):
+        self.app = app
+
+    def swagger_json(self):
+        return jsonify(self.get_spec().to_dict())
+
+    def get_spec(self):
+        with self._lock:
+            if not self._built:
+                self._build_spec()
+                self._built = True
+        return self.spec
+
+    def _build_spec(self):
+        from ursh.schemas import TokenSchema, URLSchema
+        self.spec = APISpec(
+            openapi_version='3.0.2',
+            title='ursh - URL Shortener',
+            version='2.0',
+            plugins=(
+                FlaskPlugin(),
+                MarshmallowPlugin(),
+            ),
+        )
+        self.spec.components.schema('Token', schema=TokenSchema)
+        self.spec.components.schema('URL', schema=URLSchema)
+        self.resource_converter = ResourceConverter(self.app, self.spec, self.document_options)
+        self.view_converter = ViewConverter(self.app, self.spec, self.document_options)
+        with self.app.app_context():
+            for endpoint, view in self.app.view_functions.items():
+                # unlike `register_existing_resources`, this also works for views whose function has a different name
+                blueprint, __, name = endpoint.rpartition('.')
+                try:
+                    self._register(view, name, blueprint or None)
+                except TypeError:
+                    # neither a function nor a resource, e.g. the swagger views themselves
+                    pass
+
+
+def init_app(app):
+    """Serve the OpenAPI spec at ``/swagger/`` and the Swagger UI at ``/swagger-ui/``."""
+    apispec = app.extensions['openapi'] = _LazyApiSpec(app)
+    apispec.add_swagger_routes()
+
+
+def get_openapi_spec(app):
+    """Get the OpenAPI spec of an application.
+
+    :param app: The `Flask` application, which does not need to serve
+                the generated spec itself.
+    :return: An `APISpec` instance.
+    """
+    apispec = app.extensions.get('openapi')
+    if not isinstance(apispec, _LazyApiSpec):
+        # the spec is not served or a prebuilt one is served instead
+        apispec = _LazyApiSpec(app)
+    return apispec.get_spec()
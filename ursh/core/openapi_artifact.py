@@ -0,0 +1,146 @@
+import gzip
+import hashlib
+import json
+import os
+from importlib.metadata import PackageNotFoundError, version
+from importlib.util import find_spec
+from pathlib import Path
+from threading import Lock
+
+from flask import Blueprint, Response, current_app, render_template, request
+
+import ursh
+from ursh.util.conditional import get_conditional_headers, make_not_modified_response
+
+# the files and packages (relative to the ursh package) the spec is generated from
+SPEC_SOURCES = ('blueprints', 'schemas.py', 'core/openapi.py')
+# the packages whose versions affect the generated spec
+SPEC_PACKAGES = ('apispec', 'apispec-webframeworks', 'flask-apispec', 'marshmallow')
+# the field of the artifact containing the hash of the sources it was built from
+SOURCE_HASH_FIELD = 'x-source-hash'
+
+
+def get_source_hash():
+    """Get a hash of everything the OpenAPI spec is generated from.
+
+    It changes whenever the views, schemas or the versions of the
+    libraries generating the spec change, which means that a prebuilt
+    spec may be out of date.
+    """
+    root = os.path.dirname(ursh.__file__)
+    paths = []
+    for source in SPEC_SOURCES:
+        path = os.path.join(root, source)
+        if os.path.isdir(path):
+            paths += sorted(os.path.join(dirpath, name)
+                            for dirpath, __, files in os.walk(path)
+                            for name in files if name.endswith('.py'))
+        elif os.path.exists(path):
+            paths.append(path)
+    sha = hashlib.sha256(ursh.__version__.encode())
+    for package in SPEC_PACKAGES:
+        try:
+            sha.update(f'{package}=={version(package)}'.encode())
+        except PackageNotFoundError:
+            pass
+    for path in sorted(paths):
+        sha.update(os.path.relpath(path, root).encode())
+        sha.update(Path(path).read_bytes())
+    return sha.hexdigest()
+
+
+def write_spec_artifact(spec, path):
+    """Save an OpenAPI spec so it can be served without generating it.
+
+    Besides the JSON file, a gzip-compressed copy is saved next to it
+    (with a ``.gz`` suffix).  Both are replaced atomically.
+
+    :param spec: The spec as a dict.
+    :param path: The path of the JSON file.
+    """
+    data = json.dumps({**spec, SOURCE_HASH_FIELD: get_source_hash()}, sort_keys=True).encode()
+    _write_file(path, data)
+    _write_file(f'{path}.gz', gzip.compress(data, mtime=0))
+
+
+def _write_file(path, data):
+    tmp_path = Path(f'{path}.tmp')
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+
+
+def is_spec_artifact_stale(path):
+    """Check whether a prebuilt spec was built from different sources.
+
+    :param path: The path of the JSON file written by `write_spec_artifact`.
+    """
+    return json.loads(Path(path).read_bytes()).get(SOURCE_HASH_FIELD) != get_source_hash()
+
+
+class _SpecArtifact:
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.compressed_data = None
+        self.etag = None
+        self._lock = Lock()
+
+    def load(self):
+        with self._lock:
+            if self.data is not None:
+                return
+            data = Path(self.path).read_bytes()
+            try:
+                self.compressed_data = Path(f'{self.path}.gz').read_bytes()
+            except FileNotFoundError:
+                self.compressed_data = gzip.compress(data)
+            if json.loads(data).get(SOURCE_HASH_FIELD) != get_source_hash():
+                current_app.logger.warning('The OpenAPI spec in %s is out of date; rebuild it using '
+                                           '`ursh openapi build`', self.path)
+            self.etag = hashlib.sha1(data).hexdigest()
+            self.data = data
+
+
+def _serve_spec():
+    artifact = current_app.extensions['openapi']
+    artifact.load()
+    if (response := make_not_modified_response(artifact.etag)) is not None:
+        return response
+    compressed = request.accept_encodings['gzip'] > 0
+    response = Response(artifact.compressed_data if compressed else artifact.data, mimetype='application/json',
+                        headers=get_conditional_headers(artifact.etag))
+    response.vary.add('Accept-Encoding')
+    # clients always revalidate, so a new spec is served right after a deployment
+    response.cache_control.no_cache = True
+    if compressed:
+        response.content_encoding = 'gzip'
+        response.set_etag(f'{artifact.etag}-gzip')
+    return response
+
+
+def _serve_swagger_ui():
+    return render_template('swagger-ui.html')
+
+
+def init_app(app, path):
+    """Serve a prebuilt OpenAPI spec at ``/swagger/`` and the Swagger UI at ``/swagger-ui/``.
+
+    Unlike `ursh.core.openapi.init_app`, this does not need to import the
+    libraries generating the spec, but only the templates and static files
+    of flask-apispec are used for the Swagger UI.
+
+    :param app: The `Flask` application.
+    :param path: The path of the JSON file written by `write_spec_artifact`.
+    """
+    app.extensions['openapi'] = _SpecArtifact(path)
+    # `find_spec` locates the package without importing it
+    flask_apispec_root = os.path.dirname(find_spec('flask_apispec').origin)
+    # the endpoints are the same as those of flask-apispec, which are used by its template
+    blueprint = Blueprint('flask-apispec', __name__, static_folder=os.path.join(flask_apispec_root, 'static'),
+                          template_folder=os.path.join(flask_apispec_root, 'templates'),
+                          static_url_path='/flask-apispec/static')
+    if json_url := app.config.get('APISPEC_SWAGGER_URL', '/swagger/'):
+        blueprint.add_url_rule(json_url, 'swagger-json', _serve_spec)
+    if ui_url := app.config.get('APISPEC_SWAGGER_UI_URL', '/swagger-ui/'):
+        blueprint.add_url_rule(ui_url, 'swagger-ui', _serve_swagger_ui)
+    app.register_blueprint(blueprint)
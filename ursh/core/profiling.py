@@ -0,0 +1,369 @@
+import cProfile
+import marshal
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# the number of frames stored for each memory allocation
+TRACEMALLOC_FRAMES = 25
+_PROFILE_ENDPOINTS = {'urls.request_profile', 'urls.request_profile_results'}
+# requests sent with this header and an admin token are profiled on their own,
+# and the results in the requested format are sent instead of the response
+PROFILE_HEADER = 'X-Ursh-Profile'
+PROFILE_RESULTS = ('pstats', 'collapsed', 'memory')
+# only the plans of queries which do not modify anything are logged
+_SELECT_RE = re.compile(r'\s*SELECT\b', re.IGNORECASE)
+
+
+class QueryStats:
+    """The number of queries made while handling a request and their duration."""
+
+    __slots__ = ('count', 'duration')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+
+class ProfilingSettings:
+    """The SQL profiling settings of the current process.
+
+    They are initialized from the config and may be changed at runtime
+    using the ``/api/internal/profiling`` endpoint, which only affects the
+    process handling that request.
+
+    :param enabled: Whether to log the number of queries and the time
+                    spent in the database for each request (and to send
+                    it in a ``Server-Timing`` header in debug mode).
+    :param slow_query_threshold: The duration in milliseconds after which
+                                 a query is logged, or ``None``.
+    :param explain_rate: The fraction of slow queries which are logged
+                         with their query plan.
+    """
+
+    def __init__(self, enabled=False, slow_query_threshold=None, explain_rate=0):
+        self.enabled = enabled
+        self.slow_query_threshold = slow_query_threshold
+        self.explain_rate = explain_rate
+
+    def to_dict(self):
+        return {'enabled': self.enabled, 'slow_query_threshold': self.slow_query_threshold,
+                'explain_rate': self.explain_rate}
+
+
+class RequestProfile:
+    """Profiles of the next requests to an endpoint handled by the current process.
+
+    Only one request is profiled at a time; requests arriving while one
+    is being profiled are handled normally.  The results of all profiled
+    requests are aggregated.
+
+    :param endpoint: The endpoint whose requests are profiled, or
+                     ``None`` for all of them.
+    :param requests: The number of requests to profile.
+    :param cpu: Whether to profile the CPU usage, using both `cProfile`
+                and a thread sampling the stack of the request.
+    :param memory: Whether to trace the memory allocated by the requests
+                   (which includes allocations of other threads meanwhile).
+    :param sample_interval: How often the stack is sampled, in seconds.
+    """
+
+    def __init__(self, endpoint=None, requests=10, cpu=True, memory=False, sample_interval=0.001):
+        self.endpoint = endpoint
+        self.requests = requests
+        self.cpu = cpu
+        self.memory = memory
+        self.sample_interval = sample_interval
+        self.profiled = 0
+        self.stats = None
+        self.stacks = Counter()
+        self.allocations = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.profiled < self.requests
+
+    def to_dict(self):
+        return {'endpoint': self.endpoint, 'requests': self.requests, 'profiled': self.profiled, 'cpu': self.cpu,
+                'memory': self.memory, 'active': self.active}
+
+    def get_pstats(self):
+        """Get the aggregated `cProfile` results in the format of `pstats.Stats.dump_stats`."""
+        return marshal.dumps(self.stats.stats if self.stats else {})
+
+    def get_collapsed_stacks(self, memory=False):
+        """Get the sampled stacks in the collapsed format used by flame graph tools.
+
+        :param memory: Whether to get the stacks allocating memory
+                       (weighted by the number of bytes) instead of the
+                       sampled CPU stacks.
+        """
+        stacks = self.allocations if memory else self.stacks
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    def _start(self):
+        if not self._lock.acquire(blocking=False):
+            return None
+        if not self.active:
+            self._lock.release()
+            return None
+        state = {}
+        if self.memory:
+            if tracemalloc.is_tracing():
+                # traced by someone else (e.g. ``PYTHONTRACEMALLOC``), so we need to compare with the current traces
+                state['snapshot'] = tracemalloc.take_snapshot()
+            else:
+                # only tracing during the request keeps the snapshots small
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+        if self.cpu:
+            state['sampler'] = _StackSampler(threading.get_ident(), self.sample_interval)
+            state['sampler'].start()
+            state['profile'] = cProfile.Profile()
+            state['profile'].enable()
+        return state
+
+    def _finish(self, state):
+        try:
+            if self.cpu:
+                state['profile'].disable()
+                state['sampler'].stop()
+            # the allocations made while aggregating the results are not part of the request
+            if self.memory:
+                self._add_allocations(state.get('snapshot'))
+            if self.cpu:
+                self.stacks.update(state['sampler'].stacks)
+                if self.stats is None:
+                    self.stats = pstats.Stats(state['profile'])
+                else:
+                    self.stats.add(state['profile'])
+            self.profiled += 1
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """Stop profiling further requests."""
+        with self._lock:
+            self.requests = self.profiled
+
+    def _add_allocations(self, previous_snapshot):
+        snapshot = tracemalloc.take_snapshot()
+        if previous_snapshot is None:
+            tracemalloc.stop()
+            stats = [(stat.traceback, stat.size) for stat in snapshot.statistics('traceback')]
+        else:
+            stats = [(stat.traceback, stat.size_diff) for stat in snapshot.compare_to(previous_snapshot, 'traceback')]
+        for traceback, size in stats:
+            # skip the allocations of the profiler itself (filtering the grouped statistics is much faster)
+            if size > 0 and traceback[0].filename not in (__file__, tracemalloc.__file__):
+                # the frames of a traceback are ordered from the most recent call
+                self.allocations[';'.join(f'{frame.filename}:{frame.lineno}' for frame in reversed(traceback))] += size
+
+
+class _StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if (frame := sys._current_frames().get(self.thread_id)) is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def init_app(app):
+    """Keep track of the queries made while handling requests and allow profiling them."""
+    app.extensions['sql_profiling'] = ProfilingSettings(app.config['SQL_PROFILING'],
+                                                        app.config['SLOW_QUERY_THRESHOLD'],
+                                                        app.config['SLOW_QUERY_EXPLAIN_RATE'])
+    app.extensions['request_profile'] = None
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_finish_request_profile)
+
+
+def get_profiling_settings():
+    """Get the SQL profiling settings of the current application."""
+    return current_app.extensions['sql_profiling']
+
+
+def get_query_stats():
+    """Get the `QueryStats` of the current request or ``None``."""
+    return g.get('query_stats')
+
+
+def get_request_profile():
+    """Get the `RequestProfile` of the current application or ``None``."""
+    return current_app.extensions['request_profile']
+
+
+def start_request_profile(profile):
+    """Profile the next requests handled by the current process.
+
+    :param profile: A `RequestProfile`, which replaces the previous one.
+    """
+    if (previous := get_request_profile()) is not None:
+        previous.stop()
+    current_app.extensions['request_profile'] = profile
+
+
+def get_profile_response(profile, result):
+    """Get a response containing the results of a `RequestProfile`.
+
+    :param profile: The `RequestProfile`.
+    :param result: The format of the results (one of `PROFILE_RESULTS`).
+    """
+    if result == 'pstats':
+        return Response(profile.get_pstats(), mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=ursh.pstats'})
+    return Response(profile.get_collapsed_stacks(memory=result == 'memory'), mimetype='text/plain')
+
+
+def _is_admin_request():
+    from ursh.blueprints.api.blueprint import get_token
+    from ursh.storage import get_storage
+    if not (api_key := get_token()):
+        return False
+    storage = get_storage()
+    token = storage.get_token(api_key)
+    is_admin = token is not None and token.is_admin and not token.is_blocked
+    # the request itself must not be handled in the transaction used to check the token
+    storage.commit()
+    return is_admin
+
+
+def _start_single_request_profile():
+    # unlike profiles started using the api, this works no matter which process handles the request
+    result = request.headers[PROFILE_HEADER]
+    if result not in PROFILE_RESULTS or not _is_admin_request():
+        return
+    profile = RequestProfile(requests=1, cpu=result != 'memory', memory=result == 'memory')
+    g.single_request_profile = (profile, profile._start(), result)
+
+
+def _finish_single_request_profile(response):
+    profile, state, result = g.pop('single_request_profile')
+    try:
+        # a streamed response is only generated while it is being sent, which should be profiled as well
+        response.get_data()
+        response.close()
+    finally:
+        profile._finish(state)
+    profile_response = get_profile_response(profile, result)
+    profile_response.headers[f'{PROFILE_HEADER}-Status'] = str(response.status_code)
+    return profile_response
+
+
+def _start_request():
+    g.query_stats = QueryStats()
+    if PROFILE_HEADER in request.headers:
+        _start_single_request_profile()
+        return
+    if (profile := get_request_profile()) is None or not profile.active:
+        return
+    # the profiles are downloaded using the internal api, which should not profile itself
+    if request.endpoint in _PROFILE_ENDPOINTS or (profile.endpoint and request.endpoint != profile.endpoint):
+        return
+    if (state := profile._start()) is not None:
+        g.request_profile = (profile, state)
+
+
+def _finish_request_profile(exc):
+    # if handling the request failed, the profile of a single request cannot be sent, but it must still be stopped
+    if (single_request_profile := g.pop('single_request_profile', None)) is not None:
+        profile, state, __ = single_request_profile
+        profile._finish(state)
+    if (request_profile := g.pop('request_profile', None)) is not None:
+        profile, state = request_profile
+        profile._finish(state)
+
+
+def _finish_request(response):
+    if 'single_request_profile' in g:
+        response = _finish_single_request_profile(response)
+    stats = get_query_stats()
+    if stats is None or not get_profiling_settings().enabled:
+        return response
+    duration = stats.duration * 1000
+    current_app.logger.info('%s %s: %d queries in %.1fms', request.method, request.path, stats.count, duration,
+                            extra={'event': 'request-profile', 'endpoint': request.endpoint, 'query_count': stats.count,
+                                   'db_time': duration})
+    if current_app.debug:
+        response.headers.add('Server-Timing', f'db;dur={duration:.1f};desc="{stats.count} queries"')
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or (stats := get_query_stats()) is None:
+        return
+    duration = time.perf_counter() - conn.info['query_start']
+    stats.count += 1
+    stats.duration += duration
+    settings = get_profiling_settings()
+    if settings.slow_query_threshold is not None and duration * 1000 >= settings.slow_query_threshold:
+        _log_slow_query(conn, statement, parameters, executemany, duration * 1000, settings.explain_rate)
+
+
+def _log_slow_query(conn, statement, parameters, executemany, duration, explain_rate):
+    extra = {'event': 'slow-query', 'endpoint': request.endpoint, 'query_duration': duration, 'statement': statement}
+    # getting the plan does not run the query again, but it still takes time and is only needed for a few queries
+    if (conn.dialect.name == 'postgresql' and not executemany and _SELECT_RE.match(statement)
+            and random.random() < explain_rate):
+        extra['plan'] = _explain(conn, statement, parameters)
+    if extra.get('plan'):
+        current_app.logger.warning('Slow query (%.1fms): %s\n%s', duration, statement, extra['plan'], extra=extra)
+    else:
+        current_app.logger.warning('Slow query (%.1fms): %s', duration, statement, extra=extra)
+
+
+def _explain(conn, statement, parameters):
+    # the query runs in the transaction of the request, which must not be aborted if getting its plan fails
+    dbapi_conn = conn.connection
+    savepoint = not dbapi_conn.autocommit
+    # the results of the query itself have not been fetched yet, so we need a separate cursor
+    with dbapi_conn.cursor() as cursor:
+        if savepoint:
+            cursor.execute('SAVEPOINT ursh_explain')
+        try:
+            plan = _get_plan(cursor, statement, parameters)
+        except conn.dialect.dbapi.Error as exc:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT ursh_explain')
+            current_app.logger.warning('Could not get the plan of a slow query: %s', exc)
+            return None
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT ursh_explain')
+    return plan
+
+
+def _get_plan(cursor, statement, parameters):
+    cursor.execute(f'EXPLAIN {statement}', parameters)
+    return '\n'.join(row[0] for row in cursor.fetchall())
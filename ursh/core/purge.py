@@ -0,0 +1,42 @@
+from datetime import UTC, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select
+
+from ursh import db
+from ursh.models import IdempotencyKey
+from ursh.storage import get_storage
+
+
+def purge_expired_urls(batch_size=1000):
+    """Delete all expired URLs.
+
+    :param batch_size: The number of URLs deleted per transaction.
+    :return: The number of deleted URLs.
+    """
+    storage = get_storage()
+    total = 0
+    while deleted := storage.delete_expired_urls(datetime.now(UTC), batch_size):
+        storage.commit()
+        total += deleted
+    storage.commit()
+    return total
+
+
+def purge_idempotency_keys(batch_size=1000):
+    """Delete all expired idempotency keys.
+
+    :param batch_size: The number of keys deleted per transaction.
+    :return: The number of deleted keys.
+    """
+    expiry = datetime.now(UTC) - timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+    expired = select(IdempotencyKey.id).where(IdempotencyKey.created_at < expiry).limit(batch_size)
+    total = 0
+    while True:
+        deleted = (IdempotencyKey.query
+                   .filter(IdempotencyKey.id.in_(expired.scalar_subquery()))
+                   .delete(synchronize_session=False))
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
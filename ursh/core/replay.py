@@ -0,0 +1,122 @@
+import heapq
+import http.client
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from ursh.core.bench import get_latency_stats
+
+
+def read_captures(files):
+    """Read the requests recorded in capture files in chronological order.
+
+    :param files: Files opened for reading text, e.g. the captures of
+                  several processes or rotated files.  Access traces
+                  from ``ursh dev seed`` can be used as well.
+    :return: An iterator of the recorded requests.
+    """
+    streams = [(json.loads(line) for line in file if line.strip()) for file in files]
+    return heapq.merge(*streams, key=lambda record: record.get('t', 0))
+
+
+def replay_requests(records, target, concurrency=8, speed=1, api_key=None):
+    """Send recorded requests to a running instance.
+
+    :param records: An iterable of recorded requests, e.g. from `read_captures`.
+    :param target: The base URL of the instance, e.g. ``http://127.0.0.1:5000``.
+    :param concurrency: The number of requests sent at the same time.
+    :param speed: How much faster than recorded the requests are sent,
+                  or ``0`` to send them as fast as possible.  Requests
+                  without a recorded time are always sent right away.
+    :param api_key: The API key used for requests which were authorized
+                    with one.  Without it, such requests are skipped.
+    :return: A dict containing the results for each kind of request
+             (``redirect``, ``not-found`` and ``api``), which has the
+             same structure as the results of `run_benchmark`.
+    """
+    target = urlsplit(target)
+    local = threading.local()
+    lock = threading.Lock()
+    # bounds the requests waiting for a thread, so a long capture is not read into memory at once
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    results = {}
+    skipped = 0
+
+    def _replay(record):
+        try:
+            duration, status = _send_request(local, target, record, api_key)
+        except (OSError, http.client.HTTPException):
+            local.connection = None
+            duration = status = None
+        finally:
+            slots.release()
+        with lock:
+            results.setdefault(_get_kind(record), []).append((record, duration, status))
+
+    start = time.perf_counter()
+    first_time = None
+    with ThreadPoolExecutor(concurrency) as executor:
+        for record in records:
+            if record.get('auth') == 'bearer' and not api_key:
+                skipped += 1
+                continue
+            if speed and 't' in record:
+                if first_time is None:
+                    first_time = record['t']
+                    start = time.perf_counter()
+                if (delay := start + (record['t'] - first_time) / speed - time.perf_counter()) > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            executor.submit(_replay, record)
+    duration = time.perf_counter() - start
+    return {
+        'target': target.geturl(),
+        'speed': speed,
+        'concurrency': concurrency,
+        'duration': duration,
+        'skipped': skipped,
+        'workloads': {kind: _get_results(entries, duration) for kind, entries in sorted(results.items())},
+    }
+
+
+def _get_kind(record):
+    if record['path'].startswith('/api/'):
+        return 'api'
+    return 'not-found' if record.get('status') == 404 else 'redirect'
+
+
+def _send_request(local, target, record, api_key):
+    if getattr(local, 'connection', None) is None:
+        connection_cls = http.client.HTTPSConnection if target.scheme == 'https' else http.client.HTTPConnection
+        local.connection = connection_cls(target.netloc, timeout=30)
+    path = target.path.rstrip('/') + record['path']
+    if query := record.get('query'):
+        path += f'?{query}'
+    headers = {}
+    if record.get('auth') == 'bearer':
+        headers['Authorization'] = f'Bearer {api_key}'
+    body = record.get('body')
+    if body is not None:
+        headers['Content-Type'] = record.get('content_type') or 'application/json'
+        body = body.encode()
+    start = time.perf_counter()
+    local.connection.request(record['method'], path, body=body, headers=headers)
+    response = local.connection.getresponse()
+    response.read()
+    return (time.perf_counter() - start) * 1000, response.status
+
+
+def _get_results(entries, duration):
+    latencies = [latency for __, latency, __ in entries if latency is not None]
+    recorded_latencies = [record['duration'] for record, __, __ in entries if 'duration' in record]
+    return {
+        'requests': len(entries),
+        'errors': len(entries) - len(latencies),
+        'status_changes': sum(1 for record, latency, status in entries
+                              if latency is not None and record.get('status', status) != status),
+        'throughput': len(entries) / duration,
+        'latency': get_latency_stats(latencies) if latencies else None,
+        'recorded_latency': get_latency_stats(recorded_latencies) if recorded_latencies else None,
+    }
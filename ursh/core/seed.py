@@ -0,0 +1,223 @@
+import csv
+import io
+import itertools
+import json
+import math
+import random
+from datetime import UTC, datetime, timedelta
+from uuid import UUID
+
+from flask import current_app
+from psycopg2 import sql
+
+from ursh import db
+from ursh.models import ALPHABET_RESTRICTED
+
+_HOSTS = ('indico.example.org', 'events.example.com', 'conferences.example.net')
+_META_TYPES = ('event', 'contribution', 'attachment')
+
+
+class SyntheticDataset:
+    """A reproducible set of tokens and URLs resembling production data.
+
+    The shortcuts use the alphabet and length of generated shortcuts,
+    but instead of storing them they are derived from the index of each
+    URL using a permutation of all possible shortcuts, so millions of
+    them can be generated (and sampled for access traces) without
+    keeping them in memory.
+
+    :param urls: The number of URLs.
+    :param tokens: The number of tokens owning the URLs.  How many URLs
+                   each token owns is skewed like the popularity of URLs.
+    :param seed: The seed of the random number generator; the same seed
+                 always results in the same dataset.
+    """
+
+    def __init__(self, urls, tokens, seed=None):
+        self.urls = urls
+        self.tokens = tokens
+        self.seed = random.randrange(2**32) if seed is None else seed
+        self._length = current_app.config['URL_LENGTH']
+        self._space = len(ALPHABET_RESTRICTED) ** self._length
+        if urls > self._space // 2:
+            raise ValueError(f'At most {self._space // 2} URLs can be generated with a URL_LENGTH of {self._length}')
+        rng = random.Random(self.seed)
+        self._offset = rng.randrange(self._space)
+        self._factor = _get_coprime(rng, self._space)
+        # spreads the popular urls over the whole table instead of having them next to each other
+        self._rank_factor = _get_coprime(rng, urls)
+
+    def get_shortcut(self, index):
+        """Get the shortcut of the URL with the given index."""
+        value = (index * self._factor + self._offset) % self._space
+        chars = []
+        for __ in range(self._length):
+            value, digit = divmod(value, len(ALPHABET_RESTRICTED))
+            chars.append(ALPHABET_RESTRICTED[digit])
+        return ''.join(chars)
+
+    def iter_tokens(self):
+        """Iterate over the values of the tokens."""
+        rng = random.Random(f'{self.seed}-tokens')
+        now = datetime.now(UTC)
+        for i in range(self.tokens):
+            yield {'api_key': str(UUID(int=rng.getrandbits(128), version=4)), 'name': f'seed-{self.seed}-{i}',
+                   'is_admin': False, 'is_blocked': False, 'token_uses': 0, 'last_access': now, 'updated_at': now}
+
+    def iter_urls(self, token_ids, start=0, stop=None):
+        """Iterate over the values of the URLs.
+
+        :param token_ids: The ids of the tokens in the order returned by
+                          `iter_tokens`.
+        :param start: The index of the first URL.
+        :param stop: The index after the last URL, or ``None`` for all of them.
+        """
+        now = datetime.now(UTC)
+        blacklisted = current_app.config['BLACKLISTED_URLS']
+        for i in range(start, self.urls if stop is None else min(stop, self.urls)):
+            rng = random.Random(f'{self.seed}-url-{i}')
+            if (shortcut := self.get_shortcut(i)) in blacklisted:
+                continue
+            event_id = rng.randrange(1, 1000000)
+            type_ = rng.choice(_META_TYPES)
+            url = f'https://{rng.choice(_HOSTS)}/event/{event_id}/'
+            if type_ == 'contribution':
+                url += f'contributions/{rng.randrange(1, 10000)}/'
+            elif type_ == 'attachment':
+                url += f'attachments/{rng.randrange(1, 100000)}/{rng.randrange(1, 1000000)}/document.pdf'
+            if rng.random() < 0.05:
+                url += f'?utm_source=newsletter&utm_campaign={rng.getrandbits(64):x}'
+            # urls created by scripts usually have metadata, those created manually often don't
+            meta = {'type': type_, 'event_id': str(event_id)} if rng.random() < 0.8 else {}
+            expires_at = now + timedelta(days=rng.randrange(1, 365)) if rng.random() < 0.05 else None
+            yield {'shortcut': shortcut, 'url': url, 'token_id': token_ids[_get_zipf_rank(rng, len(token_ids), 1)],
+                   'is_custom': False, 'meta': json.dumps(meta), 'expires_at': expires_at, 'updated_at': now}
+
+    def iter_trace(self, requests, exponent=1.1):
+        """Iterate over redirect requests with Zipf-distributed shortcuts.
+
+        :param requests: The number of requests.
+        :param exponent: The exponent of the Zipf distribution; higher
+                         values concentrate more requests on the most
+                         popular URLs.
+        :return: An iterator of dicts as used in trace files.
+        """
+        rng = random.Random(f'{self.seed}-trace')
+        for __ in range(requests):
+            index = _get_zipf_rank(rng, self.urls, exponent) * self._rank_factor % self.urls
+            yield {'method': 'GET', 'path': f'/{self.get_shortcut(index)}'}
+
+
+def seed_database(dataset, batch_size=100000, callback=None):
+    """Add the tokens and URLs of a synthetic dataset to the database.
+
+    The rows are streamed to the database using ``COPY`` instead of
+    creating ORM objects, in separate transactions for each batch, so
+    the size of a batch does not affect the memory usage.  Shortcuts which already
+    exist are skipped, so seeding the same dataset again is harmless.
+    This only works on PostgreSQL.
+
+    :param dataset: The `SyntheticDataset` to add.
+    :param batch_size: The number of URLs added per transaction.
+    :param callback: A function called with the number of URLs handled
+                     so far after each batch.
+    :return: The number of added URLs.
+    """
+    _copy_rows('tokens', dataset.iter_tokens(), 'name')
+    names = [f'seed-{dataset.seed}-{i}' for i in range(dataset.tokens)]
+    query = db.text('SELECT name, id FROM tokens WHERE name = ANY(:names)')
+    ids = dict(db.session.execute(query, {'names': names}).all())
+    db.session.commit()
+    token_ids = [ids[name] for name in names]
+    total = 0
+    for start in range(0, dataset.urls, batch_size):
+        total += _copy_rows('urls', dataset.iter_urls(token_ids, start, start + batch_size), 'shortcut')
+        db.session.commit()
+        if callback:
+            callback(min(start + batch_size, dataset.urls))
+    with db.session.connection().connection.cursor() as cursor:
+        cursor.execute('ANALYZE tokens, urls')
+    db.session.commit()
+    return total
+
+
+def write_trace(dataset, file, requests, exponent=1.1):
+    """Write an access trace for a synthetic dataset.
+
+    The trace contains one JSON object per line, describing a request.
+
+    :param dataset: The `SyntheticDataset` whose URLs are requested.
+    :param file: A file opened for writing text.
+    :param requests: The number of requests.
+    :param exponent: The exponent of the Zipf distribution of the URLs.
+    """
+    for request in dataset.iter_trace(requests, exponent):
+        file.write(json.dumps(request) + '\n')
+
+
+def _copy_rows(table, rows, unique_column):
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return 0
+    params = {'target': sql.Identifier(table), 'staging': sql.Identifier(f'seed_{table}'),
+              'cols': sql.SQL(', ').join(map(sql.Identifier, first)), 'key': sql.Identifier(unique_column)}
+    # the rows go into a staging table first so conflicting ones can be skipped,
+    # which `COPY` cannot do on its own
+    with db.session.connection().connection.cursor() as cursor:
+        cursor.execute(sql.SQL('CREATE TEMPORARY TABLE {staging} AS SELECT {cols} FROM {target} WITH NO DATA')
+                       .format(**params))
+        cursor.copy_expert(sql.SQL('COPY {staging} ({cols}) FROM STDIN WITH (FORMAT csv)').format(**params),
+                           _CSVStream(itertools.chain([first], rows), list(first)))
+        cursor.execute(sql.SQL('INSERT INTO {target} ({cols}) SELECT {cols} FROM {staging} '
+                               'ON CONFLICT ({key}) DO NOTHING').format(**params))
+        count = cursor.rowcount
+        cursor.execute(sql.SQL('DROP TABLE {staging}').format(**params))
+    return count
+
+
+class _CSVStream:
+    """A file-like object writing rows as CSV while they are being read.
+
+    This lets ``COPY`` stream the rows to the database, so they never
+    need to be in memory all at once.
+    """
+
+    def __init__(self, rows, fieldnames):
+        self._rows = rows
+        self._buffer = io.StringIO()
+        self._writer = csv.DictWriter(self._buffer, fieldnames)
+
+    def read(self, size=-1):
+        # the rows are written to the end of the buffer and read from its start
+        pending = self._buffer.getvalue()
+        while size < 0 or len(pending) < size:
+            if (row := next(self._rows, None)) is None:
+                break
+            self._writer.writerow(row)
+            pending = self._buffer.getvalue()
+        if size < 0:
+            size = len(pending)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(pending[size:])
+        return pending[:size]
+
+
+def _get_coprime(rng, n):
+    while True:
+        candidate = rng.randrange(n // 2, n) if n > 2 else 1
+        if math.gcd(candidate, n) == 1:
+            return candidate
+
+
+def _get_zipf_rank(rng, n, exponent):
+    # inverse transform sampling of a continuous power law, which closely approximates the
+    # zipf distribution without computing the weights of all ranks
+    u = rng.random()
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        x = (1 + u * ((n + 1) ** (1 - exponent) - 1)) ** (1 / (1 - exponent))
+    return min(int(x), n) - 1
@@ -0,0 +1,81 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+
+def profile_startup(start=None):
+    """Measure how long importing and creating the application take.
+
+    This is only meaningful in a fresh process, since modules which
+    were imported before are not imported again.
+
+    :param start: The `time.perf_counter` value from before importing
+                  anything from ``ursh``, since importing this module
+                  already imports parts of it.
+    :return: A dict containing the durations (in seconds) of the import
+             of `ursh.core.app`, of `create_app` and of each of its
+             phases.
+    """
+    if start is None:
+        start = time.perf_counter()
+    from ursh.core.app import create_app
+    imported = time.perf_counter()
+    app = create_app()
+    created = time.perf_counter()
+    return {
+        'import': imported - start,
+        'create_app': created - imported,
+        'phases': app.extensions['startup_timings'],
+    }
+
+
+def run_startup_profile(runs=3):
+    """Profile the startup of new processes.
+
+    Each run starts a new Python process creating the application using
+    the config of the current environment (e.g. ``URSH_CONFIG``).
+
+    :param runs: The number of processes to start.
+    :return: A dict containing the median durations (in seconds) of the
+             import of the application, of `create_app` and of each of
+             its phases, and the time spent importing each top-level
+             package (excluding packages it imported itself).
+    """
+    results = [_run_process() for __ in range(runs)]
+    return {
+        'runs': runs,
+        'import': statistics.median(result['import'] for result in results),
+        'create_app': statistics.median(result['create_app'] for result in results),
+        'phases': _get_medians([result['phases'] for result in results]),
+        'packages': _get_medians([result['packages'] for result in results]),
+    }
+
+
+def _run_process():
+    code = ('import time; start = time.perf_counter(); import json; from ursh.core.startup import profile_startup; '
+            'print(json.dumps(profile_startup(start)))')
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                             check=True)
+    result = json.loads(process.stdout.splitlines()[-1])
+    result['packages'] = _parse_import_times(process.stderr)
+    return result
+
+
+def _parse_import_times(output):
+    # lines look like `import time:       286 |     371908 |   ursh.core.app` (in microseconds)
+    packages = Counter()
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, __, module = line.removeprefix('import time:').split('|')
+        packages[module.strip().partition('.')[0]] += int(self_time) / 1e6
+    return packages
+
+
+def _get_medians(dicts):
+    # phases or packages missing from a run (e.g. imported by another package first) count as 0
+    keys = dict.fromkeys(key for values in dicts for key in values)
+    return {key: statistics.median(values.get(key, 0) for values in dicts) for key in keys}
@@ -0,0 +1,52 @@
+from ursh.storage import get_storage
+
+
+def delete_token_with_urls(api_key, transfer_to=None, batch_size=1000, callback=None):
+    """Delete a token after deleting or transferring all its URLs.
+
+    The URLs are handled in batches which are committed separately, so
+    there are no long-running transactions locking many rows, and if
+    this gets interrupted it can simply be started again.  The token
+    should be blocked beforehand so it cannot create new URLs meanwhile.
+
+    This usually runs in a worker process, so the redirect caches of the
+    web workers are not updated.  They may still serve deleted URLs while
+    the database is unavailable, until each shortcut has been requested
+    successfully again.
+
+    :param api_key: The API key of the token to delete.
+    :param transfer_to: The API key of the token receiving the URLs, or
+                        ``None`` to delete them.
+    :param batch_size: The number of URLs handled per transaction.
+    :param callback: A function called with the number of URLs handled
+                     so far after each batch.
+    :return: The deleted `Token` or ``None`` if it does not exist
+    :raise ValueError: if the token receiving the URLs does not exist
+    """
+    storage = get_storage()
+    token = storage.get_token(api_key)
+    if token is None:
+        return None
+    token_id = token.id
+    new_token_id = None
+    if transfer_to is not None:
+        new_token = storage.get_token(transfer_to)
+        if new_token is None:
+            raise ValueError('The token receiving the URLs does not exist')
+        new_token_id = new_token.id
+    total = 0
+    while True:
+        if new_token_id is not None:
+            count = storage.transfer_token_urls(token_id, new_token_id, batch_size)
+            storage.commit()
+        else:
+            count = len(storage.delete_token_urls(token_id, batch_size))
+            storage.commit()
+        if not count:
+            break
+        total += count
+        if callback:
+            callback(total)
+    token = storage.delete_token(api_key)
+    storage.commit()
+    return token
@@ -0,0 +1,38 @@
+import time
+
+from ursh.storage import get_storage
+
+
+def rewrite_url_prefix(old_prefix, new_prefix, batch_size=1000, delay=0, callback=None):
+    """Replace the beginning of the target of all URLs starting with a prefix.
+
+    This is meant for moving all links to a site which moved to another
+    domain.  The URLs are handled in batches which are committed
+    separately, so there are no long-running transactions locking many
+    rows, and if this gets interrupted it can simply be started again.
+
+    This usually runs in a worker process, so the redirect caches of the
+    web workers are not updated.  They may still serve the old targets
+    while the database is unavailable, until each shortcut has been
+    redirected successfully again.
+
+    :param old_prefix: The prefix to replace, e.g. ``https://old.example.org/``.
+    :param new_prefix: The prefix replacing it, e.g. ``https://new.example.org/``.
+    :param batch_size: The number of URLs rewritten per transaction.
+    :param delay: The number of seconds to wait between two batches,
+                  which leaves room for other queries on a busy database.
+    :param callback: A function called with the number of URLs rewritten
+                     so far after each batch.
+    :return: The number of rewritten URLs.
+    """
+    storage = get_storage()
+    total = 0
+    while shortcuts := storage.rewrite_url_prefix(old_prefix, new_prefix, batch_size):
+        storage.commit()
+        total += len(shortcuts)
+        if callback:
+            callback(total)
+        if delay:
+            time.sleep(delay)
+    storage.commit()
+    return total
@@ -0,0 +1,72 @@
+import click
+from alembic import context
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy_utc import UtcDateTime
+
+from ursh import db
+
+
+def _get_databases():
+    """Get the names and engines of the databases to migrate.
+
+    When using sharded storage the urls table in each shard needs to be
+    migrated as well, unless the shard is the main database itself.
+    """
+    databases = [('main database', None, db.engine)]
+    if current_app.config['STORAGE_BACKEND'] == 'sharded' and context.config.attributes.get('shards', True):
+        for index, key in enumerate(current_app.config['SHARD_BIND_KEYS']):
+            engine = db.engines[key]
+            if str(engine.url) != str(db.engine.url):
+                databases.append((f'shard {index}', index, engine))
+    return databases
+
+
+def _create_engine(engine):
+    # the statement timeout used by the application would abort e.g. index builds, and
+    # waiting for locks must not take too long since all queries on the table would be
+    # queued behind the migration in the meantime
+    url = engine.url
+    if url.get_backend_name() == 'postgresql':
+        options = f'-c statement_timeout=0 -c lock_timeout={context.config.attributes.get("lock_timeout", 0)}'
+        if 'options' in url.query:
+            options = f'{url.query["options"]} {options}'
+        url = url.update_query_dict({'options': options})
+    return create_engine(url, poolclass=NullPool, execution_options={'statement_timeout': 0})
+
+
+def _render_item(type_, obj, autogen_context):
+    if type_ == 'type' and isinstance(obj, UtcDateTime):
+        autogen_context.imports.add('from sqlalchemy_utc import UtcDateTime')
+        return 'UtcDateTime()'
+    return False
+
+
+def _print_step(name):
+    def _callback(ctx, step, heads, run_args):
+        if not step.is_stamp:
+            action = 'Upgraded to' if step.is_upgrade else 'Downgraded from'
+            click.echo(f'{name}: {action} {step.up_revision_id} ({step.up_revision.doc})')
+    return _callback
+
+
+def run_migrations():
+    if context.is_offline_mode():
+        raise click.UsageError('Generating SQL scripts is not supported')
+    attributes = context.config.attributes
+    for name, shard, engine in _get_databases():
+        engine = _create_engine(engine)
+        try:
+            with engine.connect() as connection:
+                # committing after each revision keeps the progress of long upgrades
+                context.configure(connection=connection, target_metadata=db.metadata, render_item=_render_item,
+                                  transaction_per_migration=True, on_version_apply=_print_step(name), shard=shard,
+                                  batch_size=attributes.get('batch_size'), batch_delay=attributes.get('batch_delay'))
+                with context.begin_transaction():
+                    context.run_migrations()
+        finally:
+            engine.dispose()
+
+
+run_migrations()
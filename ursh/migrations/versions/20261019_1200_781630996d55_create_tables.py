@@ -0,0 +1,88 @@
+"""Create tables
+
+Revision ID: 781630996d55
+Revises:
+Create Date: 2026-10-19 12:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+from sqlalchemy_utc import UtcDateTime
+
+from ursh.util.migrations import is_shard
+
+# revision identifiers, used by Alembic.
+revision = '781630996d55'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+_JSON = sa.JSON().with_variant(postgresql.JSONB(), 'postgresql')
+_UUID = sa.String().with_variant(postgresql.UUID(), 'postgresql')
+
+
+def _has_table(name):
+    # databases set up using `ursh db create` before there were migrations already have the tables,
+    # which is why they are created the way they were back then and updated by later revisions
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not is_shard() and not _has_table('tokens'):
+        op.create_table(
+            'tokens',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('api_key', _UUID, nullable=True),
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('is_admin', sa.Boolean(), nullable=False),
+            sa.Column('is_blocked', sa.Boolean(), nullable=False),
+            sa.Column('token_uses', sa.Integer(), nullable=False),
+            sa.Column('last_access', UtcDateTime(), nullable=False),
+            sa.Column('callback_url', sa.String(), nullable=True),
+            sa.PrimaryKeyConstraint('id', name=op.f('pk_tokens')),
+            sa.UniqueConstraint('name', name=op.f('uq_tokens_name')),
+        )
+        op.create_index(op.f('ix_uq_tokens_api_key'), 'tokens', ['api_key'], unique=True)
+    if not _has_table('urls'):
+        # the tokens are not in the same database as the urls in a shard
+        foreign_keys = [] if is_shard() else [
+            sa.ForeignKeyConstraint(['token_id'], ['tokens.id'], name=op.f('fk_urls_token_id_tokens')),
+        ]
+        op.create_table(
+            'urls',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('shortcut', sa.String(), nullable=True),
+            sa.Column('url', sa.String(), nullable=False),
+            sa.Column('token_id', sa.Integer(), nullable=False),
+            sa.Column('is_custom', sa.Boolean(), nullable=False),
+            sa.Column('meta', _JSON, nullable=False),
+            sa.PrimaryKeyConstraint('id', name=op.f('pk_urls')),
+            *foreign_keys,
+        )
+        op.create_index(op.f('ix_uq_urls_shortcut'), 'urls', ['shortcut'], unique=True)
+    if not is_shard() and not _has_table('idempotency_keys'):
+        op.create_table(
+            'idempotency_keys',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('token_id', sa.Integer(), nullable=False),
+            sa.Column('key', sa.String(), nullable=False),
+            sa.Column('request_hash', sa.String(), nullable=False),
+            sa.Column('status_code', sa.Integer(), nullable=True),
+            sa.Column('response', _JSON, nullable=True),
+            sa.Column('created_at', UtcDateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['token_id'], ['tokens.id'], name=op.f('fk_idempotency_keys_token_id_tokens'),
+                                    ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('id', name=op.f('pk_idempotency_keys')),
+            sa.UniqueConstraint('token_id', 'key', name=op.f('uq_idempotency_keys_token_id_key')),
+        )
+        op.create_index(op.f('ix_idempotency_keys_created_at'), 'idempotency_keys', ['created_at'])
+
+
+def downgrade():
+    if not is_shard():
+        op.drop_table('idempotency_keys')
+    op.drop_table('urls')
+    if not is_shard():
+        op.drop_table('tokens')
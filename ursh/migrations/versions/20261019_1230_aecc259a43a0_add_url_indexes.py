@@ -0,0 +1,25 @@
+"""Add indexes for looking up urls by target and metadata
+
+Revision ID: aecc259a43a0
+Revises: 781630996d55
+Create Date: 2026-10-19 12:30:00.000000
+"""
+
+from ursh.util.migrations import create_index_concurrently, drop_index_concurrently
+
+# revision identifiers, used by Alembic.
+revision = 'aecc259a43a0'
+down_revision = '781630996d55'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # target urls may be longer than what fits into a btree index entry
+    create_index_concurrently('ix_urls_url', 'urls', ['url'], postgresql_using='hash')
+    create_index_concurrently('ix_urls_meta', 'urls', ['meta'], postgresql_using='gin')
+
+
+def downgrade():
+    drop_index_concurrently('ix_urls_meta', 'urls')
+    drop_index_concurrently('ix_urls_url', 'urls')
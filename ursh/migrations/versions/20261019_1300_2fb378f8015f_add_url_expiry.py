@@ -0,0 +1,29 @@
+"""Add url expiry
+
+Revision ID: 2fb378f8015f
+Revises: aecc259a43a0
+Create Date: 2026-10-19 13:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy_utc import UtcDateTime
+
+from ursh.util.migrations import create_index_concurrently, drop_index_concurrently
+
+# revision identifiers, used by Alembic.
+revision = '2fb378f8015f'
+down_revision = 'aecc259a43a0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('urls', sa.Column('expires_at', UtcDateTime(), nullable=True))
+    create_index_concurrently('ix_urls_expires_at', 'urls', ['expires_at'],
+                              postgresql_where=sa.text('expires_at IS NOT NULL'))
+
+
+def downgrade():
+    drop_index_concurrently('ix_urls_expires_at', 'urls')
+    op.drop_column('urls', 'expires_at')
@@ -0,0 +1,23 @@
+"""Index url owners
+
+Revision ID: 22cf6d953e01
+Revises: 2fb378f8015f
+Create Date: 2026-10-19 13:30:00.000000
+"""
+
+from ursh.util.migrations import create_index_concurrently, drop_index_concurrently
+
+# revision identifiers, used by Alembic.
+revision = '22cf6d953e01'
+down_revision = '2fb378f8015f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # needed to list or delete the urls of a token, and for deleting tokens without scanning all urls
+    create_index_concurrently('ix_urls_token_id', 'urls', ['token_id'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_urls_token_id', 'urls')
@@ -0,0 +1,45 @@
+"""Add job queue
+
+Revision ID: 5b0e4c7d9a21
+Revises: 22cf6d953e01
+Create Date: 2026-10-19 14:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+from sqlalchemy_utc import UtcDateTime
+
+from ursh.util.migrations import is_shard
+
+# revision identifiers, used by Alembic.
+revision = '5b0e4c7d9a21'
+down_revision = '22cf6d953e01'
+branch_labels = None
+depends_on = None
+
+
+_JSON = sa.JSON().with_variant(postgresql.JSONB(), 'postgresql')
+
+
+def upgrade():
+    if is_shard():
+        return
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('payload', _JSON, nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('run_at', UtcDateTime(), nullable=False),
+        sa.Column('failed_at', UtcDateTime(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('created_at', UtcDateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_jobs')),
+    )
+    op.create_index(op.f('ix_jobs_run_at'), 'jobs', ['run_at'], postgresql_where=sa.text('failed_at IS NULL'))
+
+
+def downgrade():
+    if not is_shard():
+        op.drop_table('jobs')
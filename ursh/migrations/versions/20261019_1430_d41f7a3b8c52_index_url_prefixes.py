@@ -0,0 +1,27 @@
+"""Index url prefixes
+
+Revision ID: d41f7a3b8c52
+Revises: 5b0e4c7d9a21
+Create Date: 2026-10-19 14:30:00.000000
+"""
+
+import sqlalchemy as sa
+
+from ursh.util.migrations import create_index_concurrently, drop_index_concurrently
+
+# revision identifiers, used by Alembic.
+revision = 'd41f7a3b8c52'
+down_revision = '5b0e4c7d9a21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # needed to find the urls pointing to a site when rewriting them in bulk
+    create_index_concurrently('ix_urls_url_prefix', 'urls',
+                              [sa.func.substr(sa.column('url'), 1, 255).label('url_prefix')],
+                              postgresql_ops={'url_prefix': 'text_pattern_ops'})
+
+
+def downgrade():
+    drop_index_concurrently('ix_urls_url_prefix', 'urls')
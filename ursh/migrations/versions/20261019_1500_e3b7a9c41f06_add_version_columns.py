@@ -0,0 +1,47 @@
+"""Add version columns
+
+Revision ID: e3b7a9c41f06
+Revises: d41f7a3b8c52
+Create Date: 2026-10-19 15:00:00.000000
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy_utc import UtcDateTime
+
+from ursh.util.migrations import backfill, batch_alter_table, is_shard, replace_index_concurrently, set_not_null
+
+# revision identifiers, used by Alembic.
+revision = 'e3b7a9c41f06'
+down_revision = 'd41f7a3b8c52'
+branch_labels = None
+depends_on = None
+
+
+def _add_version_column(table_name, index_name, column_name):
+    op.add_column(table_name, sa.Column('updated_at', UtcDateTime(), nullable=True))
+    backfill(table_name, {'updated_at': sa.func.now()}, where='updated_at IS NULL')
+    set_not_null(table_name, 'updated_at')
+    # including the version allows checking whether a row changed using an index-only scan
+    replace_index_concurrently(index_name, table_name, [column_name], unique=True, postgresql_include=['updated_at'])
+
+
+def upgrade():
+    if not is_shard():
+        op.add_column('tokens', sa.Column('last_write', UtcDateTime(), nullable=True))
+        _add_version_column('tokens', 'ix_uq_tokens_api_key', 'api_key')
+    _add_version_column('urls', 'ix_uq_urls_shortcut', 'shortcut')
+
+
+def _drop_version_column(table_name, index_name, column_name):
+    replace_index_concurrently(index_name, table_name, [column_name], unique=True)
+    with batch_alter_table(table_name) as batch_op:
+        batch_op.drop_column('updated_at')
+
+
+def downgrade():
+    _drop_version_column('urls', 'ix_uq_urls_shortcut', 'shortcut')
+    if not is_shard():
+        _drop_version_column('tokens', 'ix_uq_tokens_api_key', 'api_key')
+        with batch_alter_table('tokens') as batch_op:
+            batch_op.drop_column('last_write')
@@ -10,19 +10,30 @@ from ursh import db
 
 ALPHABET_MANUAL = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ-'
 ALPHABET_RESTRICTED = '23456789bcdfghjkmnpqrstvwxyzBCDFGHJKLMNPQRSTVWXYZ'
+# the number of characters of target urls which are indexed for prefix searches
+URL_PREFIX_INDEX_LENGTH = 255
+
+# the postgres-specific types are only used on postgres so the models also work with sqlite
+_JSON = db.JSON().with_variant(JSONB(), 'postgresql')
+_UUID = db.String().with_variant(UUID(), 'postgresql')
 
 
 class Token(db.Model):
     __tablename__ = 'tokens'
+    # including the version allows checking whether a token changed using an index-only scan
+    __table_args__ = (db.Index(None, 'api_key', unique=True, postgresql_include=['updated_at']),)
 
     id = db.Column(db.Integer, primary_key=True)
-    api_key = db.Column(UUID, unique=True, index=True, default=lambda: str(uuid4()))
+    api_key = db.Column(_UUID, default=lambda: str(uuid4()))
     name = db.Column(db.String, nullable=False, unique=True)
     is_admin = db.Column(db.Boolean, nullable=False, default=False)
     is_blocked = db.Column(db.Boolean, nullable=False, default=False)
     token_uses = db.Column(db.Integer, nullable=False, default=0)
     last_access = db.Column(UtcDateTime, nullable=False, default=lambda: datetime.now(tz=UTC))
+    last_write = db.Column(UtcDateTime, nullable=True)
     callback_url = db.Column(db.String, nullable=True)
+    updated_at = db.Column(UtcDateTime, nullable=False, default=lambda: datetime.now(tz=UTC),
+                           onupdate=lambda: datetime.now(tz=UTC))
 
     urls = db.relationship('URL', back_populates='token')
 
@@ -32,13 +43,23 @@ class Token(db.Model):
 
 class URL(db.Model):
     __tablename__ = 'urls'
+    # including the version allows checking whether a url changed using an index-only scan
+    __table_args__ = (db.Index(None, 'shortcut', unique=True, postgresql_include=['updated_at']),
+                      # target urls may be longer than what fits into a btree index entry
+                      db.Index(None, 'url', postgresql_using='hash'),
+                      db.Index(None, 'meta', postgresql_using='gin'),
+                      # most urls never expire, so there is no need to index them
+                      db.Index(None, 'expires_at', postgresql_where=db.text('expires_at IS NOT NULL')))
 
     id = db.Column(db.Integer, primary_key=True)
-    shortcut = db.Column(db.String, unique=True, index=True, default=lambda: generate_shortcut())
+    shortcut = db.Column(db.String, default=lambda: generate_shortcut())
     url = db.Column(db.String, nullable=False)
-    token_id = db.Column(db.ForeignKey('tokens.id'), nullable=False)
+    token_id = db.Column(db.ForeignKey('tokens.id'), nullable=False, index=True)
     is_custom = db.Column(db.Boolean, default=False, nullable=False)
-    meta = db.Column(JSONB, default={}, nullable=False)
+    meta = db.Column(_JSON, default={}, nullable=False)
+    expires_at = db.Column(UtcDateTime, nullable=True)
+    updated_at = db.Column(UtcDateTime, nullable=False, default=lambda: datetime.now(tz=UTC),
+                           onupdate=lambda: datetime.now(tz=UTC))
 
     token = db.relationship('Token', back_populates='urls')
 
@@ -46,10 +67,67 @@ class URL(db.Model):
         return f'<URL({self.id}, {self.shortcut}): {self.url}>'
 
 
+# long urls do not fit into a btree index entry, so only their beginning is indexed; the
+# operator class makes it usable for `LIKE 'prefix%'` conditions regardless of the collation
+db.Index('ix_urls_url_prefix', db.func.substr(URL.url, 1, URL_PREFIX_INDEX_LENGTH).label('url_prefix'),
+         postgresql_ops={'url_prefix': 'text_pattern_ops'})
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (db.UniqueConstraint('token_id', 'key'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    token_id = db.Column(db.ForeignKey('tokens.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String, nullable=False)
+    request_hash = db.Column(db.String, nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    response = db.Column(_JSON, nullable=True)
+    created_at = db.Column(UtcDateTime, nullable=False, index=True, default=lambda: datetime.now(tz=UTC))
+
+    def __repr__(self):
+        return f'<IdempotencyKey({self.id}, {self.token_id}): {self.key}>'
+
+
+class Job(db.Model):
+    """A job queued to be run by ``ursh worker``.
+
+    Jobs which are due have a `run_at` in the past.  Claiming a job moves
+    `run_at` forward by the visibility timeout of its type, so it is run
+    again if the worker handling it dies, and a failed job is scheduled
+    to be retried later the same way.  Jobs are deleted once they have
+    succeeded, while jobs which failed too often are kept with
+    `failed_at` set.
+    """
+
+    __tablename__ = 'jobs'
+    # failed jobs are never claimed again, so there is no need to index them
+    __table_args__ = (db.Index(None, 'run_at', postgresql_where=db.text('failed_at IS NULL')),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    type = db.Column(db.String, nullable=False)
+    payload = db.Column(_JSON, default={}, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(UtcDateTime, nullable=False, default=lambda: datetime.now(tz=UTC))
+    failed_at = db.Column(UtcDateTime, nullable=True)
+    last_error = db.Column(db.String, nullable=True)
+    created_at = db.Column(UtcDateTime, nullable=False, default=lambda: datetime.now(tz=UTC))
+
+    def __repr__(self):
+        return f'<Job({self.id}, {self.type}): {self.payload}>'
+
+
 def generate_shortcut():
+    while True:
+        candidate = generate_shortcut_candidate()
+        if not URL.query.filter_by(shortcut=candidate).count():
+            return candidate
+
+
+def generate_shortcut_candidate():
+    """Generate a random shortcut which may already be in use."""
     shortcut_length = current_app.config['URL_LENGTH']
     while True:
         candidate = ''.join(choices(ALPHABET_RESTRICTED, k=shortcut_length))
-        if (not URL.query.filter_by(shortcut=candidate).count()
-                and candidate not in current_app.config.get('BLACKLISTED_URLS')):
+        if candidate not in current_app.config.get('BLACKLISTED_URLS'):
             return candidate
@@ -1,9 +1,10 @@
 import posixpath
+from datetime import UTC
 from urllib.parse import urlparse
 
 from flask import current_app
 from flask_marshmallow import Schema
-from marshmallow import ValidationError, fields, validates
+from marshmallow import ValidationError, fields, validate, validates, validates_schema
 from werkzeug.exceptions import BadRequest, HTTPException
 from werkzeug.routing import RequestRedirect
 
@@ -45,6 +46,8 @@ class URLSchema(SchemaBase):
     url = fields.URL(description='The original URL (the short URL target)')
     short_url = fields.Method('_get_short_url', description='The short URL')
     meta = fields.Dict(description='Additional metadata (provided on short URL creation)')
+    expires_at = fields.AwareDateTime(default_timezone=UTC, allow_none=True,
+                                      description='The time after which the short URL stops working')
     owner = fields.Str(attribute='token.name', description='The name of the token than created the short URL')
     allow_reuse = fields.Boolean(load_only=True, default=False)
 
@@ -52,6 +55,49 @@ class URLSchema(SchemaBase):
         return posixpath.join(current_app.config['REDIRECTION_HOST'], obj.shortcut)
 
 
+class URLRewriteSchema(SchemaBase):
+    """Schema class to validate bulk rewrites of URL targets."""
+
+    from_prefix = fields.URL(required=True, description='The beginning of the URLs to rewrite')
+    to_prefix = fields.URL(required=True, description='The new beginning of the URLs')
+    dry_run = fields.Boolean(load_default=False, description='Only count the URLs which would be rewritten')
+    batch_size = fields.Int(load_default=1000, validate=validate.Range(min=1),
+                            description='The number of URLs rewritten per transaction')
+    delay = fields.Float(load_default=0, validate=validate.Range(min=0),
+                         description='The number of seconds to wait between two batches')
+
+    @validates_schema
+    def validate_prefixes(self, data, **kwargs):
+        if data.get('from_prefix') == data.get('to_prefix'):
+            raise ValidationError('The prefixes must be different.', 'to_prefix')
+
+
+class ProfilingSettingsSchema(SchemaBase):
+    """Schema class to validate the SQL profiling settings."""
+
+    enabled = fields.Boolean(description='Log the number of queries and the database time of each request')
+    slow_query_threshold = fields.Int(allow_none=True, validate=validate.Range(min=0),
+                                      description='Log queries taking longer than this many milliseconds')
+    explain_rate = fields.Float(validate=validate.Range(min=0, max=1),
+                                description='The fraction of slow queries logged with their query plan')
+
+
+class RequestProfileSchema(SchemaBase):
+    """Schema class to validate the parameters of a request profile."""
+
+    endpoint = fields.Str(allow_none=True, load_default=None,
+                          description='The endpoint whose requests are profiled (e.g. "redirection.redirect_to_url")')
+    requests = fields.Int(load_default=10, validate=validate.Range(min=1, max=1000),
+                          description='The number of requests to profile')
+    cpu = fields.Boolean(load_default=True, description='Profile the CPU usage of the requests')
+    memory = fields.Boolean(load_default=False, description='Trace the memory allocated by the requests')
+
+    @validates('endpoint')
+    def validate_endpoint(self, data):
+        if data is not None and data not in current_app.view_functions:
+            raise ValidationError('Unknown endpoint.')
+
+
 class ShortcutSchemaManual(SchemaBase):
     """Validator for user-specified shortcuts (i.e. all requests except POST)."""
 
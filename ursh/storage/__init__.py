@@ -0,0 +1,7 @@
+from ursh.storage.base import Storage, TokenInUseError
+from ursh.storage.core import BACKENDS, get_storage
+from ursh.storage.memory import MemoryStorage
+from ursh.storage.sharded import ShardedSQLStorage
+from ursh.storage.sql import SQLStorage
+
+__all__ = ('BACKENDS', 'MemoryStorage', 'SQLStorage', 'ShardedSQLStorage', 'Storage', 'TokenInUseError', 'get_storage')
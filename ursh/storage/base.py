@@ -0,0 +1,224 @@
+from uuid import UUID
+
+
+class TokenInUseError(Exception):
+    """Raised when deleting a token which still owns URLs."""
+
+
+class Storage:
+    """Base class for storage backends.
+
+    A backend provides access to URLs and tokens.  All of them return
+    `URL` and `Token` objects, but only the SQL backend persists them
+    in a database.
+    """
+
+    #: Whether the backend can store idempotency keys, which are needed
+    #: to handle requests containing an ``Idempotency-Key`` header
+    supports_idempotency_keys = False
+    #: Whether the backend can store queued jobs; without it jobs are
+    #: run right away when they are queued
+    supports_jobs = False
+
+    def init_app(self, app):
+        """Initialize the backend for an application."""
+
+    def create_all(self):
+        """Create the database structure needed by the backend."""
+
+    def commit(self):
+        """Commit the changes made so far."""
+
+    def rollback(self):
+        """Discard the changes made since the last commit."""
+
+    def get_url(self, shortcut):
+        """Get the URL with the given shortcut or ``None``."""
+        raise NotImplementedError
+
+    def get_url_target(self, shortcut):
+        """Get only the target of the URL with the given shortcut.
+
+        :return: A ``(target, expires_at)`` tuple or ``None`` if the
+                 shortcut does not exist
+        """
+        raise NotImplementedError
+
+    def get_url_owner(self, shortcut):
+        """Get the id of the token owning a shortcut or ``None``."""
+        raise NotImplementedError
+
+    def get_url_version(self, shortcut):
+        """Get the last modification time of a URL or ``None``."""
+        raise NotImplementedError
+
+    def create_url(self, values):
+        """Create a new URL.
+
+        :param values: A dict containing the attributes of the new URL,
+                       including its shortcut and `token_id`.
+        :return: The new `URL` or ``None`` if the shortcut already exists
+        """
+        raise NotImplementedError
+
+    def create_urls(self, values_list):
+        """Create many URLs at once.
+
+        :param values_list: A list of dicts as used by `create_url`.
+        :return: A list of the created URLs; shortcuts which already
+                 exist are skipped.
+        """
+        raise NotImplementedError
+
+    def get_or_create_url(self, values):
+        """Get an existing non-custom URL with the same target and expiry or create it.
+
+        :param values: A dict as used by `create_url`.
+        :return: The existing or new `URL` or ``None`` if there is none
+                 yet and the shortcut of the new one already exists.
+        """
+        raise NotImplementedError
+
+    def update_url(self, shortcut, values, merge_meta=False):
+        """Update an existing URL.
+
+        :param shortcut: The shortcut of the URL to update.
+        :param values: A dict containing the new `url` and/or `meta`.
+        :param merge_meta: Whether `meta` is a JSON merge patch (RFC 7396)
+                           to apply instead of the new metadata.
+        :return: The updated `URL` or ``None`` if it does not exist
+        """
+        raise NotImplementedError
+
+    def delete_url(self, shortcut):
+        """Delete a URL.
+
+        :return: The deleted `URL` or ``None`` if it does not exist
+        """
+        raise NotImplementedError
+
+    def delete_expired_urls(self, now, limit):
+        """Delete URLs which have expired.
+
+        :param now: The current time.
+        :param limit: The maximum number of URLs to delete, which keeps
+                      the transaction short when many URLs expired.
+        :return: The number of deleted URLs
+        """
+        raise NotImplementedError
+
+    def delete_token_urls(self, token_id, limit):
+        """Delete URLs owned by a token.
+
+        :param token_id: The id of the token.
+        :param limit: The maximum number of URLs to delete.
+        :return: A list containing the shortcuts of the deleted URLs
+        """
+        raise NotImplementedError
+
+    def transfer_token_urls(self, token_id, new_token_id, limit):
+        """Transfer URLs owned by a token to another token.
+
+        :param token_id: The id of the token currently owning the URLs.
+        :param new_token_id: The id of the token receiving the URLs.
+        :param limit: The maximum number of URLs to transfer.
+        :return: The number of transferred URLs
+        """
+        raise NotImplementedError
+
+    def rewrite_url_prefix(self, old_prefix, new_prefix, limit):
+        """Replace the beginning of the target of URLs starting with a prefix.
+
+        If the new prefix starts with the old one, URLs which already start
+        with the new prefix are skipped, so the URLs rewritten by one call
+        are not rewritten again by the next one.
+
+        :param old_prefix: The prefix to replace.
+        :param new_prefix: The prefix replacing it.
+        :param limit: The maximum number of URLs to rewrite.
+        :return: A list containing the shortcuts of the rewritten URLs
+        """
+        raise NotImplementedError
+
+    def filter_urls(self, url=None, token_id=None, meta=None, url_prefix=None, with_version=True):
+        """Get all URLs matching the given criteria.
+
+        :param url: Only include URLs with this target.
+        :param token_id: Only include URLs owned by this token.
+        :param meta: Only include URLs whose metadata contains this dict.
+        :param url_prefix: Only include URLs whose target starts with this.
+        :param with_version: Whether to get the number of URLs and their
+                             most recent modification time, which usually
+                             needs an additional query.
+        :return: A tuple containing the number of URLs, their most recent
+                 modification time (both ``None`` unless `with_version`
+                 is set) and an iterable of the URLs themselves.
+        """
+        raise NotImplementedError
+
+    def get_token(self, api_key):
+        """Get the token with the given API key or ``None``."""
+        raise NotImplementedError
+
+    def get_token_by_name(self, name):
+        """Get the token with the given name or ``None``."""
+        raise NotImplementedError
+
+    def get_token_version(self, api_key):
+        """Get the last modification time of a token or ``None``."""
+        raise NotImplementedError
+
+    def create_token(self, values):
+        """Create a new token.
+
+        :param values: A dict containing the attributes of the new token.
+        :return: The new `Token` or ``None`` if the name already exists
+        """
+        raise NotImplementedError
+
+    def update_token(self, api_key, values):
+        """Update an existing token.
+
+        :return: The updated `Token` or ``None`` if it does not exist
+        """
+        raise NotImplementedError
+
+    def delete_token(self, api_key):
+        """Delete a token.
+
+        :return: The deleted `Token` or ``None`` if it does not exist
+        :raise TokenInUseError: if the token still owns URLs
+        """
+        raise NotImplementedError
+
+    def record_token_access(self, token, now, write):
+        """Record that a token has been used to make a request.
+
+        This does not change the version of the token returned by
+        `get_token_version`, since it happens on every request and
+        would otherwise invalidate all cached copies of the token.
+
+        :param token: The `Token` used to make the request.
+        :param now: The time of the request.
+        :param write: Whether the request may modify data.
+        """
+        raise NotImplementedError
+
+    def filter_tokens(self, with_version=True, **filters):
+        """Get all tokens whose attributes match the given values.
+
+        :param with_version: Like for `filter_urls`.
+        :return: A tuple like the one returned by `filter_urls`.
+        """
+        raise NotImplementedError
+
+
+def normalize_api_key(api_key):
+    """Convert an API key to its canonical form.
+
+    :return: The API key or ``None`` if it is not a valid UUID.
+    """
+    try:
+        return str(UUID(api_key))
+    except (TypeError, ValueError):
+        return None
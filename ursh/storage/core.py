@@ -0,0 +1,16 @@
+from flask import current_app
+
+from ursh.storage.memory import MemoryStorage
+from ursh.storage.sharded import ShardedSQLStorage
+from ursh.storage.sql import SQLStorage
+
+BACKENDS = {
+    'sql': SQLStorage,
+    'sharded': ShardedSQLStorage,
+    'memory': MemoryStorage,
+}
+
+
+def get_storage():
+    """Get the storage backend of the current application."""
+    return current_app.extensions['storage']
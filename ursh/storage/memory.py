@@ -0,0 +1,212 @@
+from copy import deepcopy
+from datetime import UTC, datetime
+from itertools import count
+from threading import RLock
+
+from ursh.models import URL, Token
+from ursh.storage.base import Storage, TokenInUseError, normalize_api_key
+
+
+class MemoryStorage(Storage):
+    """Keep everything in memory.
+
+    This is meant for tests, benchmarks and throwaway instances: nothing
+    is persisted, each process has its own data, and since changes take
+    effect immediately `rollback` cannot undo them.
+    """
+
+    def __init__(self):
+        self._urls = {}
+        self._tokens = {}
+        self._ids = count(1)
+        self._lock = RLock()
+
+    def get_url(self, shortcut):
+        return self._urls.get(shortcut)
+
+    def get_url_target(self, shortcut):
+        url = self._urls.get(shortcut)
+        return (url.url, url.expires_at) if url is not None else None
+
+    def get_url_owner(self, shortcut):
+        url = self._urls.get(shortcut)
+        return url.token_id if url is not None else None
+
+    def get_url_version(self, shortcut):
+        url = self._urls.get(shortcut)
+        return url.updated_at if url is not None else None
+
+    def create_url(self, values):
+        with self._lock:
+            if values['shortcut'] in self._urls:
+                return None
+            url = _create_object(URL, values, id=next(self._ids), token=self._tokens[values['token_id']])
+            self._urls[url.shortcut] = url
+            return url
+
+    def create_urls(self, values_list):
+        with self._lock:
+            return [url for values in values_list if (url := self.create_url(values)) is not None]
+
+    def get_or_create_url(self, values):
+        with self._lock:
+            existing = sorted((url for url in self._urls.values()
+                               if url.url == values['url'] and url.expires_at == values.get('expires_at')
+                               and not url.is_custom),
+                              key=lambda url: url.shortcut)
+            return existing[0] if existing else self.create_url(values)
+
+    def update_url(self, shortcut, values, merge_meta=False):
+        with self._lock:
+            url = self._urls.get(shortcut)
+            if url is None:
+                return None
+            for key, value in values.items():
+                if key == 'meta' and merge_meta:
+                    value = _merge_patch(url.meta, value)
+                setattr(url, key, value)
+            url.updated_at = datetime.now(UTC)
+            return url
+
+    def delete_url(self, shortcut):
+        with self._lock:
+            url = self._urls.pop(shortcut, None)
+            if url is not None:
+                url.token.urls.remove(url)
+            return url
+
+    def delete_expired_urls(self, now, limit):
+        with self._lock:
+            expired = sorted((url for url in self._urls.values()
+                              if url.expires_at is not None and url.expires_at <= now),
+                             key=lambda url: url.expires_at)[:limit]
+            for url in expired:
+                self.delete_url(url.shortcut)
+            return len(expired)
+
+    def delete_token_urls(self, token_id, limit):
+        with self._lock:
+            shortcuts = [url.shortcut for url in self._urls.values() if url.token_id == token_id][:limit]
+            for shortcut in shortcuts:
+                self.delete_url(shortcut)
+            return shortcuts
+
+    def transfer_token_urls(self, token_id, new_token_id, limit):
+        with self._lock:
+            urls = [url for url in self._urls.values() if url.token_id == token_id][:limit]
+            new_token = self._tokens[new_token_id]
+            for url in urls:
+                # the relationship also moves the url to the other token's collection
+                url.token = new_token
+                url.token_id = new_token_id
+                url.updated_at = datetime.now(UTC)
+            return len(urls)
+
+    def rewrite_url_prefix(self, old_prefix, new_prefix, limit):
+        skip_prefix = new_prefix if new_prefix.startswith(old_prefix) else None
+        with self._lock:
+            urls = [url for url in self._urls.values()
+                    if url.url.startswith(old_prefix) and not (skip_prefix and url.url.startswith(skip_prefix))][:limit]
+            for url in urls:
+                url.url = new_prefix + url.url[len(old_prefix):]
+                url.updated_at = datetime.now(UTC)
+            return [url.shortcut for url in urls]
+
+    def filter_urls(self, url=None, token_id=None, meta=None, url_prefix=None, with_version=True):
+        with self._lock:
+            urls = [obj for obj in self._urls.values()
+                    if (url is None or obj.url == url)
+                    and (url_prefix is None or obj.url.startswith(url_prefix))
+                    and (token_id is None or obj.token_id == token_id)
+                    and (not meta or _json_contains(obj.meta, meta))]
+        return _get_collection(urls, with_version)
+
+    def get_token(self, api_key):
+        api_key = normalize_api_key(api_key)
+        return next((token for token in self._tokens.values() if token.api_key == api_key), None)
+
+    def get_token_by_name(self, name):
+        return next((token for token in self._tokens.values() if token.name == name), None)
+
+    def get_token_version(self, api_key):
+        token = self.get_token(api_key)
+        return token.updated_at if token is not None else None
+
+    def create_token(self, values):
+        with self._lock:
+            if self.get_token_by_name(values['name']) is not None:
+                return None
+            token = _create_object(Token, values, id=next(self._ids))
+            self._tokens[token.id] = token
+            return token
+
+    def update_token(self, api_key, values):
+        with self._lock:
+            token = self.get_token(api_key)
+            if token is None:
+                return None
+            for key, value in values.items():
+                setattr(token, key, value)
+            token.updated_at = datetime.now(UTC)
+            return token
+
+    def delete_token(self, api_key):
+        with self._lock:
+            token = self.get_token(api_key)
+            if token is None:
+                return None
+            if any(url.token_id == token.id for url in self._urls.values()):
+                raise TokenInUseError
+            return self._tokens.pop(token.id)
+
+    def record_token_access(self, token, now, write):
+        with self._lock:
+            token.token_uses += 1
+            token.last_access = now
+            if write:
+                token.last_write = now
+
+    def filter_tokens(self, with_version=True, **filters):
+        with self._lock:
+            tokens = [token for token in self._tokens.values()
+                      if all(getattr(token, key) == value for key, value in filters.items())]
+        return _get_collection(tokens, with_version)
+
+
+def _create_object(model, values, **kwargs):
+    obj = model(**values, **kwargs)
+    # column defaults are usually applied when inserting a row, so we need to do it ourselves
+    for column in model.__table__.columns:
+        default = column.default
+        if default is None or default.is_sequence or getattr(obj, column.key) is not None:
+            continue
+        setattr(obj, column.key, default.arg(None) if default.is_callable else deepcopy(default.arg))
+    return obj
+
+
+def _get_collection(objs, with_version):
+    if not with_version:
+        return None, None, objs
+    return len(objs), max((obj.updated_at for obj in objs), default=None), objs
+
+
+def _merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = _merge_patch(result.get(key), value)
+    return result
+
+
+def _json_contains(value, other):
+    # same semantics as postgres' `@>` operator
+    if isinstance(other, dict):
+        return isinstance(value, dict) and all(key in value and _json_contains(value[key], item)
+                                               for key, item in other.items())
+    elif isinstance(other, list):
+        return isinstance(value, list) and all(any(_json_contains(x, item) for x in value) for item in other)
+    return value == other
@@ -0,0 +1,401 @@
+import hashlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask import current_app
+from flask_sqlalchemy.session import _app_ctx_id
+from sqlalchemy import ForeignKeyConstraint, MetaData, delete, exists, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, scoped_session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ursh import db
+from ursh.core.db import get_lane_engine
+from ursh.models import URL, Token
+from ursh.storage.base import TokenInUseError
+from ursh.storage.sql import FETCH_SIZE, SQLStorage, lock_reuse
+
+
+class _ShardSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        return get_lane_engine(engine, db.session.info.get('lane'))
+
+
+class ShardedSQLStorage(SQLStorage):
+    """Store URLs in several Postgres databases.
+
+    Each shortcut belongs to one of the databases in ``SQLALCHEMY_SHARD_URIS``
+    based on its hash, so looking up, creating or modifying a single URL
+    only involves that database.  Tokens and everything else are stored in
+    the main database.
+    """
+
+    def __init__(self):
+        self._sessions = []
+        self._executor = None
+
+    def init_app(self, app):
+        bind_keys = app.config['SHARD_BIND_KEYS']
+        if not bind_keys:
+            raise ValueError('The sharded storage backend requires SQLALCHEMY_SHARD_URIS')
+        self._sessions = [scoped_session(self._make_session_factory(key), scopefunc=_app_ctx_id) for key in bind_keys]
+        self._executor = ThreadPoolExecutor(len(bind_keys), thread_name_prefix='ursh-shards')
+        app.teardown_appcontext(self._remove_sessions)
+
+    def _make_session_factory(self, bind_key):
+        def _make_session():
+            # expiring the urls on commit would make them load their token from the shard
+            return _ShardSession(bind=db.engines[bind_key], autoflush=False, expire_on_commit=False)
+        return _make_session
+
+    def _remove_sessions(self, exc=None):
+        for session in self._sessions:
+            session.remove()
+
+    def _get_url_session(self, shortcut):
+        return self._sessions[get_shard_index(shortcut, len(self._sessions))]
+
+    def _get_shard_engines(self):
+        return [db.engines[key] for key in current_app.config['SHARD_BIND_KEYS']]
+
+    def _attach_tokens(self, urls):
+        # the tokens live in a different database, so they cannot be loaded using the relationship
+        token_ids = {url.token_id for url in urls} - {None}
+        tokens = {token.id: token for token in Token.query.filter(Token.id.in_(token_ids))} if token_ids else {}
+        for url in urls:
+            set_committed_value(url, 'token', tokens.get(url.token_id))
+        return urls
+
+    def _attach_token(self, url):
+        if url is not None:
+            self._attach_tokens([url])
+        return url
+
+    def create_all(self):
+        super().create_all()
+        # a copy of the table without the foreign key, since the tokens are not in the same database
+        metadata = MetaData(naming_convention=db.Model.metadata.naming_convention)
+        Token.__table__.to_metadata(metadata)
+        table = URL.__table__.to_metadata(metadata)
+        for constraint in [c for c in table.constraints if isinstance(c, ForeignKeyConstraint)]:
+            table.constraints.remove(constraint)
+        for engine in self._get_shard_engines():
+            metadata.create_all(engine, tables=[table])
+
+    def commit(self):
+        # the shards come first, so e.g. an idempotency key is not marked as used
+        # unless the url it refers to has been created as well
+        for session in self._sessions:
+            if session.registry.has():
+                session.commit()
+        super().commit()
+
+    def rollback(self):
+        for session in self._sessions:
+            if session.registry.has():
+                session.rollback()
+        super().rollback()
+
+    def _get_other_url_sessions(self, shortcut):
+        """Get the sessions of all other locations a URL may be in while rebalancing.
+
+        This includes the main database unless it is one of the shards,
+        since URLs are moved from there when switching to sharded storage.
+        """
+        target = self._get_url_session(shortcut)
+        sessions = [session for session in self._sessions if session is not target]
+        if not self._is_main_db_shard():
+            sessions.insert(0, db.session)
+        return sessions
+
+    def _is_main_db_shard(self):
+        shard_urls = {str(session.get_bind(URL.__mapper__).url) for session in self._sessions}
+        return str(db.session.get_bind(URL.__mapper__).url) in shard_urls
+
+    def _find_misplaced(self, shortcut, query):
+        """Look up a URL which may not have been moved to its shard yet.
+
+        :return: A ``(session, row)`` tuple, or ``None`` if the URL was
+                 not found or no rebalancing is in progress.
+        """
+        if not current_app.config['SHARD_REBALANCING']:
+            return None
+        return next(((session, row) for session in self._get_other_url_sessions(shortcut)
+                     if (row := session.execute(query).one_or_none()) is not None),
+                    None)
+
+    def _move_misplaced_url(self, shortcut):
+        """Move a URL to its shard before modifying it while rebalancing.
+
+        Otherwise creating a URL could add a second one with the same
+        shortcut, and changes to a URL which has not been moved yet would
+        not be made at all.  The URL is moved as part of the current
+        transaction and stays locked in its previous location until then,
+        so `rebalance` cannot move it at the same time.
+        """
+        found = self._find_misplaced(shortcut, select(URL.__table__).filter_by(shortcut=shortcut).with_for_update())
+        if found is None:
+            return
+        source_session, row = found
+        values = {key: value for key, value in row._mapping.items() if key != 'id'}
+        stmt = (insert(URL.__table__)
+                .values(values)
+                .on_conflict_do_nothing(index_elements=['shortcut'])
+                .returning(URL.shortcut))
+        # if it already exists, `rebalance` copied it in the meantime and deletes it once the lock is released
+        if self._get_url_session(shortcut).execute(stmt).scalar() is not None:
+            source_session.execute(delete(URL.__table__).filter_by(id=row.id))
+
+    def get_url(self, shortcut):
+        url = super().get_url(shortcut)
+        if url is None and (found := self._find_misplaced(shortcut, select(URL).filter_by(shortcut=shortcut))):
+            url = found[1][0]
+        return self._attach_token(url)
+
+    def get_url_target(self, shortcut):
+        target = super().get_url_target(shortcut)
+        if target is None and (found := self._find_misplaced(shortcut, select(URL.url, URL.expires_at)
+                                                             .filter_by(shortcut=shortcut))):
+            target = found[1]
+        return target
+
+    def get_url_owner(self, shortcut):
+        token_id = super().get_url_owner(shortcut)
+        if token_id is None and (found := self._find_misplaced(shortcut, select(URL.token_id)
+                                                               .filter_by(shortcut=shortcut))):
+            token_id = found[1].token_id
+        return token_id
+
+    def get_url_version(self, shortcut):
+        updated_at = super().get_url_version(shortcut)
+        if updated_at is None and (found := self._find_misplaced(shortcut, select(URL.updated_at)
+                                                                 .filter_by(shortcut=shortcut))):
+            updated_at = found[1].updated_at
+        return updated_at
+
+    def create_url(self, values):
+        self._move_misplaced_url(values['shortcut'])
+        return self._attach_token(super().create_url(values))
+
+    def create_urls(self, values_list):
+        shards = [[] for _ in self._sessions]
+        for values in values_list:
+            shards[get_shard_index(values['shortcut'], len(shards))].append(values)
+        return self._attach_tokens([url
+                                    for session, shard_values in zip(self._sessions, shards, strict=True)
+                                    for url in self._create_urls(session, shard_values)])
+
+    def get_or_create_url(self, values):
+        lock_reuse(values['url'])
+        query = (select(URL)
+                 .where(URL.url == values['url'], URL.expires_at == values.get('expires_at'), ~URL.is_custom)
+                 .order_by(URL.shortcut)
+                 .limit(1))
+        existing = [url for session in self._sessions if (url := session.execute(query).scalar()) is not None]
+        if existing:
+            return self._attach_token(min(existing, key=lambda url: url.shortcut))
+        return self.create_url(values)
+
+    def update_url(self, shortcut, values, merge_meta=False):
+        self._move_misplaced_url(shortcut)
+        return self._attach_token(super().update_url(shortcut, values, merge_meta=merge_meta))
+
+    def delete_url(self, shortcut):
+        self._move_misplaced_url(shortcut)
+        return super().delete_url(shortcut)
+
+    def delete_expired_urls(self, now, limit):
+        return sum(self._delete_expired_urls(session, now, limit) for session in self._sessions)
+
+    def delete_token_urls(self, token_id, limit):
+        shortcuts = []
+        for session in self._sessions:
+            shortcuts += self._delete_token_urls(session, token_id, limit - len(shortcuts))
+            if len(shortcuts) >= limit:
+                break
+        return shortcuts
+
+    def transfer_token_urls(self, token_id, new_token_id, limit):
+        count = 0
+        for session in self._sessions:
+            count += self._transfer_token_urls(session, token_id, new_token_id, limit - count)
+            if count >= limit:
+                break
+        return count
+
+    def rewrite_url_prefix(self, old_prefix, new_prefix, limit):
+        shortcuts = []
+        for session in self._sessions:
+            shortcuts += self._rewrite_url_prefix(session, old_prefix, new_prefix, limit - len(shortcuts))
+            if len(shortcuts) >= limit:
+                break
+        return shortcuts
+
+    def filter_urls(self, url=None, token_id=None, meta=None, url_prefix=None, with_version=True):
+        queries = [self._filter_urls(session, url, token_id, meta, url_prefix) for session in self._sessions]
+        if not with_version:
+            return None, None, self._iter_urls(queries)
+        # the aggregates are queried in parallel since they are all we need to
+        # tell whether the client's copy of the listing is still up to date
+        stmts = [query.with_entities(func.count(), func.max(URL.updated_at)).order_by(None).statement
+                 for query in queries]
+        results = list(self._executor.map(_execute_aggregate, self._get_shard_engines(), stmts))
+        count = sum(count for count, _ in results)
+        last_modified = max((last_modified for _, last_modified in results if last_modified is not None),
+                            default=None)
+        return count, last_modified, self._iter_urls(queries)
+
+    def _iter_urls(self, queries):
+        # the rows are fetched from all shards in parallel, and while the urls from one shard are being
+        # processed, the next chunk from that shard is already being fetched; the listing is unordered,
+        # so each chunk is used as soon as it is available
+        readers = [_ShardReader(query.session.get_bind(URL.__mapper__), query.statement) for query in queries]
+        pending = {self._executor.submit(reader.read): reader for reader in readers}
+        try:
+            while pending:
+                done, __ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    reader = pending.pop(future)
+                    if chunk := future.result():
+                        pending[self._executor.submit(reader.read)] = reader
+                        yield from self._attach_tokens(chunk)
+        finally:
+            # the readers must not be closed while they are still fetching rows
+            wait(pending)
+            for reader in readers:
+                reader.close()
+
+    def delete_token(self, api_key):
+        token = self.get_token(api_key)
+        if token is None:
+            return None
+        for session in self._sessions:
+            if session.registry.has():
+                session.flush()
+        if any(session.query(exists().where(URL.token_id == token.id)).scalar() for session in self._sessions):
+            raise TokenInUseError
+        return super().delete_token(api_key)
+
+    def rebalance(self, batch_size, dry_run=False, callback=None):
+        """Move URLs to the shard they belong to.
+
+        This is needed after adding shards, and also moves all URLs from
+        the main database when switching to sharded storage.  Each batch
+        is copied and committed before it is deleted from its previous
+        location, so interrupting this never loses any data.  URLs whose
+        shortcut already exists on the shard they belong to are kept in
+        their previous location and logged, since they cannot be moved
+        without losing one of them.
+
+        :param batch_size: The number of URLs to check at once.
+        :param dry_run: Only count the URLs which would be moved.
+        :param callback: A function called with the source, the number of
+                         checked URLs, the number of moved URLs and the
+                         number of URLs which could not be moved after
+                         each batch.
+        :return: The total number of URLs moved.
+        """
+        sources = list(enumerate(self._sessions))
+        if not self._is_main_db_shard():
+            sources.insert(0, (None, db.session))
+        total = 0
+        for index, session in sources:
+            checked = moved = conflicts = 0
+            last_id = 0
+            while rows := session.execute(select(URL.__table__)
+                                          .where(URL.id > last_id)
+                                          .order_by(URL.id)
+                                          .limit(batch_size)).mappings().all():
+                last_id = rows[-1]['id']
+                checked += len(rows)
+                misplaced = [row for row in rows if get_shard_index(row['shortcut'], len(self._sessions)) != index]
+                if misplaced and not dry_run:
+                    conflicting = self._move_urls(session, misplaced)
+                    if conflicting:
+                        source = 'main database' if index is None else f'shard {index}'
+                        current_app.logger.warning('Could not move URLs from %s since their shortcuts already exist '
+                                                   'on the shard they belong to: %s', source, ', '.join(conflicting))
+                    conflicts += len(conflicting)
+                    moved += len(misplaced) - len(conflicting)
+                else:
+                    moved += len(misplaced)
+                if callback:
+                    callback(index, checked, moved, conflicts)
+            total += moved
+        return total
+
+    def _move_urls(self, source_session, rows):
+        """Move URLs to their shards.
+
+        Only URLs which were actually copied are deleted from the source,
+        so a URL created with the same shortcut on the target shard in
+        the meantime never replaces the original one.
+
+        :return: The shortcuts of the URLs which could not be moved.
+        """
+        targets = {}
+        for row in rows:
+            values = {key: value for key, value in row.items() if key != 'id'}
+            targets.setdefault(get_shard_index(row['shortcut'], len(self._sessions)), []).append(values)
+        moved = set()
+        for index, values_list in targets.items():
+            session = self._sessions[index]
+            moved.update(session.execute(insert(URL.__table__).values(values_list)
+                                         .on_conflict_do_nothing(index_elements=['shortcut'])
+                                         .returning(URL.shortcut)).scalars())
+            session.commit()
+        source_session.execute(delete(URL.__table__).where(URL.id.in_([row['id'] for row in rows
+                                                                        if row['shortcut'] in moved])))
+        source_session.commit()
+        return sorted(row['shortcut'] for row in rows if row['shortcut'] not in moved)
+
+
+class _ShardReader:
+    """Fetch the URLs matching a query from a shard in chunks.
+
+    Each chunk may be fetched in a different thread, but never in more
+    than one at the same time.  The URLs are loaded using a separate
+    session, since the session of the shard belongs to the thread
+    handling the request.
+    """
+
+    def __init__(self, engine, stmt):
+        self.engine = engine
+        self.stmt = stmt
+        self.session = None
+        self.result = None
+
+    def read(self):
+        if self.result is None:
+            self.session = Session(bind=self.engine, autoflush=False)
+            self.result = self.session.execute(self.stmt, execution_options={'yield_per': FETCH_SIZE}).scalars()
+        return self.result.fetchmany(FETCH_SIZE)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+def _execute_aggregate(engine, stmt):
+    with engine.connect() as conn:
+        return conn.execute(stmt).one()
+
+
+def get_shard_index(shortcut, num_shards):
+    """Get the shard a shortcut belongs to.
+
+    This uses jump consistent hashing, so when adding a shard only the
+    URLs which now belong to the new shard need to be moved.
+
+    :param shortcut: The shortcut of the URL.
+    :param num_shards: The number of shards.
+    :return: The index of the shard.
+    """
+    key = int.from_bytes(hashlib.blake2b(shortcut.encode(), digest_size=8).digest(), 'big')
+    index = -1
+    candidate = 0
+    while candidate < num_shards:
+        index = candidate
+        key = (key * 2862933555777941757 + 1) % 2**64
+        candidate = int((index + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return index
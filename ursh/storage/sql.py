@@ -0,0 +1,299 @@
+import json
+
+from flask import current_app
+from psycopg2.errors import QueryCanceled
+from sqlalchemy import and_, delete, exists, func, literal, select, true, type_coerce, union_all, update
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from ursh import db
+from ursh.core.db import use_primary
+from ursh.models import URL, URL_PREFIX_INDEX_LENGTH, Token
+from ursh.storage.base import Storage, TokenInUseError, normalize_api_key
+from ursh.util.db import insert_unless_exists, json_merge_patch
+
+# number of rows fetched at once when iterating over a collection
+FETCH_SIZE = 1000
+# arbitrary key used to namespace the advisory locks taken when reusing urls
+_REUSE_LOCK_ID = 0x7572
+
+
+class SQLStorage(Storage):
+    """Store everything in the database configured for Flask-SQLAlchemy.
+
+    This is meant to be used with Postgres, but also works with sqlite
+    for small deployments which do not need a database server.
+    """
+
+    supports_idempotency_keys = True
+    supports_jobs = True
+
+    def _is_postgres(self, session):
+        return session.get_bind(URL.__mapper__).dialect.name == 'postgresql'
+
+    def _get_url_session(self, shortcut):
+        """Get the session used to access the URL with the given shortcut."""
+        return db.session
+
+    def create_all(self):
+        # the other binds are replicas or shards, which are not set up like the main database
+        db.create_all(bind_key=None)
+
+    def commit(self):
+        db.session.commit()
+
+    def rollback(self):
+        db.session.rollback()
+
+    def get_url(self, shortcut):
+        return self._get_url_session(shortcut).query(URL).filter_by(shortcut=shortcut).one_or_none()
+
+    def get_url_target(self, shortcut):
+        query = self._get_url_session(shortcut).query(URL.url, URL.expires_at).filter_by(shortcut=shortcut)
+        try:
+            return query.one_or_none()
+        except OperationalError as exc:
+            # a timeout is not the replica's fault and would most likely happen on the primary as well
+            if db.session.info.get('replica') is None or isinstance(exc.orig, QueryCanceled):
+                raise
+            current_app.logger.warning('Replica query failed, retrying on primary', exc_info=True)
+            db.session.rollback()
+            use_primary(replica_failed=True)
+            return query.one_or_none()
+
+    def get_url_owner(self, shortcut):
+        return self._get_url_session(shortcut).query(URL.token_id).filter_by(shortcut=shortcut).scalar()
+
+    def get_url_version(self, shortcut):
+        return self._get_url_session(shortcut).query(URL.updated_at).filter_by(shortcut=shortcut).scalar()
+
+    def create_url(self, values):
+        return insert_unless_exists(URL, values, 'shortcut', session=self._get_url_session(values['shortcut']))
+
+    def create_urls(self, values_list):
+        return self._create_urls(db.session, values_list)
+
+    def _create_urls(self, session, values_list):
+        if not values_list:
+            return []
+        if not self._is_postgres(session):
+            return [url for values in values_list
+                    if (url := insert_unless_exists(URL, values, 'shortcut', session=session)) is not None]
+        stmt = (insert(URL)
+                .values(values_list)
+                .on_conflict_do_nothing(index_elements=['shortcut'])
+                .returning(*URL.__table__.c))
+        return session.execute(select(URL).from_statement(stmt)).scalars().all()
+
+    def get_or_create_url(self, values):
+        session = db.session
+        existing = (select(URL.__table__)
+                    .where(URL.url == values['url'], URL.expires_at == values.get('expires_at'), ~URL.is_custom)
+                    .order_by(URL.shortcut)
+                    .limit(1))
+        if not self._is_postgres(session):
+            url = session.execute(select(URL).from_statement(existing)).scalar_one_or_none()
+            return url if url is not None else self.create_url(values)
+        lock_reuse(values['url'])
+        existing = existing.cte('existing')
+        inserted = (insert(URL)
+                    .from_select(list(values), select(*(literal(v, URL.__table__.c[k].type)
+                                                        for k, v in values.items()))
+                                 .where(~exists(existing.select())))
+                    .on_conflict_do_nothing(index_elements=['shortcut'])
+                    .returning(*URL.__table__.c)
+                    .cte('inserted'))
+        stmt = union_all(select(inserted), select(existing))
+        return session.execute(select(URL).from_statement(stmt)).scalar_one_or_none()
+
+    def update_url(self, shortcut, values, merge_meta=False):
+        if not merge_meta or 'meta' not in values:
+            url = self.get_url(shortcut)
+            if url is not None:
+                for key, value in values.items():
+                    setattr(url, key, value)
+            return url
+        # the new metadata is computed by the database, so concurrent patches
+        # touching different keys cannot overwrite each other
+        session = self._get_url_session(shortcut)
+        values = dict(values)
+        if self._is_postgres(session):
+            values['meta'] = json_merge_patch(URL.meta, values['meta'])
+            stmt = update(URL).where(URL.shortcut == shortcut).values(**values).returning(*URL.__table__.c)
+            query = select(URL).from_statement(stmt).execution_options(populate_existing=True)
+            return session.execute(query).scalar_one_or_none()
+        # sqlite's json_patch implements RFC 7396 as well
+        values['meta'] = func.json_patch(URL.meta, json.dumps(values['meta']))
+        session.execute(update(URL).where(URL.shortcut == shortcut).values(**values)
+                        .execution_options(synchronize_session=False))
+        query = select(URL).filter_by(shortcut=shortcut).execution_options(populate_existing=True)
+        return session.execute(query).scalar_one_or_none()
+
+    def delete_url(self, shortcut):
+        url = self.get_url(shortcut)
+        if url is not None:
+            self._get_url_session(shortcut).delete(url)
+        return url
+
+    def delete_expired_urls(self, now, limit):
+        return self._delete_expired_urls(db.session, now, limit)
+
+    def _delete_expired_urls(self, session, now, limit):
+        expired = select(URL.id).where(URL.expires_at <= now).order_by(URL.expires_at).limit(limit)
+        return session.execute(delete(URL)
+                               .where(URL.id.in_(expired.scalar_subquery()))
+                               .execution_options(synchronize_session=False)).rowcount
+
+    def delete_token_urls(self, token_id, limit):
+        return self._delete_token_urls(db.session, token_id, limit)
+
+    def _delete_token_urls(self, session, token_id, limit):
+        rows = session.execute(select(URL.id, URL.shortcut).where(URL.token_id == token_id).limit(limit)).all()
+        if rows:
+            session.execute(delete(URL)
+                            .where(URL.id.in_([id_ for id_, _ in rows]))
+                            .execution_options(synchronize_session=False))
+        return [shortcut for _, shortcut in rows]
+
+    def transfer_token_urls(self, token_id, new_token_id, limit):
+        return self._transfer_token_urls(db.session, token_id, new_token_id, limit)
+
+    def _transfer_token_urls(self, session, token_id, new_token_id, limit):
+        urls = select(URL.id).where(URL.token_id == token_id).limit(limit)
+        return session.execute(update(URL)
+                               .where(URL.id.in_(urls.scalar_subquery()))
+                               .values(token_id=new_token_id)
+                               .execution_options(synchronize_session=False)).rowcount
+
+    def rewrite_url_prefix(self, old_prefix, new_prefix, limit):
+        return self._rewrite_url_prefix(db.session, old_prefix, new_prefix, limit)
+
+    def _rewrite_url_prefix(self, session, old_prefix, new_prefix, limit):
+        condition = _url_prefix_filter(old_prefix)
+        if new_prefix.startswith(old_prefix):
+            condition = and_(condition, ~_url_prefix_filter(new_prefix))
+        rows = session.execute(select(URL.id, URL.shortcut).where(condition).limit(limit)).all()
+        if rows:
+            # checking the prefix again skips urls which have been modified concurrently
+            session.execute(update(URL)
+                            .where(URL.id.in_([id_ for id_, _ in rows]), condition)
+                            .values(url=literal(new_prefix) + func.substr(URL.url, len(old_prefix) + 1))
+                            .execution_options(synchronize_session=False))
+        return [shortcut for _, shortcut in rows]
+
+    def filter_urls(self, url=None, token_id=None, meta=None, url_prefix=None, with_version=True):
+        return _get_collection(self._filter_urls(db.session, url, token_id, meta, url_prefix), URL.updated_at,
+                               with_version)
+
+    def _filter_urls(self, session, url=None, token_id=None, meta=None, url_prefix=None):
+        query = session.query(URL)
+        if url is not None:
+            query = query.filter(URL.url == url)
+        if url_prefix is not None:
+            query = query.filter(_url_prefix_filter(url_prefix))
+        if token_id is not None:
+            query = query.filter(URL.token_id == token_id)
+        if meta:
+            if self._is_postgres(session):
+                query = query.filter(type_coerce(URL.meta, JSONB).contains(meta))
+            else:
+                query = query.filter(_sqlite_json_contains(URL.meta, meta))
+        return query
+
+    def get_token(self, api_key):
+        if (api_key := normalize_api_key(api_key)) is None:
+            return None
+        return Token.query.filter_by(api_key=api_key).one_or_none()
+
+    def get_token_by_name(self, name):
+        return Token.query.filter_by(name=name).one_or_none()
+
+    def get_token_version(self, api_key):
+        if (api_key := normalize_api_key(api_key)) is None:
+            return None
+        return db.session.query(Token.updated_at).filter_by(api_key=api_key).scalar()
+
+    def create_token(self, values):
+        return insert_unless_exists(Token, values, 'name')
+
+    def update_token(self, api_key, values):
+        token = self.get_token(api_key)
+        if token is not None:
+            for key, value in values.items():
+                setattr(token, key, value)
+        return token
+
+    def delete_token(self, api_key):
+        token = self.get_token(api_key)
+        if token is None:
+            return None
+        # the urls may have been deleted or transferred in bulk, which does not update an already loaded collection
+        db.session.expire(token, ['urls'])
+        try:
+            with db.session.begin_nested():
+                db.session.delete(token)
+        except IntegrityError:
+            raise TokenInUseError
+        return token
+
+    def record_token_access(self, token, now, write):
+        values = {'token_uses': Token.token_uses + 1, 'last_access': now}
+        if write:
+            values['last_write'] = now
+        # setting the version explicitly keeps it from being bumped by `onupdate`
+        db.session.execute(update(Token)
+                           .where(Token.id == token.id)
+                           .values(**values, updated_at=Token.updated_at)
+                           .execution_options(synchronize_session='evaluate'))
+
+    def filter_tokens(self, with_version=True, **filters):
+        return _get_collection(Token.query.filter_by(**filters), Token.updated_at, with_version)
+
+
+def lock_reuse(target):
+    """Serialize concurrent requests reusing a URL with the given target.
+
+    Otherwise they could all see that there is no existing url and end
+    up creating duplicates.  The lock is released at the end of the
+    transaction.
+    """
+    db.session.execute(select(func.pg_advisory_xact_lock(_REUSE_LOCK_ID, func.hashtext(target))))
+
+
+def _url_prefix_filter(prefix):
+    """Build an SQL condition matching URLs whose target starts with a prefix.
+
+    Only the beginning of each target is indexed, so the condition on it
+    narrows down the candidates using the index, while comparing the
+    whole prefix handles longer prefixes and sqlite's case-insensitive
+    ``LIKE``.
+    """
+    indexed = func.substr(URL.url, 1, URL_PREFIX_INDEX_LENGTH)
+    return and_(indexed.startswith(prefix[:URL_PREFIX_INDEX_LENGTH], autoescape=True),
+                func.substr(URL.url, 1, len(prefix)) == prefix)
+
+
+def _get_collection(query, version_column, with_version):
+    count = last_modified = None
+    if with_version:
+        count, last_modified = query.with_entities(func.count(), func.max(version_column)).order_by(None).one()
+    return count, last_modified, query.yield_per(FETCH_SIZE)
+
+
+def _sqlite_json_contains(doc, value):
+    # like postgres' `@>` operator, but for nested objects only
+    if isinstance(value, dict):
+        return and_(true(), *(_sqlite_json_contains(_sqlite_json_member(doc, k, isinstance(v, dict)), v)
+                              for k, v in value.items()))
+    return doc == func.json_extract(literal(json.dumps(value)), '$')
+
+
+def _sqlite_json_member(doc, key, is_object):
+    # json paths cannot contain every key (e.g. one containing a double quote), so we look for the
+    # key among the members of the object instead; nested objects only match objects, since the
+    # members of anything else cannot be listed
+    members = func.json_each(doc).table_valued('key', 'value', 'type')
+    query = select(members.c.value).where(members.c.key == key)
+    if is_object:
+        query = query.where(members.c.type == 'object')
+    return query.scalar_subquery()
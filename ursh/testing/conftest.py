@@ -6,9 +6,14 @@ import subprocess
 import tempfile
 
 import pytest
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 
 from ursh.core.app import create_app
+from ursh.core.cache import get_redirect_cache
 from ursh.core.db import db as db_
+from ursh.storage import get_storage
 
 POSTGRES_MIN_VERSION = (9, 6)
 POSTGRES_VERSION = (12,)
@@ -111,12 +116,13 @@ def database(app, postgresql):
     if 'URSH_TEST_DATABASE_URI' in os.environ and os.environ.get('URSH_TEST_DATABASE_HAS_TABLES') == '1':
         yield db_
         return
+    # apps created by other tests may have registered binds unknown to this one
     with app.app_context():
-        db_.create_all()
+        db_.create_all(bind_key=None)
     yield db_
     with app.app_context():
         db_.session.remove()
-        db_.drop_all()
+        db_.drop_all(bind_key=None)
 
 
 @pytest.fixture
@@ -125,6 +131,55 @@ def db(database, monkeypatch):
     # Prevent database/session modifications
     monkeypatch.setattr(database.session, 'commit', database.session.flush)
     monkeypatch.setattr(database.session, 'remove', lambda: None)
+    # connections from separate pools would not see the data of the test transaction
+    monkeypatch.setitem(current_app.config, 'DB_LANE_ENGINE_OPTIONS', {})
+    get_redirect_cache().clear()
     yield database
     database.session.rollback()
     database.session.remove()
+
+
+@pytest.fixture
+def sqlite_app(tmp_path):
+    uri = f'sqlite:///{tmp_path / "ursh.db"}'
+    config = tmp_path / 'ursh.cfg'
+    config.write_text(f'SQLALCHEMY_DATABASE_URI = {uri!r}\n')
+    app = create_app(str(config), testing=True)
+    with app.app_context():
+        db_.create_all(bind_key=None)
+        yield app
+        db_.session.remove()
+
+
+@pytest.fixture
+def sharded_app(postgresql, tmp_path):
+    """Create an app using two shards.
+
+    The main database and the shards are separate schemas in the test
+    database, which are dropped afterwards.
+    """
+    schemas = ['sharded_main', 'sharded_0', 'sharded_1']
+    engine = create_engine(postgresql)
+    with engine.begin() as conn:
+        for schema in schemas:
+            conn.exec_driver_sql(f'CREATE SCHEMA {schema}')
+    uris = [make_url(postgresql).update_query_dict({'options': f'-csearch_path={schema}'})
+            .render_as_string(hide_password=False) for schema in schemas]
+    config = tmp_path / 'ursh.cfg'
+    config.write_text(f'SQLALCHEMY_DATABASE_URI = {uris[0]!r}\n'
+                      f'SQLALCHEMY_SHARD_URIS = {uris[1:]!r}\n'
+                      f"STORAGE_BACKEND = 'sharded'\n")
+    app = create_app(str(config), testing=True)
+    try:
+        with app.app_context():
+            get_storage().create_all()
+            yield app
+            get_storage().rollback()
+            db_.session.remove()
+            for engine_ in db_.engines.values():
+                engine_.dispose()
+    finally:
+        with engine.begin() as conn:
+            for schema in schemas:
+                conn.exec_driver_sql(f'DROP SCHEMA {schema} CASCADE')
+        engine.dispose()
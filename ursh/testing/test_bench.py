@@ -0,0 +1,48 @@
+import json
+
+from ursh.cli.core import cli
+from ursh.core.bench import WORKLOADS, compare_results
+from ursh.models import URL, Token
+
+
+def _make_results(throughput, p50, p95, p99):
+    return {'workloads': {'redirect': {'throughput': throughput, 'latency': {'p50': p50, 'p95': p95, 'p99': p99}}}}
+
+
+def test_bench_cli(sqlite_app, tmp_path):
+    output = tmp_path / 'results.json'
+    runner = sqlite_app.test_cli_runner()
+    result = runner.invoke(cli, ['bench', 'run', '--urls', '150', '--requests', '10', '--concurrency', '2',
+                                 '--warmup', '2', '-o', str(output)])
+    assert result.exit_code == 0, result.output
+    results = json.loads(output.read_text())
+    assert set(results['workloads']) == set(WORKLOADS)
+    for workload in results['workloads'].values():
+        assert workload['requests'] == 10
+        assert workload['errors'] == 0
+        assert workload['latency']['p50'] <= workload['latency']['p99'] <= workload['latency']['max']
+    # the benchmark data is deleted afterwards
+    assert Token.query.count() == 0
+    assert URL.query.count() == 0
+    result = runner.invoke(cli, ['bench', 'compare', str(output), str(output)])
+    assert result.exit_code == 0
+    assert 'regression' not in result.output
+
+
+def test_compare_results(sqlite_app, tmp_path):
+    old = _make_results(100, 10, 20, 40)
+    new = _make_results(80, 10, 22, 30)
+    assert compare_results(old, new) == [
+        ('redirect', 'throughput', 100, 80, 0.2),
+        ('redirect', 'p50', 10, 10, 0),
+        ('redirect', 'p95', 20, 22, 0.1),
+        ('redirect', 'p99', 40, 30, -0.25),
+    ]
+    (tmp_path / 'old.json').write_text(json.dumps(old))
+    (tmp_path / 'new.json').write_text(json.dumps(new))
+    runner = sqlite_app.test_cli_runner()
+    result = runner.invoke(cli, ['bench', 'compare', str(tmp_path / 'old.json'), str(tmp_path / 'new.json'),
+                                 '--threshold', '15'])
+    assert result.exit_code == 1
+    assert result.output.count('regression') == 1
+    assert '1 metrics regressed by more than 15.0%' in result.output
@@ -0,0 +1,127 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+from flask import current_app
+
+from ursh import db as db_
+from ursh.cli.core import cli
+from ursh.cli.urls import cli as urls_cli
+from ursh.core.jobs import JOB_TYPES, JobType, Worker, claim_job, enqueue_job, run_job
+from ursh.models import URL, Job, Token
+from ursh.storage import MemoryStorage, get_storage
+
+
+@pytest.fixture
+def failing_job(monkeypatch):
+    """Provide a job type which always fails."""
+    job_type = JobType('builtins:print', max_attempts=2)
+    job_type.func = lambda **kwargs: 1 / 0
+    monkeypatch.setitem(JOB_TYPES, 'fail', job_type)
+    return job_type
+
+
+def _create_expired_urls(count):
+    token = Token(name='test')
+    expires_at = datetime.now(UTC) - timedelta(minutes=1)
+    db_.session.add_all(URL(shortcut=f'url{i}', url='http://example.com', token=token, expires_at=expires_at)
+                        for i in range(count))
+    db_.session.commit()
+
+
+def test_claim_and_run_job(db):
+    _create_expired_urls(3)
+    enqueue_job('purge-expired-urls', {'batch_size': 2})
+    enqueue_job('purge-idempotency-keys', delay=60)
+    job = claim_job()
+    assert job.type == 'purge-expired-urls'
+    assert job.attempts == 1
+    # the claimed job is hidden from other workers, and the other job is not due yet
+    assert job.run_at > datetime.now(UTC) + timedelta(minutes=59)
+    assert claim_job() is None
+    assert run_job(job)
+    assert URL.query.count() == 0
+    assert [job.type for job in Job.query] == ['purge-idempotency-keys']
+
+
+def test_claim_lost_job(db):
+    enqueue_job('purge-expired-urls')
+    job = claim_job()
+    job.run_at = datetime.now(UTC) - timedelta(seconds=1)
+    db.session.commit()
+    assert claim_job() is job
+    assert job.attempts == 2
+    assert claim_job(['purge-idempotency-keys']) is None
+
+
+def test_run_lost_job(db):
+    enqueue_job('purge-expired-urls')
+    job = claim_job()
+    # another worker claims the job after its visibility timeout expired
+    run_at = datetime.now(UTC) + timedelta(hours=1)
+    Job.query.filter_by(id=job.id).update({'attempts': 2, 'run_at': run_at}, synchronize_session=False)
+    assert job.attempts == 1
+    assert run_job(job)
+    # the job is still running in the other worker
+    assert Job.query.filter_by(id=job.id, attempts=2).count() == 1
+
+
+def test_enqueue_job_without_database(db, monkeypatch):
+    storage = MemoryStorage()
+    monkeypatch.setitem(current_app.extensions, 'storage', storage)
+    token = storage.create_token({'name': 'test'})
+    expires_at = datetime.now(UTC) - timedelta(minutes=1)
+    storage.create_url({'shortcut': 'abc', 'url': 'http://example.com', 'token_id': token.id,
+                        'expires_at': expires_at})
+    assert enqueue_job('purge-expired-urls') is None
+    assert storage.get_url('abc') is None
+    assert Job.query.count() == 0
+
+
+def test_job_retry(sqlite_app, failing_job):
+    enqueue_job('fail')
+    db_.session.commit()
+    job = claim_job()
+    assert not run_job(job)
+    job = Job.query.one()
+    assert job.attempts == 1
+    assert job.failed_at is None
+    assert 'ZeroDivisionError' in job.last_error
+    delay = timedelta(seconds=sqlite_app.config['JOB_RETRY_DELAY'])
+    assert datetime.now(UTC) + delay / 2 - timedelta(seconds=1) < job.run_at < datetime.now(UTC) + delay
+    assert claim_job() is None
+    job.run_at = datetime.now(UTC)
+    db_.session.commit()
+    assert not run_job(claim_job())
+    # the job has been attempted as often as its type allows, so it is not retried anymore
+    job = Job.query.one()
+    assert job.attempts == 2
+    assert job.failed_at is not None
+    job.run_at = datetime.now(UTC)
+    db_.session.commit()
+    assert claim_job() is None
+
+
+def test_worker_concurrency_limit(db):
+    enqueue_job('purge-expired-urls')
+    worker = Worker(current_app, threads=1)
+    worker._running['purge-expired-urls'] = 1
+    assert not worker._run_next_job()
+    worker._running['purge-expired-urls'] = 0
+    assert worker._run_next_job()
+    assert Job.query.count() == 0
+
+
+def test_worker_cli(sqlite_app, failing_job):
+    _create_expired_urls(5)
+    runner = sqlite_app.test_cli_runner()
+    result = runner.invoke(urls_cli, ['purge-expired', '--queue'])
+    assert result.output == 'Queued a job deleting expired URLs\n'
+    assert get_storage().filter_urls()[0] == 5
+    enqueue_job('fail')
+    db_.session.commit()
+    result = runner.invoke(cli, ['worker', '--type', 'purge-expired-urls', '--burst', '--threads', '2'])
+    assert result.exit_code == 0, result.output
+    assert get_storage().filter_urls()[0] == 0
+    assert [(job.type, job.attempts) for job in Job.query] == [('fail', 0)]
+    result = runner.invoke(cli, ['worker', '--type', 'foo', '--burst'])
+    assert 'Unknown job types: foo' in result.output
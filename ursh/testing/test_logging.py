@@ -0,0 +1,95 @@
+import json
+import logging
+import sys
+
+import pytest
+
+from ursh.core.app import create_app
+from ursh.core.logging import JSONFormatter, QueueHandler, SamplingFilter
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def logger():
+    """Provide a logger which is not used by the application."""
+    logger = logging.getLogger('ursh-test')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    yield logger
+    logger.handlers.clear()
+
+
+def test_json_formatter():
+    record = logging.makeLogRecord({'name': 'ursh', 'levelname': 'INFO', 'msg': 'URL created: %s',
+                                    'args': ('abc',), 'event': 'url-created'})
+    try:
+        raise ValueError('test')
+    except ValueError:
+        record.exc_info = sys.exc_info()
+    data = json.loads(JSONFormatter().format(record))
+    assert data.items() >= {'level': 'INFO', 'logger': 'ursh', 'message': 'URL created: abc',
+                            'event': 'url-created'}.items()
+    assert 'ValueError: test' in data['exception']
+    assert 'args' not in data
+
+
+def test_sampling_filter(logger, monkeypatch):
+    handler = _ListHandler()
+    handler.addFilter(SamplingFilter({'redirect-cache-fallback': 0.25}))
+    logger.addHandler(handler)
+    random_values = iter([0.1, 0.5])
+    monkeypatch.setattr('ursh.core.logging.random.random', lambda: next(random_values))
+    logger.warning('kept', extra={'event': 'redirect-cache-fallback'})
+    logger.warning('dropped', extra={'event': 'redirect-cache-fallback'})
+    logger.warning('not sampled')
+    assert [record.msg for record in handler.records] == ['kept', 'not sampled']
+    assert handler.records[0].sample_rate == pytest.approx(0.25)
+
+
+def test_queue_handler(logger):
+    target = _ListHandler()
+    handler = QueueHandler([target], maxsize=2)
+    logger.addHandler(handler)
+    data = {'meta': 'foo'}
+    for i in range(5):
+        logger.info('record %d %r', i, data)
+    # records which do not fit into the queue are dropped instead of blocking
+    assert handler.dropped == 3
+    assert not target.records
+    handler.listener.start()
+    handler.close()
+    assert [record.getMessage() for record in target.records] == ["record 0 {'meta': 'foo'}",
+                                                                  "record 1 {'meta': 'foo'}"]
+
+
+def test_log_queue_config(tmp_path, monkeypatch):
+    for name in ('', 'ursh', 'werkzeug'):
+        # configuring logging modifies the lists of handlers
+        monkeypatch.setattr(logging.getLogger(name), 'handlers', logging.getLogger(name).handlers[:])
+    config = tmp_path / 'ursh.cfg'
+    config.write_text("LOG_FORMAT = 'json'\nLOG_QUEUE_SIZE = 100\nLOG_SAMPLE_RATES = {'slow-query': '0.5'}\n")
+    app = create_app(str(config), testing=True)
+    [handler] = app.logger.handlers
+    assert isinstance(handler, QueueHandler)
+    assert logging.getLogger().handlers == [handler]
+    [werkzeug_handler] = logging.getLogger('werkzeug').handlers
+    assert isinstance(werkzeug_handler, QueueHandler)
+    # all records passing through any of the queues are sampled and formatted as JSON
+    for queue_handler in (handler, werkzeug_handler):
+        [sampling_filter] = queue_handler.filters
+        assert sampling_filter.rates == {'slow-query': 0.5}
+        assert all(isinstance(target.formatter, JSONFormatter) for target in queue_handler.listener.handlers)
+    werkzeug_handler.close()
+    target = _ListHandler()
+    handler.listener.handlers = (target,)
+    app.logger.info('test')
+    handler.close()
+    assert [record.msg for record in target.records] == ['test']
@@ -0,0 +1,134 @@
+import logging
+import sys
+
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import OperationalError
+
+from ursh.core.app import create_app
+from ursh.core.profiling import ProfilingSettings
+from ursh.models import URL, Token
+
+
+def _get_value(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def log_records(app, monkeypatch):
+    """Collect the records logged by the application itself."""
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(lambda record: record.name == app.logger.name)
+    monkeypatch.setattr(app.logger, 'handlers', [handler])
+    return records
+
+
+def test_request_metrics(db, client):
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token(name='test')))
+    db.session.flush()
+    labels = {'endpoint': 'redirection.redirect_to_url', 'method': 'GET'}
+    requests = _get_value('ursh_requests_total', **labels, status='302')
+    observed = _get_value('ursh_request_duration_seconds_count', **labels)
+    db_time = _get_value('ursh_request_db_duration_seconds_sum', endpoint=labels['endpoint'])
+    not_found = _get_value('ursh_requests_total', endpoint='none', method='GET', status='404')
+    for _ in range(3):
+        assert client.get('/abc').status_code == 302
+    assert client.get('/foo/bar').status_code == 404
+    assert _get_value('ursh_requests_total', **labels, status='302') == requests + 3
+    assert _get_value('ursh_request_duration_seconds_count', **labels) == observed + 3
+    assert _get_value('ursh_request_db_duration_seconds_sum', endpoint=labels['endpoint']) > db_time
+    assert _get_value('ursh_requests_total', endpoint='none', method='GET', status='404') == not_found + 1
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'ursh_requests_total{endpoint="redirection.redirect_to_url",method="GET",status="302"}' in response.text
+
+
+def test_error_metrics(db, client):
+    invalid_token = _get_value('ursh_api_errors_total', code='invalid-token')
+    validation_error = _get_value('ursh_api_errors_total', code='validation-error')
+    assert client.get('/api/urls/').status_code == 401
+    user = Token(name='test')
+    db.session.add(user)
+    db.session.flush()
+    response = client.post('/api/urls/', json={'url': 'invalid'}, headers={'Authorization': f'Bearer {user.api_key}'})
+    assert response.status_code == 400
+    assert _get_value('ursh_api_errors_total', code='invalid-token') == invalid_token + 1
+    assert _get_value('ursh_api_errors_total', code='validation-error') == validation_error + 1
+
+
+def test_redirect_cache_fallback_metrics(db, client, monkeypatch):
+    def _fail(shortcut):
+        raise OperationalError('SELECT 1', {}, Exception('connection lost'))
+
+    monkeypatch.setattr(sys.modules['ursh.blueprints.redirection'], '_get_target_url', _fail)
+    misses = _get_value('ursh_redirect_cache_fallbacks_total', result='miss')
+    assert client.get('/abc').status_code == 503
+    assert _get_value('ursh_redirect_cache_fallbacks_total', result='miss') == misses + 1
+
+
+def test_metrics_url(tmp_path):
+    config = tmp_path / 'ursh.cfg'
+    config.write_text("METRICS_URL = '/internal/metrics'\n")
+    app = create_app(str(config), testing=True)
+    assert 'internal' in app.config['BLACKLISTED_URLS']
+    assert app.test_client().get('/internal/metrics').status_code == 200
+    config.write_text('METRICS_URL = None\n')
+    app = create_app(str(config), testing=True)
+    assert 'metrics' not in {rule.endpoint for rule in app.url_map.iter_rules()}
+
+
+def test_sql_profiling(db, app, client, log_records, monkeypatch):
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token(name='test')))
+    db.session.flush()
+    monkeypatch.setitem(app.extensions, 'sql_profiling', ProfilingSettings())
+    response = client.get('/abc')
+    assert 'Server-Timing' not in response.headers
+    assert not log_records
+    app.extensions['sql_profiling'].enabled = True
+    response = client.get('/abc')
+    assert 'Server-Timing' not in response.headers
+    [record] = log_records
+    assert record.endpoint == 'redirection.redirect_to_url'
+    assert record.query_count == 1
+    assert record.db_time > 0
+    monkeypatch.setattr(app, 'debug', True)
+    response = client.get('/abc')
+    assert response.headers['Server-Timing'].endswith(';desc="1 queries"')
+
+
+def test_slow_query_log(db, app, client, log_records, monkeypatch):
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token(name='test')))
+    db.session.flush()
+    monkeypatch.setitem(app.extensions, 'sql_profiling', ProfilingSettings(slow_query_threshold=0, explain_rate=1))
+    assert client.get('/abc').status_code == 302
+    [record] = log_records
+    assert record.levelname == 'WARNING'
+    assert record.statement.startswith('SELECT')
+    assert 'Scan' in record.plan
+    app.extensions['sql_profiling'].explain_rate = 0
+    assert client.get('/abc').status_code == 302
+    assert not hasattr(log_records[-1], 'plan')
+
+
+def test_slow_query_log_explain_failed(db, app, client, log_records, monkeypatch):
+    token = Token(name='test')
+    db.session.add(token)
+    db.session.flush()
+
+    def _get_plan(cursor, statement, parameters):
+        cursor.execute('EXPLAIN SELEC 1')
+
+    monkeypatch.setattr('ursh.core.profiling._get_plan', _get_plan)
+    monkeypatch.setitem(app.extensions, 'sql_profiling', ProfilingSettings(slow_query_threshold=0, explain_rate=1))
+    # the request keeps using its transaction after the plan of its first query could not be retrieved
+    response = client.put('/api/urls/abc', json={'url': 'http://example.com'},
+                          headers={'Authorization': f'Bearer {token.api_key}'})
+    assert response.status_code == 201
+    slow_queries = [record for record in log_records if getattr(record, 'event', None) == 'slow-query']
+    failures = [record for record in log_records if record.getMessage().startswith('Could not get the plan')]
+    assert {'SELECT', 'INSERT'} <= {record.statement.split()[0] for record in slow_queries}
+    # only queries which do not modify anything are explained
+    assert len(failures) == sum(record.statement.startswith('SELECT') for record in slow_queries)
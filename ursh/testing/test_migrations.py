@@ -0,0 +1,151 @@
+import pytest
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import make_url
+
+from ursh import db as db_
+from ursh.cli.database import cli
+from ursh.core.app import create_app
+from ursh.util.migrations import backfill, create_index_concurrently, drop_index_concurrently
+
+HEAD = 'e3b7a9c41f06'
+
+
+@pytest.fixture
+def empty_app(postgresql):
+    """Create an app using an empty schema in the test database."""
+    engine = create_engine(postgresql)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE SCHEMA migrations')
+    app = create_app(testing=True)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (make_url(postgresql)
+                                             .update_query_dict({'options': '-csearch_path=migrations'})
+                                             .render_as_string(hide_password=False))
+    app.extensions.pop('sqlalchemy', None)
+    db_.init_app(app)
+    try:
+        with app.app_context():
+            yield app
+            db_.session.remove()
+            db_.engine.dispose()
+    finally:
+        with engine.begin() as conn:
+            conn.exec_driver_sql('DROP SCHEMA migrations CASCADE')
+        engine.dispose()
+
+
+def _run(app, *args):
+    result = app.test_cli_runner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def _compare_with_models(engine):
+    with engine.connect() as conn:
+        return compare_metadata(MigrationContext.configure(conn), db_.metadata)
+
+
+def test_upgrade(empty_app):
+    output = _run(empty_app, 'upgrade')
+    assert f'main database: Upgraded to {HEAD}' in output
+    assert _compare_with_models(db_.engine) == []
+    # autogenerate ignores indexes on expressions
+    with db_.engine.connect() as conn:
+        definition = conn.exec_driver_sql("SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_urls_url_prefix'")
+        assert 'substr((url)::text, 1, 255) text_pattern_ops' in definition.scalar()
+    assert f'{HEAD} (head)' in _run(empty_app, 'current')
+    assert not _run(empty_app, 'upgrade')
+    _run(empty_app, 'downgrade', 'base')
+    assert inspect(db_.engine).get_table_names() == ['alembic_version']
+
+
+def test_upgrade_baseline(empty_app):
+    # the schema of databases set up using `ursh db create` before there were migrations
+    with db_.engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE tokens (id serial, api_key uuid, name varchar NOT NULL, '
+                             'is_admin boolean NOT NULL, is_blocked boolean NOT NULL, token_uses integer NOT NULL, '
+                             'last_access timestamptz NOT NULL, callback_url varchar, '
+                             'CONSTRAINT pk_tokens PRIMARY KEY (id), CONSTRAINT uq_tokens_name UNIQUE (name))')
+        conn.exec_driver_sql('CREATE UNIQUE INDEX ix_uq_tokens_api_key ON tokens (api_key)')
+        conn.exec_driver_sql('CREATE TABLE urls (id serial, shortcut varchar, url varchar NOT NULL, '
+                             'token_id integer NOT NULL, is_custom boolean NOT NULL, meta jsonb NOT NULL, '
+                             'CONSTRAINT pk_urls PRIMARY KEY (id), '
+                             'CONSTRAINT fk_urls_token_id_tokens FOREIGN KEY (token_id) REFERENCES tokens (id))')
+        conn.exec_driver_sql('CREATE UNIQUE INDEX ix_uq_urls_shortcut ON urls (shortcut)')
+        conn.exec_driver_sql("INSERT INTO tokens VALUES (1, gen_random_uuid(), 'test', false, false, 0, now(), NULL)")
+        conn.exec_driver_sql("INSERT INTO urls VALUES (1, 'abc', 'https://example.com', 1, false, '{}')")
+    output = _run(empty_app, 'upgrade')
+    assert f'main database: Upgraded to {HEAD}' in output
+    assert _compare_with_models(db_.engine) == []
+    with db_.engine.connect() as conn:
+        assert conn.exec_driver_sql('SELECT updated_at IS NOT NULL FROM tokens').scalar()
+        assert conn.exec_driver_sql('SELECT updated_at IS NOT NULL FROM urls').scalar()
+        query = ("SELECT indexname, indexdef FROM pg_indexes "
+                 "WHERE indexname IN ('ix_uq_tokens_api_key', 'ix_uq_urls_shortcut')")
+        definitions = dict(conn.exec_driver_sql(query).all())
+    assert definitions['ix_uq_tokens_api_key'].endswith('(api_key) INCLUDE (updated_at)')
+    assert definitions['ix_uq_urls_shortcut'].endswith('(shortcut) INCLUDE (updated_at)')
+    assert not _run(empty_app, 'upgrade')
+
+
+def test_create(empty_app):
+    _run(empty_app, 'create')
+    assert f'{HEAD} (head)' in _run(empty_app, 'current')
+    assert not _run(empty_app, 'upgrade')
+
+
+def test_upgrade_sqlite(sqlite_app):
+    db_.drop_all(bind_key=None)
+    _run(sqlite_app, 'upgrade')
+    assert _compare_with_models(db_.engine) == []
+    _run(sqlite_app, 'downgrade', 'base')
+    assert inspect(db_.engine).get_table_names() == ['alembic_version']
+
+
+def test_upgrade_sharded(sharded_app):
+    for engine in db_.engines.values():
+        with engine.begin() as conn:
+            conn.exec_driver_sql('DROP TABLE IF EXISTS jobs, idempotency_keys, urls, tokens')
+    output = _run(sharded_app, 'upgrade')
+    assert f'shard 1: Upgraded to {HEAD}' in output
+    _run(sharded_app, 'downgrade', 'base')
+    for key in ('shard-0', 'shard-1'):
+        assert inspect(db_.engines[key]).get_table_names() == ['alembic_version']
+    _run(sharded_app, 'upgrade')
+    assert _compare_with_models(db_.engine) == []
+    for key in ('shard-0', 'shard-1'):
+        shard = inspect(db_.engines[key])
+        assert sorted(shard.get_table_names()) == ['alembic_version', 'urls']
+        assert shard.get_foreign_keys('urls') == []
+        assert {index['name'] for index in shard.get_indexes('urls')} == {'ix_uq_urls_shortcut', 'ix_urls_expires_at',
+                                                                         'ix_urls_meta', 'ix_urls_token_id',
+                                                                         'ix_urls_url'}
+
+
+def test_index_helpers(empty_app):
+    with db_.engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE test (id serial PRIMARY KEY, value text)')
+    with db_.engine.connect() as conn, Operations.context(MigrationContext.configure(conn)):
+        create_index_concurrently('ix_test_value', 'test', ['value'])
+        # creating it again does nothing, so interrupted migrations can be restarted
+        create_index_concurrently('ix_test_value', 'test', ['value'])
+        assert [index['name'] for index in inspect(conn).get_indexes('test')] == ['ix_test_value']
+        drop_index_concurrently('ix_test_value', 'test')
+        drop_index_concurrently('ix_test_value', 'test')
+        assert inspect(conn).get_indexes('test') == []
+
+
+def test_backfill(empty_app, capsys):
+    with db_.engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE test (id serial PRIMARY KEY, a integer, b integer)')
+        conn.exec_driver_sql('INSERT INTO test (a, b) '
+                             'SELECT x, CASE WHEN x = 5 THEN 0 END FROM generate_series(1, 10) x')
+    opts = {'batch_size': 3, 'batch_delay': 0.01}
+    with db_.engine.connect() as conn, Operations.context(MigrationContext.configure(conn, opts=opts)):
+        assert backfill('test', {'b': 'a * 2'}, where='b IS NULL') == 9
+        assert capsys.readouterr().out.endswith('test: 9 rows updated (100%)\n')
+        assert backfill('test', {'b': 'a * 2'}, where='b IS NULL') == 0
+        rows = conn.exec_driver_sql('SELECT a, b FROM test ORDER BY id').all()
+    assert rows == [(x, 0 if x == 5 else x * 2) for x in range(1, 11)]
@@ -0,0 +1,107 @@
+import json
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+from ursh import db as db_
+from ursh.cli.core import cli
+from ursh.core.app import create_app
+from ursh.core.replay import read_captures, replay_requests
+from ursh.storage import get_storage
+
+
+@pytest.fixture
+def capture_app(tmp_path):
+    """Create an app recording its requests to ``capture.log``."""
+    uri = f'sqlite:///{tmp_path / "ursh.db"}'
+    config = tmp_path / 'ursh.cfg'
+    config.write_text(f'SQLALCHEMY_DATABASE_URI = {uri!r}\n'
+                      f'CAPTURE_FILE = {str(tmp_path / "capture.log")!r}\n'
+                      'CAPTURE_BODIES = True\n')
+    app = create_app(str(config), testing=True)
+    with app.app_context():
+        db_.create_all(bind_key=None)
+        yield app
+        db_.session.remove()
+
+
+@pytest.fixture
+def server(capture_app):
+    """Serve the capture app over HTTP."""
+    server = make_server('127.0.0.1', 0, capture_app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield f'http://127.0.0.1:{server.port}'
+    server.shutdown()
+    thread.join()
+
+
+def _create_url():
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    storage.create_url({'shortcut': 'abc', 'url': 'http://example.com', 'token_id': token.id})
+    storage.commit()
+    return token
+
+
+def _read_capture(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_capture(capture_app, tmp_path):
+    token = _create_url()
+    client = capture_app.test_client()
+    # the request is only recorded once the server closes the response
+    client.get('/abc', buffered=True)
+    client.get('/missing?foo=bar', buffered=True)
+    client.post('/api/urls/', json={'url': 'http://example.com'}, headers={'Authorization': f'Bearer {token.api_key}'},
+                buffered=True)
+    redirect, missing, created = _read_capture(tmp_path / 'capture.log')
+    assert redirect.items() >= {'method': 'GET', 'path': '/abc', 'auth': 'none', 'status': 302}.items()
+    assert redirect['duration'] > 0
+    assert missing.items() >= {'path': '/missing', 'query': 'foo=bar', 'status': 404}.items()
+    assert created.items() >= {'method': 'POST', 'auth': 'bearer', 'status': 201,
+                               'body': '{"url": "http://example.com"}'}.items()
+    # the api key itself is not recorded
+    assert token.api_key not in (tmp_path / 'capture.log').read_text()
+    capture_app.wsgi_app.sample_rate = 0
+    client.get('/abc', buffered=True)
+    assert len(_read_capture(tmp_path / 'capture.log')) == 3
+
+
+def test_replay(capture_app, server, tmp_path):
+    token = _create_url()
+    capture = tmp_path / 'old.log'
+    capture.write_text('\n'.join(json.dumps(record) for record in [
+        {'t': 1000, 'method': 'GET', 'path': '/abc', 'auth': 'none', 'status': 302, 'duration': 1},
+        {'t': 1000.1, 'method': 'GET', 'path': '/missing', 'auth': 'none', 'status': 404, 'duration': 1},
+        {'t': 1000.2, 'method': 'POST', 'path': '/api/urls/', 'auth': 'bearer', 'status': 201, 'duration': 1,
+         'content_type': 'application/json', 'body': '{"url": "http://example.com/new"}'},
+    ]))
+    other_capture = tmp_path / 'other.log'
+    other_capture.write_text(json.dumps({'t': 1000.05, 'method': 'GET', 'path': '/abc', 'status': 302}))
+    with capture.open() as f, other_capture.open() as other_f:
+        assert [record['t'] for record in read_captures([f, other_f])] == [1000, 1000.05, 1000.1, 1000.2]
+    with capture.open() as f:
+        results = replay_requests(read_captures([f]), server, concurrency=2)
+    assert results['skipped'] == 1
+    # the requests are sent at the recorded speed
+    assert results['duration'] >= 0.1
+    assert set(results['workloads']) == {'redirect', 'not-found'}
+    assert results['workloads']['redirect']['status_changes'] == 0
+    assert results['workloads']['redirect']['recorded_latency']['p50'] == 1
+    with capture.open() as f:
+        results = replay_requests(read_captures([f]), server, speed=0, api_key=token.api_key)
+    assert results['workloads']['api'].items() >= {'requests': 1, 'errors': 0, 'status_changes': 0}.items()
+    assert get_storage().filter_urls(url='http://example.com/new')[0] == 1
+
+
+def test_replay_cli(capture_app, server, tmp_path):
+    _create_url()
+    (tmp_path / 'trace.log').write_text(json.dumps({'method': 'GET', 'path': '/abc'}))
+    result = capture_app.test_cli_runner().invoke(cli, ['replay', str(tmp_path / 'trace.log'), '--target', server,
+                                                        '-o', str(tmp_path / 'results.json')])
+    assert result.exit_code == 0, result.output
+    assert 'redirect: 1 requests, 0 errors, 0 with a different status' in result.output
+    assert json.loads((tmp_path / 'results.json').read_text())['workloads']['redirect']['requests'] == 1
@@ -1,11 +1,29 @@
+import gzip
+import json
+import os
 import posixpath
+import pstats
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
 from operator import itemgetter
 from urllib.parse import urlparse
 from uuid import uuid4
 
 import pytest
+from psycopg2.errors import QueryCanceled
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from werkzeug.http import http_date
 
-from ursh.models import URL, Token
+from ursh.core.cache import get_redirect_cache
+from ursh.core.db import _ReplicaStatus, get_lane_engines
+from ursh.core.jobs import claim_job, run_job
+from ursh.core.profiling import ProfilingSettings
+from ursh.models import URL, IdempotencyKey, Token
 
 
 def make_auth(db, name, is_admin=False, is_blocked=False):
@@ -412,6 +430,14 @@ def test_create_url(db, app, client, data, expected, status):
                    'messages': {'shortcut': ['Invalid value.']}}, 'status': 400},
         400,
     ),
+    (
+        # reserved for probes
+        'readyz',
+        {'url': 'https://google.com', 'meta': {'author': 'me'}},
+        {'error': {'code': 'validation-error',
+                   'messages': {'shortcut': ['Invalid value.']}}, 'status': 400},
+        400,
+    ),
 ))
 def test_put_url(db, client, name, data, expected, status):
     auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
@@ -430,6 +456,32 @@ def test_put_url(db, client, name, data, expected, status):
         assert url is not None
 
 
+@pytest.mark.parametrize(('deleted', 'status'), (
+    (True, 201),
+    (False, 409),
+))
+def test_put_url_conflict_deleted(db, app, client, monkeypatch, deleted, status):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    storage = app.extensions['storage']
+    get_url = storage.get_url
+
+    def _get_url(shortcut):
+        # nothing is found since the url was deleted after the insert failed (or it was not deleted but is
+        # not found anyway, which should never happen)
+        if deleted:
+            db.session.delete(get_url(shortcut))
+            db.session.flush()
+
+    monkeypatch.setattr(storage, 'get_url', _get_url)
+    response = client.put('/api/urls/abc', json={'url': 'http://example.com/new', 'allow_reuse': True}, headers=auth)
+    assert response.status_code == status
+    if deleted:
+        assert response.get_json()['url'] == 'http://example.com/new'
+    else:
+        assert response.get_json()['error']['code'] == 'conflict'
+
+
 @pytest.mark.parametrize(('shortcut', 'data', 'expected', 'status'), (
     (
         # everything goes right
@@ -482,6 +534,80 @@ def test_patch_url(db, client, shortcut, data, expected, status):
         assert url.token.name == parsed_response.get('owner')
 
 
+@pytest.mark.parametrize(('meta', 'patch', 'expected'), (
+    (
+        # new keys are added, existing ones are kept
+        {'a': 'foo', 'b': 'bar'},
+        {'c': 'baz'},
+        {'a': 'foo', 'b': 'bar', 'c': 'baz'},
+    ),
+    (
+        # existing keys are replaced
+        {'a': 'foo', 'b': 'bar'},
+        {'a': 'baz'},
+        {'a': 'baz', 'b': 'bar'},
+    ),
+    (
+        # null removes keys
+        {'a': 'foo', 'b': 'bar'},
+        {'a': None, 'x': None},
+        {'b': 'bar'},
+    ),
+    (
+        # nested objects are merged recursively
+        {'a': {'x': 1, 'y': 2}, 'b': 'bar'},
+        {'a': {'y': None, 'z': 3}},
+        {'a': {'x': 1, 'z': 3}, 'b': 'bar'},
+    ),
+    (
+        # non-object values are replaced by nested objects
+        {'a': 'foo'},
+        {'a': {'x': {'y': 1}}},
+        {'a': {'x': {'y': 1}}},
+    ),
+    (
+        # arrays are replaced, not merged
+        {'a': [1, 2]},
+        {'a': [3]},
+        {'a': [3]},
+    ),
+))
+def test_merge_patch_url(db, client, meta, patch, expected):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    client.put('/api/urls/abc', json={'url': 'http://example.com', 'meta': meta}, headers=auth)
+    response = client.patch('/api/urls/abc', data=json.dumps({'meta': patch}),
+                            content_type='application/merge-patch+json', headers=auth)
+
+    assert response.status_code == 200
+    assert response.get_json()['meta'] == expected
+    assert response.get_json()['url'] == 'http://example.com'
+    assert URL.query.filter_by(shortcut='abc').one().meta == expected
+
+
+def test_merge_patch_url_unsupported_fields(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    client.put('/api/urls/abc', json={'url': 'http://example.com', 'meta': {'a': 1}}, headers=auth)
+
+    response = client.patch('/api/urls/abc', data=json.dumps({'meta': {'b': 2}, 'allow_reuse': True}),
+                            content_type='application/merge-patch+json', headers=auth)
+
+    assert response.status_code == 400
+    assert response.get_json()['error']['code'] == 'invalid-args'
+    assert response.get_json()['error']['args'] == ['allow_reuse']
+    assert URL.query.filter_by(shortcut='abc').one().meta == {'a': 1}
+
+
+def test_merge_patch_url_not_found(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    response = client.patch('/api/urls/abc', data=json.dumps({'meta': {'a': 'b'}}),
+                            content_type='application/merge-patch+json', headers=auth)
+
+    assert response.status_code == 404
+    assert response.get_json()['error']['code'] == 'not-found'
+
+
 @pytest.mark.parametrize(('shortcut', 'expected', 'status'), (
     (
         # everything goes right
@@ -643,3 +769,723 @@ def test_other_user(db, client, method):
 
     assert response.status_code == 403
     assert response.get_json() == expected
+
+
+@pytest.fixture
+def committing_db(database):
+    """Provide database access with real commits for concurrency tests.
+
+    Everything created while using this fixture must be cleaned up by the
+    test itself since it is actually persisted in the database.
+    """
+    yield database
+    database.session.rollback()
+    database.session.remove()
+
+
+def _run_concurrently(app, func, count=20):
+    barrier = threading.Barrier(count)
+
+    def _run(n):
+        client = app.test_client()
+        barrier.wait()
+        return func(client, n)
+
+    with ThreadPoolExecutor(count) as executor:
+        return list(executor.map(_run, range(count)))
+
+
+def test_concurrent_creation(app, committing_db):
+    db = committing_db
+    token = create_user(db, 'concurrency-test', is_admin=True)
+    auth = {'Authorization': f'Bearer {token.api_key}'}
+    try:
+        # reusing a url never creates duplicates
+        responses = _run_concurrently(app, lambda client, n: client.post(
+            '/api/urls/', json={'url': 'http://example.com/reuse', 'allow_reuse': True}, headers=auth))
+        assert {r.status_code for r in responses} == {201}
+        assert len({r.get_json()['short_url'] for r in responses}) == 1
+        assert URL.query.filter_by(url='http://example.com/reuse').count() == 1
+
+        # new random shortcuts are always unique
+        responses = _run_concurrently(app, lambda client, n: client.post(
+            '/api/urls/', json={'url': 'http://example.com/new'}, headers=auth))
+        assert {r.status_code for r in responses} == {201}
+        assert len({r.get_json()['short_url'] for r in responses}) == len(responses)
+
+        # only one request can create a custom shortcut, the others get a conflict
+        responses = _run_concurrently(app, lambda client, n: client.put(
+            '/api/urls/concurrent', json={'url': f'http://example.com/{n}'}, headers=auth))
+        assert sorted(r.status_code for r in responses) == [201] + [409] * (len(responses) - 1)
+
+        # ...unless they reuse the same url
+        responses = _run_concurrently(app, lambda client, n: client.put(
+            '/api/urls/concurrent-reuse', json={'url': 'http://example.com', 'allow_reuse': True}, headers=auth))
+        assert {r.status_code for r in responses} == {201}
+
+        # only one token with the same name can be created
+        responses = _run_concurrently(app, lambda client, n: client.post(
+            '/api/tokens/', json={'name': 'concurrency-test-new'}, headers=auth))
+        assert sorted(r.status_code for r in responses) == [201] + [409] * (len(responses) - 1)
+    finally:
+        db.session.rollback()
+        URL.query.filter_by(token_id=token.id).delete()
+        Token.query.filter(Token.name.in_(['concurrency-test', 'concurrency-test-new'])).delete()
+        db.session.commit()
+
+
+@pytest.mark.parametrize(('method', 'url', 'data'), (
+    ('post', '/api/urls/', {'url': 'http://example.com'}),
+    ('put', '/api/urls/abc', {'url': 'http://example.com'}),
+    ('post', '/api/tokens/', {'name': 'abc'}),
+))
+def test_idempotency_key(db, client, method, url, data):
+    auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+    headers = {**auth, 'Idempotency-Key': 'foo'}
+    method = getattr(client, method)
+
+    response = method(url, json=data, headers=headers)
+    # retries are recognized even if they are serialized differently
+    retry_response = method(url, data=json.dumps(data, indent=2), content_type='application/json', headers=headers)
+
+    assert response.status_code == 201
+    assert retry_response.status_code == 201
+    assert 'Idempotent-Replayed' not in response.headers
+    assert retry_response.headers['Idempotent-Replayed'] == 'true'
+    assert retry_response.get_json() == response.get_json()
+    if 'urls' in url:
+        assert URL.query.filter_by(url='http://example.com').count() == 1
+
+    # the same key cannot be used for a different request
+    response = method(url, json={**data, 'meta': {'a': 'b'}}, headers=headers)
+    assert response.status_code == 422
+    assert response.get_json()['error']['code'] == 'idempotency-key-reused'
+
+
+def test_idempotency_key_key_order(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    headers = {**auth, 'Idempotency-Key': 'foo'}
+
+    response = client.post('/api/urls/', data='{"url": "http://example.com", "meta": {"a": 1, "b": 2}}',
+                           content_type='application/json', headers=headers)
+    retry_response = client.post('/api/urls/', data='{"meta":{"b":2,"a":1},"url":"http://example.com"}',
+                                 content_type='application/json', headers=headers)
+
+    assert response.status_code == 201
+    assert retry_response.status_code == 201
+    assert retry_response.headers['Idempotent-Replayed'] == 'true'
+    assert retry_response.get_json() == response.get_json()
+
+
+def test_idempotency_key_scoped_to_token(db, client):
+    auth1 = make_auth(db, 'non-admin-1', is_admin=False, is_blocked=False)
+    auth2 = make_auth(db, 'non-admin-2', is_admin=False, is_blocked=False)
+
+    response1 = client.post('/api/urls/', json={'url': 'http://example.com'}, headers={**auth1, 'Idempotency-Key': 'x'})
+    response2 = client.post('/api/urls/', json={'url': 'http://example.com'}, headers={**auth2, 'Idempotency-Key': 'x'})
+
+    assert response1.status_code == 201
+    assert response2.status_code == 201
+    assert response1.get_json()['short_url'] != response2.get_json()['short_url']
+
+
+def test_idempotency_key_failed_request(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    headers = {**auth, 'Idempotency-Key': 'foo'}
+
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    response = client.put('/api/urls/abc', json={'url': 'http://example.org'}, headers=headers)
+    assert response.status_code == 409
+    # failed requests are not stored so they can be retried
+    client.delete('/api/urls/abc', headers=auth)
+    response = client.put('/api/urls/abc', json={'url': 'http://example.org'}, headers=headers)
+    assert response.status_code == 201
+
+
+def test_idempotency_key_expired(db, app, client, monkeypatch):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    headers = {**auth, 'Idempotency-Key': 'foo'}
+
+    response = client.post('/api/urls/', json={'url': 'http://example.com'}, headers=headers)
+    monkeypatch.setitem(app.config, 'IDEMPOTENCY_KEY_TTL', -1)
+    retry_response = client.post('/api/urls/', json={'url': 'http://example.com'}, headers=headers)
+
+    assert retry_response.status_code == 201
+    assert 'Idempotent-Replayed' not in retry_response.headers
+    assert response.get_json()['short_url'] != retry_response.get_json()['short_url']
+
+
+def test_idempotency_key_in_progress(app, committing_db, monkeypatch):
+    db = committing_db
+    token = create_user(db, 'idempotency-test')
+    headers = {'Authorization': f'Bearer {token.api_key}', 'Idempotency-Key': 'foo'}
+    storage = app.extensions['storage']
+    create_url = storage.create_url
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def _create_url(values):
+        started.set()
+        assert proceed.wait(10)
+        return create_url(values)
+
+    monkeypatch.setattr(storage, 'create_url', _create_url)
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(lambda: app.test_client().put('/api/urls/idempotency-test',
+                                                                   json={'url': 'http://example.com'},
+                                                                   headers=headers))
+            assert started.wait(10)
+            # a retry while the first request is still being processed (in another session) is rejected
+            response = app.test_client().put('/api/urls/idempotency-test', json={'url': 'http://example.com'},
+                                             headers=headers)
+            proceed.set()
+            assert response.status_code == 409
+            assert response.get_json()['error']['code'] == 'idempotency-key-in-use'
+            assert future.result().status_code == 201
+        response = app.test_client().put('/api/urls/idempotency-test', json={'url': 'http://example.com'},
+                                         headers=headers)
+        assert response.status_code == 201
+        assert response.headers['Idempotent-Replayed'] == 'true'
+    finally:
+        proceed.set()
+        db.session.rollback()
+        URL.query.filter_by(token_id=token.id).delete()
+        IdempotencyKey.query.filter_by(token_id=token.id).delete()
+        Token.query.filter_by(id=token.id).delete()
+        db.session.commit()
+
+
+def test_get_url_conditional(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    response = client.get('/api/urls/abc', headers=auth)
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert response.headers['Last-Modified']
+
+    response = client.get('/api/urls/abc', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    client.patch('/api/urls/abc', json={'meta': {'a': 'b'}}, headers=auth)
+    response = client.get('/api/urls/abc', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['meta'] == {'a': 'b'}
+
+    response = client.get('/api/urls/xyz', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 404
+
+
+def test_get_urls_conditional(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    other_auth = make_auth(db, 'non-admin-2', is_admin=False, is_blocked=False)
+
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    # getting the etag of a listing needs an additional query, which is only made when it is used
+    response = client.get('/api/urls/', headers=auth)
+    assert 'ETag' not in response.headers
+    response = client.head('/api/urls/', headers=auth)
+    etag = response.headers['ETag']
+
+    response = client.get('/api/urls/', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # urls of other users do not affect the listing
+    client.put('/api/urls/def', json={'url': 'http://example.com'}, headers=other_auth)
+    response = client.get('/api/urls/', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 304
+
+    client.delete('/api/urls/abc', headers=auth)
+    response = client.get('/api/urls/', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json() == []
+    assert response.headers['ETag'] != etag
+
+
+def test_get_token_conditional(db, client):
+    auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+
+    api_key = client.post('/api/tokens/', json={'name': 'abc'}, headers=auth).get_json()['api_key']
+    response = client.get(f'/api/tokens/{api_key}', headers=auth)
+    etag = response.headers['ETag']
+
+    response = client.get(f'/api/tokens/{api_key}', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 304
+
+    client.patch(f'/api/tokens/{api_key}', json={'is_blocked': True}, headers=auth)
+    response = client.get(f'/api/tokens/{api_key}', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json()['is_blocked']
+
+
+def test_get_tokens_conditional_after_use(db, client):
+    auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+    api_key = auth['Authorization'].split()[1]
+
+    response = client.head('/api/tokens/', headers=auth)
+    etag = response.headers['ETag']
+    token_etag = client.get(f'/api/tokens/{api_key}', headers=auth).headers['ETag']
+
+    # using the token to make requests does not change its version
+    response = client.get('/api/tokens/', headers={**auth, 'If-None-Match': etag})
+    assert response.status_code == 304
+    response = client.get(f'/api/tokens/{api_key}', headers={**auth, 'If-None-Match': token_etag})
+    assert response.status_code == 304
+
+
+def test_get_urls_conditional_after_delete(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    client.put('/api/urls/def', json={'url': 'http://example.com'}, headers=auth)
+    response = client.get('/api/urls/', headers=auth)
+    assert len(response.get_json()) == 2
+    assert 'Last-Modified' not in response.headers
+
+    # deleting a url does not change the most recent modification of the others
+    client.delete('/api/urls/abc', headers=auth)
+    response = client.get('/api/urls/', headers={**auth, 'If-Modified-Since': http_date(datetime.now(UTC))})
+    assert response.status_code == 200
+    assert [url['shortcut'] for url in response.get_json()] == ['def']
+
+
+@pytest.mark.parametrize(('encoding', 'decompress'), (
+    ('gzip', gzip.decompress),
+    ('deflate', zlib.decompress),
+))
+def test_compressed_listing(db, client, encoding, decompress):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    for i in range(50):
+        client.put(f'/api/urls/u{i}', json={'url': f'http://example.com/{i}', 'meta': {'n': i}}, headers=auth)
+
+    plain = client.get('/api/urls/', headers=auth)
+    response = client.get('/api/urls/', headers={**auth, 'Accept-Encoding': f'{encoding}, identity;q=0.5'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert response.headers['Content-Encoding'] == encoding
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(decompress(response.data)) == plain.get_json()
+    assert len(response.data) < len(plain.data)
+    etag = client.head('/api/urls/', headers=auth).headers['ETag']
+    response = client.get('/api/urls/', headers={**auth, 'Accept-Encoding': encoding, 'If-None-Match': '"outdated"'})
+    assert response.headers['ETag'] == etag[:-1] + f'-{encoding}"'
+
+    # the etag of the compressed response can be used for conditional requests
+    response = client.get('/api/urls/', headers={**auth, 'Accept-Encoding': encoding,
+                                                 'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_small_response_not_compressed(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    response = client.get('/api/urls/abc', headers={**auth, 'Accept-Encoding': 'gzip'})
+
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_json()['url'] == 'http://example.com'
+
+
+def test_pool_stats(db, client):
+    admin_auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    response = client.get('/api/internal/pool', headers=auth)
+    assert response.status_code == 403
+
+    response = client.get('/api/internal/pool', headers=admin_auth)
+    assert response.status_code == 200
+    stats = response.get_json()['default']
+    assert stats['checked_out'] >= 1
+    assert stats['checkouts'] >= 1
+    assert stats['size'] == 5
+
+
+def test_profiling_settings(db, app, client, monkeypatch):
+    monkeypatch.setitem(app.extensions, 'sql_profiling', ProfilingSettings())
+    admin_auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    response = client.patch('/api/internal/profiling', json={'enabled': True}, headers=auth)
+    assert response.status_code == 403
+    assert not app.extensions['sql_profiling'].enabled
+
+    response = client.patch('/api/internal/profiling', json={'enabled': True, 'slow_query_threshold': 50},
+                            headers=admin_auth)
+    assert response.status_code == 200
+    assert response.get_json() == {'enabled': True, 'slow_query_threshold': 50, 'explain_rate': 0, 'pid': os.getpid()}
+    response = client.patch('/api/internal/profiling', json={'explain_rate': 2}, headers=admin_auth)
+    assert response.status_code == 400
+    assert 'explain_rate' in response.get_json()['error']['messages']
+    response = client.get('/api/internal/profiling', headers=admin_auth)
+    assert response.get_json() == {'enabled': True, 'slow_query_threshold': 50, 'explain_rate': 0, 'pid': os.getpid()}
+
+
+def test_request_profile(db, app, client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.extensions, 'request_profile', None)
+    admin_auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    token = Token.query.filter_by(name='non-admin').one()
+    db.session.add(URL(shortcut='abc', url='https://example.com', token=token))
+    db.session.flush()
+
+    response = client.post('/api/internal/profile', json={}, headers=auth)
+    assert response.status_code == 403
+    assert app.extensions['request_profile'] is None
+    response = client.post('/api/internal/profile', json={'endpoint': 'nothing'}, headers=admin_auth)
+    assert response.status_code == 400
+    assert 'endpoint' in response.get_json()['error']['messages']
+    assert client.get('/api/internal/profile/pstats', headers=admin_auth).status_code == 404
+
+    response = client.post('/api/internal/profile', json={'endpoint': 'redirection.redirect_to_url', 'requests': 2,
+                                                          'memory': True}, headers=admin_auth)
+    assert response.status_code == 201
+    assert response.get_json() == {'endpoint': 'redirection.redirect_to_url', 'requests': 2,
+                                   'profiled': 0, 'cpu': True, 'memory': True, 'active': True}
+    # requests to other endpoints are not profiled
+    client.get('/api/urls/', headers=auth)
+    for __ in range(3):
+        assert client.get('/abc').status_code == 302
+    response = client.get('/api/internal/profile', headers=admin_auth)
+    assert response.get_json().items() >= {'profiled': 2, 'active': False}.items()
+    assert app.extensions['request_profile'].allocations
+
+    (tmp_path / 'ursh.pstats').write_bytes(client.get('/api/internal/profile/pstats', headers=admin_auth).get_data())
+    stats = pstats.Stats(str(tmp_path / 'ursh.pstats')).stats
+    # stats are keyed by (filename, line, function) and the call count is the second value
+    assert any(function == 'redirect_to_url' and 'redirection.py' in filename and calls == 2
+               for (filename, __, function), (__, calls, *__) in stats.items())
+    response = client.get('/api/internal/profile/collapsed', headers=admin_auth)
+    assert response.mimetype == 'text/plain'
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in response.get_data(as_text=True).splitlines())
+    assert client.get('/api/internal/profile/memory', headers=admin_auth).status_code == 200
+
+    client.post('/api/internal/profile', json={}, headers=admin_auth)
+    response = client.delete('/api/internal/profile', headers=admin_auth)
+    assert response.get_json().items() >= {'endpoint': None, 'requests': 0, 'active': False}.items()
+    client.get('/abc')
+    assert app.extensions['request_profile'].profiled == 0
+
+
+@pytest.mark.parametrize('result', ('pstats', 'collapsed', 'memory'))
+def test_single_request_profile(db, client, result, tmp_path):
+    admin_auth = make_auth(db, 'admin', is_admin=True, is_blocked=False)
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    token = Token.query.filter_by(name='non-admin').one()
+    db.session.add(URL(shortcut='abc', url='https://example.com', token=token))
+    db.session.flush()
+
+    # the header is ignored unless the request is sent with an admin token
+    for headers in ({'X-Ursh-Profile': result}, {'X-Ursh-Profile': result, **auth},
+                    {'X-Ursh-Profile': 'nothing', **admin_auth}):
+        response = client.get('/abc', headers=headers)
+        assert response.status_code == 302
+        assert 'X-Ursh-Profile-Status' not in response.headers
+
+    response = client.get('/abc', headers={'X-Ursh-Profile': result, **admin_auth})
+    assert response.status_code == 200
+    assert response.headers['X-Ursh-Profile-Status'] == '302'
+    if result == 'pstats':
+        (tmp_path / 'ursh.pstats').write_bytes(response.get_data())
+        stats = pstats.Stats(str(tmp_path / 'ursh.pstats')).stats
+        assert any(function == 'redirect_to_url' for __, __, function in stats)
+    else:
+        assert response.mimetype == 'text/plain'
+        lines = response.get_data(as_text=True).splitlines()
+        # a fast request may not be caught by the stack sampler at all
+        assert lines or result == 'collapsed'
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+def test_health(db, client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'READINESS_CHECK_INTERVAL', 0)
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'OK'
+
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['status'] == 'ready'
+    assert set(data['checks']) == {'database', 'pools', 'jobs', 'cache', 'logging'}
+    assert data['checks']['database']['latency']['default'] > 0
+    assert data['checks']['jobs'] == {'status': 'ok', 'lag': 0}
+    # the cache is still empty, which is only worth a warning
+    assert data['checks']['cache'] == {'status': 'warning', 'entries': 0, 'size': app.config['REDIRECT_CACHE_SIZE']}
+
+    # saturated pools are only a warning unless failing is enabled
+    with monkeypatch.context() as m:
+        m.setattr('ursh.core.health._get_pool_usage', lambda stats: 1)
+        response = client.get('/readyz')
+        assert response.status_code == 200
+        pools = response.get_json()['checks']['pools']
+        assert pools.items() >= {'status': 'warning', 'saturated': ['default']}.items()
+        m.setitem(app.config, 'READINESS_MAX_POOL_USAGE', 1)
+        response = client.get('/readyz')
+        assert response.status_code == 503
+        assert response.get_json()['checks']['pools']['status'] == 'error'
+
+    def _fail(*args):
+        raise OperationalError('SELECT 1', {}, Exception('connection refused'))
+
+    monkeypatch.setattr('ursh.core.health._execute', _fail)
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    data = response.get_json()
+    assert data['status'] == 'unavailable'
+    assert data['checks']['database'].items() >= {'status': 'error', 'errors': {'default': 'OperationalError'}}.items()
+    assert data['checks']['jobs'] == {'status': 'warning', 'lag': None}
+    # the liveness probe does not care about the database
+    assert client.get('/healthz').status_code == 200
+
+
+def test_readiness_interval(db, client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'READINESS_CHECK_INTERVAL', 0)
+    assert client.get('/readyz').status_code == 200
+    monkeypatch.setitem(app.config, 'READINESS_CHECK_INTERVAL', 60)
+    monkeypatch.setattr('ursh.core.health._execute', lambda *args: 1 / 0)
+    # the previous results are reused
+    assert client.get('/readyz').status_code == 200
+
+
+def test_pgbouncer_mode_statement_timeout(db, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'DB_PGBOUNCER_MODE', True)
+    monkeypatch.setitem(app.config, 'DB_STATEMENT_TIMEOUT', 1234)
+    with db.engine.begin() as conn:
+        assert conn.exec_driver_sql('SHOW statement_timeout').scalar() == '1234ms'
+    with db.engine.connect() as conn:
+        # the timeout is only set for the transaction
+        assert conn.exec_driver_sql('SHOW statement_timeout').scalar() == '0'
+
+
+@pytest.fixture
+def replica(app, db, postgresql, monkeypatch):
+    """Register a "replica" (actually the primary) and track the queries sent to it.
+
+    Since it uses a separate connection, uncommitted test data is not visible
+    on the replica.
+    """
+    engine = create_engine(postgresql)
+    queries = []
+    event.listen(engine, 'before_cursor_execute', lambda conn, cursor, statement, *args: queries.append(statement))
+    monkeypatch.setitem(db.engines, 'replica-0', engine)
+    monkeypatch.setitem(app.config, 'REPLICA_BIND_KEYS', ['replica-0'])
+    yield queries
+    engine.dispose()
+
+
+def test_redirect_uses_replica(db, client, replica):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    assert not any('urls' in query for query in replica)
+
+    response = client.get('/abc')
+    assert response.status_code == 404
+    assert any('FROM urls' in query for query in replica)
+
+
+def test_api_read_your_writes(db, client, replica):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+
+    response = client.get('/api/urls/', headers=auth)
+    assert response.status_code == 200
+    assert response.get_json() == []
+    assert any('FROM urls' in query for query in replica)
+
+    replica.clear()
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    response = client.get('/api/urls/abc', headers=auth)
+    assert response.status_code == 200
+    assert response.get_json()['url'] == 'http://example.com'
+    assert not any('FROM urls' in query for query in replica)
+
+
+def test_lagging_replica_not_used(db, app, client, replica, monkeypatch):
+    monkeypatch.setitem(app.config, 'REPLICA_MAX_LAG', -1)
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token.query.filter_by(name='non-admin').one()))
+    db.session.flush()
+
+    response = client.get('/abc')
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'http://example.com'
+    assert not any('FROM urls' in query for query in replica)
+    response = client.get('/api/urls/abc', headers=auth)
+    assert response.status_code == 200
+
+
+def test_unavailable_replica_not_used(db, app, client, postgresql, monkeypatch):
+    engine = create_engine(make_url(postgresql).set(database='does-not-exist'))
+    monkeypatch.setitem(db.engines, 'replica-0', engine)
+    monkeypatch.setitem(app.config, 'REPLICA_BIND_KEYS', ['replica-0'])
+    make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token.query.filter_by(name='non-admin').one()))
+    db.session.flush()
+
+    response = client.get('/abc')
+    assert response.status_code == 302
+
+
+def test_replica_without_lag_not_used(db, app, client, replica, monkeypatch):
+    # e.g. a standby which has not replayed anything yet
+    monkeypatch.setattr(_ReplicaStatus, '_lag_query', text('SELECT NULL'))
+    make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token.query.filter_by(name='non-admin').one()))
+    db.session.flush()
+
+    response = client.get('/abc')
+    assert response.status_code == 302
+    assert not any('FROM urls' in query for query in replica)
+
+
+def test_statement_timeout_per_route(db, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'STATEMENT_TIMEOUTS', {'redirection': 500, 'urls': 1234, 'urls.urls': '2s'})
+    for path, expected in (('/abc', '500ms'), ('/api/tokens/', '1234ms'), ('/api/urls/', '2s'), ('/', '0')):
+        with app.test_request_context(path), db.engine.begin() as conn:
+            assert conn.exec_driver_sql('SHOW statement_timeout').scalar() == expected
+
+
+def test_redirect_lane(app, committing_db, client):
+    db = committing_db
+    token = create_user(db, 'lane-test', is_admin=True)
+    db.session.add(URL(shortcut='lane-test', url='http://example.com', token=token))
+    db.session.commit()
+    try:
+        response = client.get('/lane-test')
+        assert response.status_code == 302
+        lane_engines = [engine for base_engine, lane, engine in get_lane_engines()
+                        if base_engine is db.engine and lane == 'redirection']
+        assert len(lane_engines) == 1
+        # the timeout of the lane is set when connecting instead of in every transaction
+        with lane_engines[0].connect() as conn:
+            assert conn.exec_driver_sql('SHOW statement_timeout').scalar() == '500ms'
+        response = client.get('/api/internal/pool', headers={'Authorization': f'Bearer {token.api_key}'})
+        assert response.get_json()['default/redirection']['checkouts'] >= 1
+    finally:
+        URL.query.filter_by(token=token).delete()
+        db.session.delete(token)
+        db.session.commit()
+
+
+def test_redirect_served_from_cache_on_timeout(db, client, monkeypatch):
+    make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    db.session.add(URL(shortcut='abc', url='http://example.com', token=Token.query.filter_by(name='non-admin').one()))
+    db.session.flush()
+    response = client.get('/abc')
+    assert response.status_code == 302
+
+    def _timeout(shortcut):
+        raise OperationalError('SELECT', {}, QueryCanceled())
+
+    monkeypatch.setattr(sys.modules['ursh.blueprints.redirection'], '_get_target_url', _timeout)
+    response = client.get('/abc')
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'http://example.com'
+    response = client.get('/xyz')
+    assert response.status_code == 503
+
+
+def test_redirect_cache_invalidated(db, client, monkeypatch):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    client.put('/api/urls/abc', json={'url': 'http://example.com'}, headers=auth)
+    assert client.get('/abc').status_code == 302
+    assert get_redirect_cache().get('abc') == ('http://example.com', None)
+    client.patch('/api/urls/abc', json={'url': 'http://example.org'}, headers=auth)
+    assert get_redirect_cache().get('abc') is None
+    assert client.get('/abc').headers['Location'] == 'http://example.org'
+    client.delete('/api/urls/abc', headers=auth)
+    assert get_redirect_cache().get('abc') is None
+
+
+def test_url_expiry(db, client):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    response = client.put('/api/urls/abc', json={'url': 'http://example.com', 'expires_at': '2000-01-01T00:00:00'},
+                          headers=auth)
+    assert response.get_json()['expires_at'] == '2000-01-01T00:00:00+00:00'
+    assert client.get('/abc').status_code == 410
+    response = client.patch('/api/urls/abc', json={'expires_at': '2100-01-01T00:00:00Z'}, headers=auth)
+    assert response.get_json()['expires_at'] == '2100-01-01T00:00:00+00:00'
+    assert client.get('/abc').status_code == 302
+    response = client.patch('/api/urls/abc', json={'expires_at': None}, headers=auth)
+    assert response.get_json()['expires_at'] is None
+    assert client.get('/abc').status_code == 302
+
+
+def test_expired_url_not_served_from_cache(db, client, monkeypatch):
+    auth = make_auth(db, 'non-admin', is_admin=False, is_blocked=False)
+    expires_at = datetime.now(UTC) + timedelta(minutes=1)
+    client.put('/api/urls/abc', json={'url': 'http://example.com', 'expires_at': expires_at.isoformat()}, headers=auth)
+    assert client.get('/abc').status_code == 302
+    assert get_redirect_cache().get('abc') == ('http://example.com', expires_at)
+
+    def _timeout(shortcut):
+        raise OperationalError('SELECT', {}, QueryCanceled())
+
+    monkeypatch.setattr(sys.modules['ursh.blueprints.redirection'], '_get_target_url', _timeout)
+    assert client.get('/abc').status_code == 302
+    get_redirect_cache().set('abc', ('http://example.com', datetime.now(UTC)))
+    assert client.get('/abc').status_code == 410
+
+
+@pytest.mark.parametrize('transfer', (False, True))
+def test_delete_token_with_urls(db, client, transfer):
+    admin_auth = make_auth(db, 'admin', is_admin=True)
+    token = create_user(db, 'departed')
+    other = create_user(db, 'other')
+    for i in range(3):
+        db.session.add(URL(shortcut=f'url{i}', url='http://example.com', token_id=token.id))
+    db.session.flush()
+    assert client.get('/url0').status_code == 302
+    api_key = token.api_key
+    assert client.delete(f'/api/tokens/{api_key}', headers=admin_auth).status_code == 409
+    response = client.delete(f'/api/tokens/{api_key}', query_string={'transfer_urls_to': api_key},
+                             headers=admin_auth)
+    assert response.status_code == 400
+    query_string = {'transfer_urls_to': other.api_key} if transfer else {'delete_urls': True}
+    response = client.delete(f'/api/tokens/{api_key}', query_string=query_string, headers=admin_auth)
+    assert response.status_code == 202
+    assert token.is_blocked
+    assert run_job(claim_job())
+    assert claim_job() is None
+    assert Token.query.filter_by(name='departed').one_or_none() is None
+    if transfer:
+        assert {url.token.name for url in URL.query} == {'other'}
+        assert client.get('/url0').status_code == 302
+    else:
+        assert URL.query.count() == 0
+        assert client.get('/url0').status_code == 404
+        assert get_redirect_cache().get('url0') is None
+
+
+def test_rewrite_urls(db, client):
+    auth = make_auth(db, 'user')
+    admin_auth = make_auth(db, 'admin', is_admin=True)
+    token = Token.query.filter_by(name='user').one()
+    for i in range(3):
+        db.session.add(URL(shortcut=f'url{i}', url=f'https://old.example.org/{i}', token=token))
+    db.session.add(URL(shortcut='other', url='https://example.com/', token=token))
+    db.session.flush()
+    assert client.get('/url0').location == 'https://old.example.org/0'
+    data = {'from_prefix': 'https://old.example.org/', 'to_prefix': 'https://new.example.org/'}
+    assert client.post('/api/url-rewrites/', json=data, headers=auth).status_code == 403
+    response = client.post('/api/url-rewrites/', json={**data, 'to_prefix': data['from_prefix']}, headers=admin_auth)
+    assert response.status_code == 400
+    assert response.get_json()['error']['messages'] == {'to_prefix': ['The prefixes must be different.']}
+    response = client.post('/api/url-rewrites/', json={**data, 'dry_run': True}, headers=admin_auth)
+    assert response.status_code == 200
+    assert response.get_json() == {'count': 3}
+    assert claim_job() is None
+    response = client.post('/api/url-rewrites/', json={**data, 'batch_size': 2}, headers=admin_auth)
+    assert response.status_code == 202
+    assert response.get_json() == {'count': 3}
+    assert run_job(claim_job())
+    db.session.expire_all()
+    assert sorted(url.url for url in URL.query) == ['https://example.com/', 'https://new.example.org/0',
+                                                    'https://new.example.org/1', 'https://new.example.org/2']
+    assert client.get('/url0').location == 'https://new.example.org/0'
+    assert get_redirect_cache().get('url0') == ('https://new.example.org/0', None)
@@ -0,0 +1,59 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from flask import current_app
+
+from ursh.cli.core import cli
+from ursh.core.seed import SyntheticDataset, _CSVStream, seed_database, write_trace
+from ursh.models import ALPHABET_RESTRICTED, URL, Token
+
+
+def test_seed_database(db):
+    dataset = SyntheticDataset(500, 5, seed=1)
+    assert seed_database(dataset, batch_size=200) == 500
+    assert Token.query.filter(Token.name.startswith('seed-1-')).count() == 5
+    urls = URL.query.all()
+    assert len(urls) == 500
+    assert all(len(url.shortcut) == current_app.config['URL_LENGTH'] for url in urls)
+    assert all(set(url.shortcut) <= set(ALPHABET_RESTRICTED) for url in urls)
+    assert sum(1 for url in urls if url.meta) > 300
+    # the same seed results in the same dataset, which is not added again
+    assert seed_database(SyntheticDataset(500, 5, seed=1), batch_size=200) == 0
+    assert URL.query.count() == 500
+
+
+def test_csv_stream():
+    rows = [{'a': i, 'b': f'x,"{i}"'} for i in range(1000)]
+    consumed = []
+    stream = _CSVStream((consumed.append(row) or row for row in rows), ['a', 'b'])
+    # only the rows needed for the data which was read are written
+    data = stream.read(100)
+    assert len(data) == 100
+    assert len(consumed) < 10
+    while chunk := stream.read(100):
+        data += chunk
+    expected = io.StringIO()
+    csv.DictWriter(expected, ['a', 'b']).writerows(rows)
+    assert data == expected.getvalue()
+
+
+def test_write_trace():
+    dataset = SyntheticDataset(1000, 5, seed=1)
+    shortcuts = {dataset.get_shortcut(i) for i in range(1000)}
+    assert len(shortcuts) == 1000
+    trace = io.StringIO()
+    write_trace(dataset, trace, 5000)
+    requests = [json.loads(line) for line in trace.getvalue().splitlines()]
+    assert len(requests) == 5000
+    assert {request['path'][1:] for request in requests} <= shortcuts
+    # a few urls get most of the requests
+    counts = Counter(request['path'] for request in requests).most_common()
+    assert sum(count for __, count in counts[:10]) > 1000
+
+
+def test_seed_cli_requires_postgres(sqlite_app):
+    result = sqlite_app.test_cli_runner().invoke(cli, ['dev', 'seed', '--urls', '10'])
+    assert result.exit_code == 2
+    assert 'only supported with a single PostgreSQL database' in result.output
@@ -0,0 +1,109 @@
+import gzip
+import json
+
+import pytest
+
+from ursh.cli.core import cli
+from ursh.core.app import create_app
+from ursh.core.openapi_artifact import SOURCE_HASH_FIELD, is_spec_artifact_stale
+from ursh.core.startup import _parse_import_times, run_startup_profile
+
+
+def _create_swagger_app(tmp_path, spec_file=None):
+    uri = f'sqlite:///{tmp_path / "ursh.db"}'
+    config = tmp_path / 'ursh.cfg'
+    config.write_text(f'SQLALCHEMY_DATABASE_URI = {uri!r}\n'
+                      'ENABLE_SWAGGER = True\n'
+                      "METRICS_URL = '/metrics'\n"
+                      f'OPENAPI_SPEC_FILE = {spec_file and str(spec_file)!r}\n')
+    return create_app(str(config), testing=True)
+
+
+@pytest.fixture
+def swagger_app(tmp_path):
+    app = _create_swagger_app(tmp_path)
+    # the cli commands use the current app
+    with app.app_context():
+        yield app
+
+
+def test_lazy_openapi_spec(swagger_app):
+    apispec = swagger_app.extensions['openapi']
+    assert apispec.spec is None
+    response = swagger_app.test_client().get('/swagger/')
+    assert response.status_code == 200
+    spec = response.get_json()
+    assert {'/{shortcut}', '/readyz', '/api/internal/pool'} <= set(spec['paths'])
+    assert any(path.startswith('/api/urls/') for path in spec['paths'])
+    # the spec is only built once
+    assert apispec.get_spec() is apispec.spec
+
+
+def test_openapi_export(swagger_app):
+    result = swagger_app.test_cli_runner().invoke(cli, ['openapi', 'export-json'])
+    assert result.exit_code == 0, result.output
+    assert '"/api/tokens/"' in result.output
+
+
+def test_prebuilt_openapi_spec(swagger_app, tmp_path):
+    path = tmp_path / 'openapi.json'
+    runner = swagger_app.test_cli_runner()
+    result = runner.invoke(cli, ['openapi', 'check', str(path)])
+    assert result.exit_code == 1
+    assert 'does not exist' in result.output
+    result = runner.invoke(cli, ['openapi', 'build', str(path)])
+    assert result.exit_code == 0, result.output
+    assert gzip.decompress((tmp_path / 'openapi.json.gz').read_bytes()) == path.read_bytes()
+    assert runner.invoke(cli, ['openapi', 'check', str(path)]).exit_code == 0
+
+    app = _create_swagger_app(tmp_path, path)
+    client = app.test_client()
+    response = client.get('/swagger/', headers={'Accept-Encoding': 'gzip'})
+    assert response.content_encoding == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(response.get_data()) == path.read_bytes()
+    response = client.get('/swagger/', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    response = client.get('/swagger/')
+    assert response.content_encoding is None
+    spec = response.get_json()
+    assert spec.pop(SOURCE_HASH_FIELD)
+    assert spec == swagger_app.test_client().get('/swagger/').get_json()
+    assert client.get('/swagger-ui/').status_code == 200
+    # export-json uses the prebuilt spec as well
+    with app.app_context():
+        result = app.test_cli_runner().invoke(cli, ['openapi', 'export-json'])
+    assert json.loads(result.output) == json.loads(path.read_text())
+
+
+def test_stale_openapi_spec(swagger_app, tmp_path):
+    path = tmp_path / 'openapi.json'
+    swagger_app.test_cli_runner().invoke(cli, ['openapi', 'build', str(path)])
+    assert not is_spec_artifact_stale(path)
+    path.write_text(json.dumps({**json.loads(path.read_text()), SOURCE_HASH_FIELD: 'old'}))
+    assert is_spec_artifact_stale(path)
+    result = swagger_app.test_cli_runner().invoke(cli, ['openapi', 'check', str(path)])
+    assert result.exit_code == 1
+    assert 'out of date' in result.output
+
+
+def test_startup_timings(swagger_app):
+    timings = swagger_app.extensions['startup_timings']
+    assert {'logging', 'config', 'database', 'blueprints', 'openapi'} <= set(timings)
+    assert all(duration >= 0 for duration in timings.values())
+
+
+def test_parse_import_times():
+    output = ('import time: self [us] | cumulative | imported package\n'
+              'import time:       100 |        100 |   sqlalchemy.sql\n'
+              'import time:       200 |        300 | sqlalchemy\n'
+              'import time:        50 |        350 | ursh\n')
+    assert _parse_import_times(output) == {'sqlalchemy': pytest.approx(0.0003), 'ursh': pytest.approx(0.00005)}
+
+
+def test_startup_profile():
+    results = run_startup_profile(runs=1)
+    assert results['import'] > 0
+    assert results['create_app'] > 0
+    assert 'blueprints' in results['phases']
+    assert {'ursh', 'sqlalchemy'} <= set(results['packages'])
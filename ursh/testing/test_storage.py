@@ -0,0 +1,426 @@
+from datetime import UTC, datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+from ursh import db as db_
+from ursh.cli.key import cli as apikey_cli
+from ursh.cli.urls import cli as urls_cli
+from ursh.core.app import create_app
+from ursh.models import URL
+from ursh.storage import MemoryStorage, SQLStorage, TokenInUseError, get_storage
+from ursh.storage.sharded import get_shard_index
+
+
+@pytest.fixture(params=['postgres', 'sqlite', 'sharded', 'memory'])
+def storage(request):
+    """Provide each storage backend; all of them must behave the same."""
+    if request.param == 'postgres':
+        request.getfixturevalue('db')
+        return SQLStorage()
+    elif request.param == 'sqlite':
+        request.getfixturevalue('sqlite_app')
+        return SQLStorage()
+    elif request.param == 'sharded':
+        return request.getfixturevalue('sharded_app').extensions['storage']
+    else:
+        return MemoryStorage()
+
+
+@pytest.fixture
+def token(storage):
+    token = storage.create_token({'name': 'test'})
+    storage.commit()
+    return token
+
+
+def _url_values(token, shortcut, url='http://example.com', meta=None, is_custom=True, expires_at=None):
+    return {'shortcut': shortcut, 'url': url, 'meta': meta or {}, 'token_id': token.id, 'is_custom': is_custom,
+            'expires_at': expires_at}
+
+
+def test_create_url(storage, token):
+    url = storage.create_url(_url_values(token, 'abc', meta={'foo': 'bar'}))
+    storage.commit()
+    assert url.shortcut == 'abc'
+    assert url.token.name == 'test'
+    assert storage.create_url(_url_values(token, 'abc', url='http://example.org')) is None
+
+    url = storage.get_url('abc')
+    assert url.url == 'http://example.com'
+    assert url.meta == {'foo': 'bar'}
+    assert storage.get_url_target('abc') == ('http://example.com', None)
+    assert storage.get_url_owner('abc') == token.id
+    assert storage.get_url_version('abc') is not None
+    assert storage.get_url('xyz') is None
+    assert storage.get_url_target('xyz') is None
+    assert storage.get_url_owner('xyz') is None
+    assert storage.get_url_version('xyz') is None
+
+
+def test_create_urls(storage, token):
+    storage.create_url(_url_values(token, 'abc'))
+    urls = storage.create_urls([_url_values(token, shortcut) for shortcut in ('abc', 'def', 'ghi')])
+    storage.commit()
+    assert sorted(url.shortcut for url in urls) == ['def', 'ghi']
+    assert storage.filter_urls()[0] == 3
+
+
+def test_get_or_create_url(storage, token):
+    storage.create_url(_url_values(token, 'custom'))
+    url = storage.get_or_create_url(_url_values(token, 'abc', is_custom=False))
+    assert url.shortcut == 'abc'
+    url = storage.get_or_create_url(_url_values(token, 'def', is_custom=False))
+    assert url.shortcut == 'abc'
+    url = storage.get_or_create_url(_url_values(token, 'def', url='http://example.org', is_custom=False))
+    assert url.shortcut == 'def'
+    assert storage.get_or_create_url(_url_values(token, 'custom', url='http://example.net', is_custom=False)) is None
+    # only urls with the same expiry are reused
+    expires_at = datetime(2100, 1, 1, tzinfo=UTC)
+    url = storage.get_or_create_url(_url_values(token, 'ghi', is_custom=False, expires_at=expires_at))
+    assert url.shortcut == 'ghi'
+    url = storage.get_or_create_url(_url_values(token, 'jkl', is_custom=False, expires_at=expires_at))
+    assert url.shortcut == 'ghi'
+
+
+def test_update_url(storage, token):
+    storage.create_url(_url_values(token, 'abc', meta={'a': 1, 'b': {'c': 2, 'd': 3}}))
+    url = storage.update_url('abc', {'url': 'http://example.org'})
+    assert url.url == 'http://example.org'
+    url = storage.update_url('abc', {'meta': {'a': None, 'b': {'c': 4}, 'e': [1]}}, merge_meta=True)
+    assert url.meta == {'b': {'c': 4, 'd': 3}, 'e': [1]}
+    url = storage.update_url('abc', {'meta': {'x': 'y'}})
+    assert url.meta == {'x': 'y'}
+    storage.commit()
+    assert storage.get_url('abc').meta == {'x': 'y'}
+    assert storage.update_url('xyz', {'url': 'http://example.org'}) is None
+    assert storage.update_url('xyz', {'meta': {}}, merge_meta=True) is None
+
+
+def test_delete_expired_urls(storage, token):
+    now = datetime.now(UTC)
+    storage.create_urls([_url_values(token, f'url{i}', expires_at=now - timedelta(minutes=i)) for i in range(5)])
+    storage.create_urls([_url_values(token, 'future', expires_at=now + timedelta(minutes=1)),
+                         _url_values(token, 'never')])
+    storage.commit()
+    assert storage.get_url_target('url0')[1] == now
+    assert storage.delete_expired_urls(now, 3) >= 3
+    assert storage.delete_expired_urls(now, 3) <= 2
+    assert storage.delete_expired_urls(now, 3) == 0
+    storage.commit()
+    assert sorted(url.shortcut for url in storage.filter_urls()[2]) == ['future', 'never']
+
+
+def test_purge_expired_urls(sqlite_app):
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    expires_at = datetime.now(UTC) - timedelta(minutes=1)
+    storage.create_urls([_url_values(token, f'url{i}', expires_at=expires_at) for i in range(5)])
+    storage.commit()
+    result = sqlite_app.test_cli_runner().invoke(urls_cli, ['purge-expired', '--batch-size', '2'])
+    assert result.output == 'Deleted 5 expired URLs\n'
+    assert storage.filter_urls()[0] == 0
+
+
+def test_delete_url(storage, token):
+    storage.create_url(_url_values(token, 'abc'))
+    assert storage.delete_url('abc').shortcut == 'abc'
+    storage.commit()
+    assert storage.get_url('abc') is None
+    assert storage.delete_url('abc') is None
+
+
+def test_filter_urls(storage, token, monkeypatch):
+    # the urls of each shard are fetched in several chunks
+    monkeypatch.setattr('ursh.storage.sharded.FETCH_SIZE', 1)
+    other = storage.create_token({'name': 'other'})
+    storage.create_urls([
+        _url_values(token, 'abc', meta={'event': {'id': 1}, 'public': True}),
+        _url_values(token, 'def', url='http://example.org', meta={'event': {'id': 2}, 'a"b': {'c.d': 'x'}}),
+        _url_values(other, 'ghi', meta={'event': {'id': 1}, 'public': False}),
+        _url_values(other, 'jkl', meta={'event': 'none', 'a\\b': 1}),
+    ])
+    storage.commit()
+
+    def _get_shortcuts(**kwargs):
+        count, last_modified, urls = storage.filter_urls(**kwargs)
+        shortcuts = sorted(url.shortcut for url in urls)
+        assert count == len(shortcuts)
+        assert (last_modified is None) == (not count)
+        return shortcuts
+
+    assert _get_shortcuts() == ['abc', 'def', 'ghi', 'jkl']
+    assert _get_shortcuts(url='http://example.com') == ['abc', 'ghi', 'jkl']
+    assert _get_shortcuts(token_id=token.id) == ['abc', 'def']
+    assert _get_shortcuts(meta={'event': {'id': 1}}) == ['abc', 'ghi']
+    assert _get_shortcuts(meta={'event': {'id': 1}, 'public': True}) == ['abc']
+    assert _get_shortcuts(token_id=other.id, meta={'event': {'id': 2}}) == []
+    # keys are not interpreted in any way
+    assert _get_shortcuts(meta={'a"b': {'c.d': 'x'}}) == ['def']
+    assert _get_shortcuts(meta={'a\\b': 1}) == ['jkl']
+    assert _get_shortcuts(meta={'a"b': 'x'}) == []
+    count, last_modified, urls = storage.filter_urls(token_id=token.id, with_version=False)
+    assert (count, last_modified) == (None, None)
+    assert sorted(url.shortcut for url in urls) == ['abc', 'def']
+
+
+def test_tokens(storage, token):
+    assert storage.create_token({'name': 'test'}) is None
+    assert storage.get_token(token.api_key).name == 'test'
+    assert storage.get_token(token.api_key.upper()).name == 'test'
+    assert storage.get_token('invalid') is None
+    assert storage.get_token_by_name('test').api_key == token.api_key
+    assert storage.get_token_by_name('invalid') is None
+    assert storage.get_token_version(token.api_key) is not None
+    assert storage.get_token_version('invalid') is None
+    assert not token.is_admin
+    assert not token.is_blocked
+
+    token = storage.update_token(token.api_key, {'is_blocked': True})
+    storage.commit()
+    assert storage.get_token(token.api_key).is_blocked
+    assert storage.update_token('invalid', {'is_blocked': True}) is None
+
+    storage.create_token({'name': 'admin', 'is_admin': True})
+    storage.commit()
+    assert [t.name for t in storage.filter_tokens(is_admin=True)[2]] == ['admin']
+    assert storage.filter_tokens()[0] == 2
+
+
+def test_record_token_access(storage, token):
+    storage.record_token_access(token, token.last_access, write=False)
+    storage.commit()
+    assert storage.get_token(token.api_key).token_uses == 1
+    assert storage.get_token(token.api_key).last_write is None
+    storage.record_token_access(token, token.last_access, write=True)
+    storage.commit()
+    token = storage.get_token(token.api_key)
+    assert token.token_uses == 2
+    assert token.last_write == token.last_access
+
+
+def test_delete_token(storage, token):
+    storage.create_url(_url_values(token, 'abc'))
+    storage.commit()
+    with pytest.raises(TokenInUseError):
+        storage.delete_token(token.api_key)
+    storage.delete_url('abc')
+    assert storage.delete_token(token.api_key).name == 'test'
+    storage.commit()
+    assert storage.get_token(token.api_key) is None
+    assert storage.delete_token(token.api_key) is None
+
+
+def test_delete_and_transfer_token_urls(storage, token):
+    other = storage.create_token({'name': 'other'})
+    storage.create_urls([_url_values(token, f'url{i}') for i in range(5)])
+    storage.commit()
+    assert storage.transfer_token_urls(token.id, other.id, 3) == 3
+    assert storage.transfer_token_urls(token.id, other.id, 3) == 2
+    assert storage.transfer_token_urls(token.id, other.id, 3) == 0
+    storage.commit()
+    assert storage.filter_urls(token_id=token.id)[0] == 0
+    assert storage.get_url('url0').token.name == 'other'
+    shortcuts = storage.delete_token_urls(other.id, 3) + storage.delete_token_urls(other.id, 3)
+    assert sorted(shortcuts) == [f'url{i}' for i in range(5)]
+    assert storage.delete_token_urls(other.id, 3) == []
+    storage.commit()
+    assert storage.filter_urls()[0] == 0
+
+
+def test_delete_api_key_with_urls(sqlite_app):
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    storage.create_token({'name': 'other'})
+    storage.create_urls([_url_values(token, f'url{i}') for i in range(5)])
+    storage.commit()
+    runner = sqlite_app.test_cli_runner()
+    result = runner.invoke(apikey_cli, ['delete', '-n', 'test'])
+    assert 'there are URLs associated with it' in result.output
+    result = runner.invoke(apikey_cli, ['delete', '-n', 'test', '--transfer-urls-to', 'other', '--batch-size', '2'])
+    assert result.exit_code == 0
+    assert '5/5 URLs transferred' in result.output
+    assert storage.get_token_by_name('test') is None
+    assert {url.token.name for url in storage.filter_urls()[2]} == {'other'}
+    result = runner.invoke(apikey_cli, ['delete', '-n', 'other', '--delete-urls'])
+    assert result.exit_code == 0
+    assert '5/5 URLs deleted' in result.output
+    assert storage.filter_urls()[0] == 0
+
+
+def test_rewrite_url_prefix(storage, token):
+    long_path = 'x' * 300
+    storage.create_urls([
+        *(_url_values(token, f'url{i}', url=f'https://old.example.org/{i}') for i in range(5)),
+        _url_values(token, 'long', url=f'https://old.example.org/{long_path}/a'),
+        _url_values(token, 'upper', url='https://OLD.example.org/'),
+        _url_values(token, 'other', url='https://other.example.org/https://old.example.org/'),
+        _url_values(token, 'wildcard', url='https://old.example.org/a%b'),
+    ])
+    storage.commit()
+    assert storage.filter_urls(url_prefix='https://old.example.org/')[0] == 7
+    assert storage.filter_urls(url_prefix=f'https://old.example.org/{long_path}/')[0] == 1
+    assert storage.filter_urls(url_prefix='https://old.example.org/a%')[0] == 1
+    assert storage.filter_urls(url_prefix='https://old.example.org/_')[0] == 0
+    assert len(storage.rewrite_url_prefix('https://old.example.org/', 'https://new.example.org/', 4)) == 4
+    assert len(storage.rewrite_url_prefix('https://old.example.org/', 'https://new.example.org/', 4)) == 3
+    assert storage.rewrite_url_prefix('https://old.example.org/', 'https://new.example.org/', 4) == []
+    storage.commit()
+    assert storage.get_url('url0').url == 'https://new.example.org/0'
+    assert storage.get_url('long').url == f'https://new.example.org/{long_path}/a'
+    assert storage.get_url('upper').url == 'https://OLD.example.org/'
+    assert storage.get_url('other').url == 'https://other.example.org/https://old.example.org/'
+    # urls which already start with the new prefix are not rewritten again
+    storage.create_url(_url_values(token, 'v2', url='https://new.example.org/v2/a'))
+    shortcuts = storage.rewrite_url_prefix('https://new.example.org/', 'https://new.example.org/v2/', 10)
+    assert len(shortcuts) == 7
+    assert 'v2' not in shortcuts
+    assert storage.rewrite_url_prefix('https://new.example.org/', 'https://new.example.org/v2/', 10) == []
+    storage.commit()
+    assert storage.get_url('url0').url == 'https://new.example.org/v2/0'
+    assert storage.get_url('v2').url == 'https://new.example.org/v2/a'
+
+
+def test_rewrite_urls_cli(sqlite_app):
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    storage.create_urls([_url_values(token, f'url{i}', url=f'https://old.example.org/{i}') for i in range(5)])
+    storage.commit()
+    runner = sqlite_app.test_cli_runner()
+    args = ['rewrite', '--from-prefix', 'https://old.example.org/', '--to-prefix', 'https://new.example.org/']
+    result = runner.invoke(urls_cli, [*args, '--dry-run'])
+    assert result.output == '5 URLs would be rewritten\n'
+    result = runner.invoke(urls_cli, [*args, '--batch-size', '2'])
+    assert result.exit_code == 0
+    assert '5/5 URLs rewritten' in result.output
+    assert storage.filter_urls(url_prefix='https://new.example.org/')[0] == 5
+
+
+def test_shard_index():
+    shortcuts = [f'shortcut{i}' for i in range(1000)]
+    assert {get_shard_index(shortcut, 1) for shortcut in shortcuts} == {0}
+    for num_shards in (2, 3, 10):
+        indexes = [get_shard_index(shortcut, num_shards) for shortcut in shortcuts]
+        assert all(indexes.count(index) > 500 / num_shards for index in range(num_shards))
+        # when adding a shard, urls may only move to the new shard
+        new_indexes = [get_shard_index(shortcut, num_shards + 1) for shortcut in shortcuts]
+        assert all(new in (old, num_shards) for old, new in zip(indexes, new_indexes, strict=True))
+
+
+def _count_urls(app):
+    return [db_.session.execute(select(func.count()).select_from(URL)).scalar()] + [
+        conn.execute(select(func.count()).select_from(URL)).scalar()
+        for conn in (db_.engines[key].connect() for key in app.config['SHARD_BIND_KEYS'])
+    ]
+
+
+def test_sharded_urls(sharded_app):
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    storage.create_urls([_url_values(token, f'url{i}') for i in range(20)])
+    storage.commit()
+    main, *shards = _count_urls(sharded_app)
+    assert main == 0
+    assert sum(shards) == 20
+    assert all(shards)
+    for i in range(20):
+        url = storage.get_url(f'url{i}')
+        assert url.token.name == 'test'
+        assert storage.get_url_owner(f'url{i}') == token.id
+
+
+def test_rebalance_shards(sharded_app):
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    storage.commit()
+    # urls created before switching to sharded storage are in the main database
+    db_.session.execute(URL.__table__.insert(), [_url_values(token, f'url{i}') for i in range(20)])
+    db_.session.commit()
+    assert storage.get_url('url0') is None
+
+    assert storage.rebalance(batch_size=7, dry_run=True) == 20
+    assert _count_urls(sharded_app) == [20, 0, 0]
+    progress = []
+    assert storage.rebalance(batch_size=7, callback=lambda *args: progress.append(args)) == 20
+    assert [args for args in progress if args[0] is None][-1] == (None, 20, 20, 0)
+    main, *shards = _count_urls(sharded_app)
+    assert main == 0
+    assert sum(shards) == 20
+    assert storage.get_url('url0').url == 'http://example.com'
+    assert storage.rebalance(batch_size=7) == 0
+
+
+def test_rebalance_shards_in_use(sharded_app, monkeypatch, caplog):
+    monkeypatch.setitem(sharded_app.config, 'SHARD_REBALANCING', True)
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    other_token = storage.create_token({'name': 'other'})
+    storage.commit()
+    db_.session.execute(URL.__table__.insert(), [_url_values(token, f'url{i}') for i in range(5)])
+    db_.session.commit()
+
+    # urls which have not been moved yet can be used as usual
+    assert storage.get_url('url0').token.name == 'test'
+    assert storage.get_url_owner('url0') == token.id
+    assert storage.get_url_target('url0').url == 'http://example.com'
+    assert storage.create_url(_url_values(other_token, 'url1', url='http://example.com/other')) is None
+    assert storage.update_url('url2', {'url': 'http://example.com/new'}).url == 'http://example.com/new'
+    assert storage.delete_url('url3').shortcut == 'url3'
+    storage.commit()
+    assert _count_urls(sharded_app)[0] == 2
+    assert storage.get_url('url1').token.name == 'test'
+    assert storage.get_url('url2').url == 'http://example.com/new'
+    assert storage.get_url('url3') is None
+
+    # a url which cannot be moved since its shortcut is taken is not lost
+    shard_session = storage._get_url_session('url4')
+    shard_session.execute(URL.__table__.insert(), [_url_values(other_token, 'url4', url='http://example.com/other')])
+    shard_session.commit()
+    progress = []
+    assert storage.rebalance(batch_size=7, callback=lambda *args: progress.append(args)) == 1
+    assert [args for args in progress if args[0] is None][-1] == (None, 2, 1, 1)
+    assert 'url4' in caplog.text
+    assert _count_urls(sharded_app)[0] == 1
+    assert db_.session.execute(select(URL.url).filter_by(shortcut='url4')).scalar() == 'http://example.com'
+
+
+def test_sharded_api(sharded_app):
+    storage = get_storage()
+    token = storage.create_token({'name': 'test'})
+    storage.commit()
+    auth = {'Authorization': f'Bearer {token.api_key}'}
+    client = sharded_app.test_client()
+    for i in range(5):
+        response = client.put(f'/api/urls/url{i}', json={'url': f'http://example.com/{i}'}, headers=auth)
+        assert response.status_code == 201
+        assert response.get_json()['owner'] == 'test'
+    response = client.get('/api/urls/', headers=auth)
+    assert sorted(url['shortcut'] for url in response.get_json()) == [f'url{i}' for i in range(5)]
+    response = client.get('/url3')
+    assert response.headers['Location'] == 'http://example.com/3'
+    assert client.delete('/api/urls/url3', headers=auth).status_code == 204
+    assert client.get('/url3').status_code == 404
+
+
+def test_api_without_database():
+    app = create_app(testing=True)
+    app.config['STORAGE_BACKEND'] = 'memory'
+    app.extensions['storage'] = storage = MemoryStorage()
+    client = app.test_client()
+    with app.app_context():
+        token = storage.create_token({'name': 'test'})
+    auth = {'Authorization': f'Bearer {token.api_key}'}
+
+    response = client.put('/api/urls/abc', json={'url': 'http://example.com', 'meta': {'a': 1}}, headers=auth)
+    assert response.status_code == 201
+    response = client.patch('/api/urls/abc', json={'meta': {'b': 2}}, headers=auth,
+                            content_type='application/merge-patch+json')
+    assert response.get_json()['meta'] == {'a': 1, 'b': 2}
+    response = client.get('/api/urls/', headers=auth)
+    assert [url['shortcut'] for url in response.get_json()] == ['abc']
+    response = client.get('/abc')
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'http://example.com'
+    response = client.delete('/api/urls/abc', headers=auth)
+    assert response.status_code == 204
+    assert client.get('/abc').status_code == 404
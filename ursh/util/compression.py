@@ -0,0 +1,64 @@
+import zlib
+
+from flask import current_app, request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _get_compressors():
+    compressors = {}
+    if zstandard is not None:
+        compressors['zstd'] = lambda level: zstandard.ZstdCompressor(level=level).compressobj()
+    compressors['gzip'] = lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressors['deflate'] = lambda level: zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    return compressors
+
+
+# in order of preference in case the client accepts multiple encodings with the same quality
+COMPRESSORS = _get_compressors()
+
+
+def compress_response(response):
+    """Compress a response using the best encoding accepted by the client.
+
+    Streamed responses are compressed chunk by chunk while they are
+    sent, so they never need to be buffered in memory; other responses
+    are only compressed if they are at least ``COMPRESSION_MIN_SIZE``
+    bytes large.
+    """
+    if not _should_compress(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(COMPRESSORS)
+    if encoding is None:
+        return response
+    compressor = COMPRESSORS[encoding](current_app.config['COMPRESSION_LEVEL'])
+    if response.is_streamed:
+        response.response = _compress_stream(response.iter_encoded(), compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+    response.content_encoding = encoding
+    # different representations of a resource must not share a strong etag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f'{etag}-{encoding}')
+    return response
+
+
+def _should_compress(response):
+    if (response.status_code < 200 or response.status_code in (204, 304) or 300 <= response.status_code < 400
+            or response.direct_passthrough or response.content_encoding
+            or 'no-transform' in response.cache_control):
+        return False
+    return response.is_streamed or response.calculate_content_length() >= current_app.config['COMPRESSION_MIN_SIZE']
+
+
+def _compress_stream(chunks, compressor):
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,40 @@
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+
+from ursh.util.compression import COMPRESSORS
+
+
+def make_etag(*parts):
+    """Build a strong ETag from the values identifying a resource version."""
+    return hashlib.sha1('\0'.join(map(str, parts)).encode()).hexdigest()
+
+
+def get_conditional_headers(etag, last_modified=None):
+    """Get the ``ETag`` and ``Last-Modified`` headers for a response."""
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def is_conditional_request():
+    """Check whether the current request contains any cache validators."""
+    return bool(request.if_none_match or request.if_modified_since)
+
+
+def make_not_modified_response(etag, last_modified=None):
+    """Get a ``304 Not Modified`` response if the client's copy is still valid.
+
+    :return: A `Response` or ``None`` if the resource has been modified
+             and thus needs to be sent to the client.
+    """
+    if request.if_none_match:
+        # compressed responses use a separate etag for each encoding
+        variants = [etag, *(f'{etag}-{encoding}' for encoding in COMPRESSORS)]
+        if not any(request.if_none_match.contains(variant) for variant in variants):
+            return None
+    elif is_resource_modified(request.environ, last_modified=last_modified):
+        return None
+    return Response(status=304, headers=get_conditional_headers(etag, last_modified))
@@ -1,41 +1,84 @@
-import os
 from importlib import import_module
-from importlib.util import find_spec
 
+from sqlalchemy import Text, case, cast, func, literal, select, type_coerce
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
+from sqlalchemy.exc import IntegrityError
 
-def _get_package_root_path(import_name):
-    """Get the root path of a package.
+from ursh import db
 
-    Returns ``None`` if the specified import name is invalid or
-    points to a module instead of a package.
-    """
-    spec = find_spec(import_name)
-    if spec is None or not spec.parent:
-        # no parent if it's not a package (PEP 451)
-        return None
-    paths = spec.submodule_search_locations
-    assert len(paths) == 1
-    return paths[0]
+# the modules defining models, which need to be imported before the models are used
+MODEL_MODULES = ('ursh.models',)
 
 
-def import_all_models(package_name):
-    """Import all modules inside 'models' folders of a package.
+def import_all_models():
+    """Import all modules defining SQLAlchemy models.
 
     The purpose of this is to import all SQLAlchemy models when the
     application is initialized so there are no cases where models
     end up not being imported e.g. because they are only referenced
     implicitly in a relationship instead of being imported somewhere.
-
-    :param package_name: Top-level package name to scan for models.
+    The modules are listed in `MODEL_MODULES` instead of searching
+    the package for them, which would slow down the startup.
     """
-    package_root = _get_package_root_path(package_name)
-    modules = []
-    for root, _dirs, files in os.walk(package_root):
-        if os.path.basename(root) == 'models':
-            package = os.path.relpath(root, package_root).replace(os.sep, '.')
-            modules += [f'{package_name}.{package}.{name[:-3]}'
-                        for name in files
-                        if name.endswith('.py') and name != 'blueprint.py' and not name.endswith('_test.py')]
-
-    for module in modules:
+    for module in MODEL_MODULES:
         import_module(module)
+
+
+def json_merge_patch(target, patch):
+    """Build an SQL expression applying a JSON merge patch to a JSONB value.
+
+    The semantics follow RFC 7396: keys set to ``None`` are removed,
+    nested objects are merged recursively and any other value replaces
+    the existing one.  Since the whole merge is a single expression, it
+    can be used directly in an ``UPDATE`` statement without having to
+    read the current value first.
+
+    :param target: The JSONB SQL expression to patch (usually a column).
+    :param patch: A dict containing the merge patch.
+    """
+    target = type_coerce(target, JSONB)
+    expr = target
+    values = {k: v for k, v in patch.items() if v is not None and not isinstance(v, dict)}
+    if values:
+        expr = expr.op('||')(literal(values, JSONB))
+    for key, value in patch.items():
+        if not isinstance(value, dict):
+            continue
+        current = case((func.jsonb_typeof(target[key]) == 'object', target[key]), else_=literal({}, JSONB))
+        expr = expr.op('||')(func.jsonb_build_object(key, json_merge_patch(current, value)))
+    if removed := [k for k, v in patch.items() if v is None]:
+        expr = expr.op('-')(cast(literal(removed, ARRAY(Text)), ARRAY(Text)))
+    return type_coerce(expr, JSONB)
+
+
+def insert_unless_exists(model, values, *index_elements, session=None):
+    """Insert a new row unless it conflicts with an existing one.
+
+    This runs a single ``INSERT ... ON CONFLICT DO NOTHING RETURNING``
+    statement, so unlike checking for an existing row first it cannot
+    fail with an integrity error when another transaction creates the
+    same row concurrently.
+
+    :param model: The model class to insert a row for.
+    :param values: A dict containing the column values of the new row.
+    :param index_elements: The columns of the unique index which may
+                           conflict with an existing row.
+    :param session: The session to use instead of the default one.
+    :return: The newly created object or ``None`` in case of a conflict.
+    """
+    if session is None:
+        session = db.session
+    if session.get_bind(model.__mapper__).dialect.name != 'postgresql':
+        # other databases (i.e. sqlite) serialize writes anyway, so a savepoint is good enough there
+        obj = model(**values)
+        try:
+            with session.begin_nested():
+                session.add(obj)
+        except IntegrityError:
+            return None
+        return obj
+    stmt = (insert(model)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=index_elements)
+            .returning(*model.__table__.c))
+    return session.execute(select(model).from_statement(stmt)).scalar_one_or_none()
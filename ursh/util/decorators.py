@@ -1,10 +1,17 @@
+import hashlib
+import json
+from datetime import UTC, datetime, timedelta
 from functools import wraps
 
-from flask import g
+from flask import current_app, g, jsonify, request
 from flask_apispec import marshal_with
+from sqlalchemy.exc import SQLAlchemyError
 
+from ursh import db
 from ursh.blueprints.api.handlers import create_error_json
-from ursh.models import URL
+from ursh.models import IdempotencyKey
+from ursh.storage import get_storage
+from ursh.util.db import insert_unless_exists
 
 
 def admin_only(f):
@@ -34,8 +41,108 @@ def authorize_request_for_url(f):
     def wrapper(*args, **kwargs):
         shortcut = kwargs.get('shortcut')
         if shortcut:
-            url = URL.query.filter_by(shortcut=shortcut).one_or_none()
-            if url and url.token != g.token and not g.token.is_admin:
+            token_id = get_storage().get_url_owner(shortcut)
+            if token_id is not None and token_id != g.token.id and not g.token.is_admin:
                 return create_error_json(403, 'insufficient-permissions', 'You are not allowed to make this request')
         return f(*args, **kwargs)
     return wrapper
+
+
+def idempotent(f):
+    """Replay the original response when a request is retried.
+
+    Requests containing an ``Idempotency-Key`` header are only processed
+    once per key and token; the successful response is stored and sent
+    again for any later request with the same key (until it expires
+    after ``IDEMPOTENCY_KEY_TTL`` seconds).
+
+    The key is committed before the request is processed, so a retry
+    arriving in the meantime fails with ``409 Conflict`` instead of
+    being processed as well.  If processing the request fails, the key
+    is deleted again so the request can be retried.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key or not get_storage().supports_idempotency_keys:
+            return f(*args, **kwargs)
+        request_hash = _get_request_hash()
+        entry = _get_idempotency_key(key)
+        if entry is None:
+            entry = insert_unless_exists(IdempotencyKey, {'token_id': g.token.id, 'key': key,
+                                                          'request_hash': request_hash}, 'token_id', 'key')
+            if entry is None:
+                # a concurrent request with the same key has just been completed
+                entry = _get_idempotency_key(key)
+            else:
+                return _run_idempotent(entry, f, *args, **kwargs)
+        if entry.request_hash != request_hash:
+            return create_error_json(422, 'idempotency-key-reused',
+                                     'This idempotency key has already been used for a different request')
+        elif entry.status_code is None:
+            return create_error_json(409, 'idempotency-key-in-use',
+                                     'A request with this idempotency key is still being processed')
+        response = jsonify(entry.response)
+        response.status_code = entry.status_code
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapper
+
+
+def _get_request_hash():
+    # retries may serialize the same data differently, e.g. with another key order
+    if (data := request.get_json(silent=True)) is not None:
+        body = json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+    else:
+        body = request.get_data()
+    return hashlib.sha256(b'\0'.join([request.method.encode(), request.path.encode(), body])).hexdigest()
+
+
+def _get_idempotency_key(key):
+    entry = IdempotencyKey.query.filter_by(token_id=g.token.id, key=key).one_or_none()
+    if entry is not None and entry.created_at < _get_idempotency_key_expiry():
+        db.session.delete(entry)
+        db.session.flush()
+        return None
+    return entry
+
+
+def _get_idempotency_key_expiry():
+    return datetime.now(UTC) - timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+
+
+def _run_idempotent(entry, f, *args, **kwargs):
+    entry_id = entry.id
+    # concurrent requests with the same key need to see that it is in use while we process the request
+    db.session.commit()
+    try:
+        response = current_app.make_response(f(*args, **kwargs))
+    except Exception:
+        _release_idempotency_key(entry_id)
+        raise
+    if response.status_code >= 400 or not response.is_json:
+        _release_idempotency_key(entry_id)
+        return response
+    entry.status_code = response.status_code
+    entry.response = response.get_json()
+    db.session.commit()
+    return response
+
+
+def _release_idempotency_key(entry_id):
+    # failed requests may be retried with the same key, so we must not keep it around
+    try:
+        _delete_idempotency_key(entry_id)
+    except SQLAlchemyError:
+        # the failed request may have left the transaction unusable, but the key was committed before
+        db.session.rollback()
+        try:
+            _delete_idempotency_key(entry_id)
+        except SQLAlchemyError:
+            db.session.rollback()
+            current_app.logger.exception('Could not release idempotency key %d', entry_id)
+
+
+def _delete_idempotency_key(entry_id):
+    IdempotencyKey.query.filter_by(id=entry_id).delete(synchronize_session='fetch')
+    db.session.commit()
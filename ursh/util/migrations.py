@@ -0,0 +1,190 @@
+import time
+from contextlib import contextmanager
+
+import click
+from alembic import op
+from sqlalchemy import column, func, literal_column, select, table, text, true, update
+
+
+def is_shard():
+    """Check whether the current migration is running on a shard.
+
+    Shards only contain the ``urls`` table, so anything touching other
+    tables needs to be skipped there.
+    """
+    return op.get_context().opts.get('shard') is not None
+
+
+def _is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def _is_index_valid(index_name):
+    query = text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)')
+    return op.get_bind().execute(query, {'name': index_name}).scalar()
+
+
+def create_index_concurrently(index_name, table_name, columns, **kwargs):
+    """Create an index without blocking writes to the table.
+
+    On Postgres this uses ``CREATE INDEX CONCURRENTLY``, which cannot run
+    inside a transaction, so anything done by the migration so far is
+    committed first.  If the index already exists it is kept, unless it
+    is an invalid leftover of an interrupted build, which is dropped and
+    built again.
+
+    :param index_name: The name of the index.
+    :param table_name: The name of the table.
+    :param columns: The columns to index.
+    :param kwargs: Additional arguments for `op.create_index`, e.g.
+                   ``postgresql_using='gin'``.
+    """
+    if not _is_postgres():
+        op.create_index(index_name, table_name, columns, if_not_exists=True, **kwargs)
+        return
+    with op.get_context().autocommit_block():
+        valid = _is_index_valid(index_name)
+        if valid:
+            return
+        elif valid is not None:
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+        # the build waits for all transactions using the table to finish, which
+        # must not be aborted by the lock timeout used for other migrations
+        op.execute('SET lock_timeout = 0')
+        try:
+            op.create_index(index_name, table_name, columns, postgresql_concurrently=True, **kwargs)
+        finally:
+            op.execute('RESET lock_timeout')
+
+
+def drop_index_concurrently(index_name, table_name):
+    """Drop an index without blocking access to the table.
+
+    Like `create_index_concurrently`, this commits anything done by the
+    migration so far when running on Postgres.
+    """
+    if not _is_postgres():
+        op.drop_index(index_name, table_name=table_name, if_exists=True)
+        return
+    with op.get_context().autocommit_block():
+        op.execute('SET lock_timeout = 0')
+        try:
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+        finally:
+            op.execute('RESET lock_timeout')
+
+
+def replace_index_concurrently(index_name, table_name, columns, **kwargs):
+    """Replace an index with a new definition without blocking access to the table.
+
+    On Postgres the new index is built under a temporary name next to the
+    old one, which is only dropped and replaced once the new one is ready,
+    so queries can keep using the index at all times.  Like
+    `create_index_concurrently`, this commits anything done by the
+    migration so far and can be restarted if it was interrupted.
+
+    :param index_name: The name of the index.
+    :param table_name: The name of the table.
+    :param columns: The columns to index.
+    :param kwargs: Additional arguments for `op.create_index`, e.g.
+                   ``postgresql_include=['foo']``.
+    """
+    if not _is_postgres():
+        op.drop_index(index_name, table_name=table_name, if_exists=True)
+        op.create_index(index_name, table_name, columns, **kwargs)
+        return
+    tmp_name = f'{index_name}_tmp'
+    create_index_concurrently(tmp_name, table_name, columns, **kwargs)
+    drop_index_concurrently(index_name, table_name)
+    with op.get_context().autocommit_block():
+        op.execute(f'ALTER INDEX {tmp_name} RENAME TO {index_name}')
+
+
+@contextmanager
+def batch_alter_table(table_name):
+    """Alter a table using `op.batch_alter_table`.
+
+    On SQLite, where the table is recreated, this also keeps its indexes
+    on expressions, which are lost otherwise since they are not reflected.
+
+    :param table_name: The name of the table.
+    """
+    conn = op.get_bind()
+    indexes = []
+    if conn.dialect.name == 'sqlite':
+        query = text("SELECT name, sql FROM sqlite_master "
+                     "WHERE type = 'index' AND tbl_name = :table AND sql IS NOT NULL")
+        indexes = conn.execute(query, {'table': table_name}).all()
+    with op.batch_alter_table(table_name) as batch_op:
+        yield batch_op
+    for name, sql in indexes:
+        if not conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+                            {'name': name}).scalar():
+            conn.exec_driver_sql(sql)
+
+
+def set_not_null(table_name, column_name):
+    """Make a column NOT NULL without blocking access to the table.
+
+    On Postgres, making a column NOT NULL checks all rows while holding a
+    lock which blocks even reads of the table.  Instead, the rows are
+    checked using a constraint which does not need such a lock, which
+    Postgres then uses to skip checking the rows again.  The column must
+    not contain any NULL values, so it usually needs to be filled using
+    `backfill` first.
+
+    :param table_name: The name of the table.
+    :param column_name: The name of the column.
+    """
+    if not _is_postgres():
+        with batch_alter_table(table_name) as batch_op:
+            batch_op.alter_column(column_name, nullable=False)
+        return
+    constraint = f'ck_{table_name}_{column_name}_not_null'
+    # each statement is committed on its own, so the locks are only held briefly
+    with op.get_context().autocommit_block():
+        op.execute(f'ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {constraint}')
+        op.execute(f'ALTER TABLE {table_name} ADD CONSTRAINT {constraint} CHECK ({column_name} IS NOT NULL) NOT VALID')
+        op.execute(f'ALTER TABLE {table_name} VALIDATE CONSTRAINT {constraint}')
+        op.alter_column(table_name, column_name, nullable=False)
+        op.execute(f'ALTER TABLE {table_name} DROP CONSTRAINT {constraint}')
+
+
+def backfill(table_name, values, where=None):
+    """Update all rows of a table in small batches.
+
+    Each batch is committed on its own, so rows are only locked briefly
+    and the migration can be interrupted and started again at any time.
+    The batch size and the delay between batches are set using the
+    options of ``ursh db upgrade``.
+
+    :param table_name: The name of the table, which needs an ``id`` column.
+    :param values: A dict mapping column names to the SQL expressions
+                   used to fill them, e.g. ``{'foo': 'lower(bar)'}``.
+    :param where: An SQL condition matching the rows which still need to
+                  be updated, e.g. ``'foo IS NULL'``, so restarting the
+                  migration skips rows which have already been updated.
+    :return: The number of updated rows.
+    """
+    opts = op.get_context().opts
+    batch_size = opts.get('batch_size') or 1000
+    batch_delay = opts.get('batch_delay') or 0
+    tbl = table(table_name, column('id'), *(column(name) for name in values))
+    values = {name: literal_column(value) if isinstance(value, str) else value for name, value in values.items()}
+    condition = text(where) if where else true()
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        max_id = conn.execute(select(func.max(tbl.c.id))).scalar() or 0
+        last_id = updated = 0
+        while ids := conn.execute(select(tbl.c.id)
+                                  .where(tbl.c.id > last_id, condition)
+                                  .order_by(tbl.c.id)
+                                  .limit(batch_size)).scalars().all():
+            updated += conn.execute(update(tbl).where(tbl.c.id.in_(ids)).values(values)).rowcount
+            last_id = ids[-1]
+            click.echo(f'\r{table_name}: {updated} rows updated ({min(100, last_id * 100 // max_id)}%)', nl=False)
+            if batch_delay:
+                time.sleep(batch_delay)
+    if updated:
+        click.echo()
+    return updated